@@ -0,0 +1,147 @@
+''' Micro-benchmarks of the client and server hot paths, no Redis or Mongo needed
+
+    $ PYTHONPATH=. python benchmarks/hot_paths.py --output current.json
+    $ PYTHONPATH=. python benchmarks/hot_paths.py --compare baseline.json --threshold 1.2
+
+    Every result is the best of --repeat runs in microseconds per operation. With --compare the
+    exit status is 1 when some benchmark is more than --threshold times slower than in the baseline.
+'''
+import datetime
+import json
+import optparse
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+from redongo import cipher_utils, envelope_utils, queue_utils, serializer_utils
+from redongo.redongo_client import RedongoClient
+from redongo.redongo_server import RedongoServer
+import new
+
+HEADER = ('benchmarkApp', 'json', 'save')
+FLAT_DOC = {'_id': 123454321, 'int_field': 100, 'long_field': 100L, 'float_field': 100.0, 'str_field': 'value', 'list_field': ['list_element'] * 5}
+NESTED_DOC = dict(FLAT_DOC, dict_field={'int_field': 1, 'inner': {'float_field': 1.5, 'str_field': 'value', 'list_field': [1, 2]}})
+OBJECTID_DOC = dict(FLAT_DOC, ref='5a1d2a8e9c3b4f0012345678', objectid_fields=['ref', 'bad_ref'], bad_ref='not an id')
+
+
+class Document(object):
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+
+def get_cases():
+    ''' [(name, function)], every call of function is one operation '''
+    cases = []
+
+    for payloads in (1, 100):
+        # Different strings, pickle would memoize repeated ones
+        data = [json.dumps(dict(FLAT_DOC, _id=i)) for i in range(payloads)]
+        for envelope_format in envelope_utils.ENVELOPE_FORMATS:
+            item = envelope_utils.dumps(HEADER, data, envelope_format)
+            cases.append(('envelope.{0}.dumps.{1}'.format(envelope_format, payloads), lambda data=data, envelope_format=envelope_format: envelope_utils.dumps(HEADER, data, envelope_format)))
+            cases.append(('envelope.{0}.loads.{1}'.format(envelope_format, payloads), lambda item=item: envelope_utils.loads(item)))
+
+    for serializer_type in ('json', 'ujson', 'pickle'):
+        ser = serializer_utils.serializer(serializer_type)
+        payload = ser.dumps(NESTED_DOC)
+        cases.append(('serializer.{0}.dumps'.format(serializer_type), lambda ser=ser: ser.dumps(NESTED_DOC)))
+        cases.append(('serializer.{0}.loads'.format(serializer_type), lambda ser=ser, payload=payload: ser.loads(payload)))
+
+    server = RedongoServer.__new__(RedongoServer)
+    # normalize_object changes the object, the copy is part of the measure
+    cases.append(('server.normalize_object', lambda: server.normalize_object(dict(OBJECTID_DOC))))
+    cases.append(('server.create_add_query.flat', lambda: server.create_add_query(FLAT_DOC)))
+    cases.append(('server.create_add_query.nested', lambda: server.create_add_query(NESTED_DOC)))
+
+    cipher = cipher_utils.AESCipher('0123456789abcdef')
+    encrypted = cipher.encrypt('mongo password')
+    cases.append(('cipher.decrypt', lambda: cipher.decrypt(encrypted)))
+
+    # Old-style class, no Redis connection is made
+    client = new.instance(RedongoClient, {})
+    cases.append(('client.serialize_object.dict', lambda: client.serialize_object(dict(FLAT_DOC))))
+    document = Document(FLAT_DOC)
+    cases.append(('client.serialize_object.object', lambda: client.serialize_object(document) and document.__dict__.pop('objectid_fields')))
+
+    item = envelope_utils.dumps(HEADER, [json.dumps(FLAT_DOC)])
+    directory = tempfile.mkdtemp(prefix='redongo-benchmark-')
+    queue = queue_utils.Queue(queue_name='{0}/queue'.format(directory))
+    items = [item] * 1000
+
+    def push_pop_single():
+        queue.push(item)
+        queue.pop()
+
+    def push_pop_batch():
+        queue.push_many(items)
+        queue.pop_many(len(items))
+
+    cases.append(('queue.push_pop.single', push_pop_single))
+    # One operation is 1000 items
+    cases.append(('queue.push_pop.batch_1000', push_pop_batch))
+    return cases, lambda: (queue.close(), shutil.rmtree(directory))
+
+
+def measure(function, min_time, repeat):
+    number = 1
+    while True:
+        elapsed = timeit.timeit(function, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed < min_time / 4 else 1 + int(min_time / max(elapsed, 1e-9))
+    return min([elapsed] + timeit.repeat(function, number=number, repeat=repeat - 1)) / number * 1e6
+
+
+def main():
+    parser = optparse.OptionParser(description='Redongo hot path benchmarks')
+    parser.add_option('--output', '-o', dest='output', help='Write the results as JSON to this file', metavar='FILE')
+    parser.add_option('--compare', '-c', dest='compare', help='JSON results to compare with', metavar='BASELINE')
+    parser.add_option('--threshold', '-t', dest='threshold', help='Slowdown ratio reported as a regression', metavar='RATIO', type='float', default=1.2)
+    parser.add_option('--filter', '-f', dest='filter', help='Only run benchmarks matching this regular expression', metavar='REGEX')
+    parser.add_option('--mintime', dest='minTime', help='Seconds of every measure', metavar='SECONDS', type='float', default=0.2)
+    parser.add_option('--repeat', dest='repeat', help='Measures of every benchmark, the best one is kept', metavar='REPEAT', type='int', default=3)
+    (options, args) = parser.parse_args()
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+
+    cases, cleanup = get_cases()
+    results = {}
+    regressions = []
+    try:
+        for name, function in cases:
+            if options.filter and not re.search(options.filter, name):
+                continue
+            microseconds = measure(function, options.minTime, options.repeat)
+            results[name] = {'us_per_op': microseconds, 'ops_per_sec': 1e6 / microseconds}
+            line = '{0:40} {1:12.3f} us'.format(name, microseconds)
+            if name in baseline:
+                ratio = microseconds / baseline[name]['us_per_op']
+                line += '  {0:6.2f}x'.format(ratio)
+                if ratio > options.threshold:
+                    line += '  REGRESSION'
+                    regressions.append(name)
+            print line
+    finally:
+        cleanup()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.utcnow().isoformat(),
+                'python': sys.version.split()[0],
+                'implementation': platform.python_implementation(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+    if regressions:
+        print '{0} regression(s): {1}'.format(len(regressions), ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,645 @@
+''' End to end load test of RedongoServer fed by RedongoClient producers, with in-process stand-ins of
+    Redis and Mongo, to size --popsize and --queuesize offline
+
+    $ PYTHONPATH=. python benchmarks/load_harness.py --popsize 100,1000 --queuesize 10000,100000 --apps 1,10
+    $ PYTHONPATH=. python benchmarks/load_harness.py --rate 5000 --mongolatency 0.02 --mongofailures 0.01 -o results.json
+
+    Every combination of the comma separated --popsize, --queuesize, --bulksize, --apps and --docsize
+    values runs in its own process for --duration seconds after --warmup seconds, reporting the objects
+    written per second, the enqueue to write latency percentiles, the peak RSS of the process (fake
+    backends and producers included) and what was spilled to disk.
+    Redis failures are injected on the producers, which retry, as the server stops on unexpected Redis errors.
+    Mongo failures make whole bulks fail, their objects are moved to the failed queue.
+    --transport picks the list or stream transport of the clients and the server, --serveroptions adds other
+    server options (e.g. '--reliable -t 8').
+'''
+import collections
+import fnmatch
+import itertools
+import json
+import logging
+import optparse
+import os
+import random
+import resource
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import redis
+from pymongo.errors import AutoReconnect
+from twisted.internet import reactor
+from redongo import mongo_utils, redongo_server, transport_utils
+from redongo.redongo_client import RedongoSentinelClient
+
+# Options taking comma separated values, (dest, flag)
+SWEEP_OPTIONS = [('popSize', '--popsize'), ('redisQueueSize', '--queuesize'), ('bulkSize', '--bulksize'), ('apps', '--apps'), ('docSize', '--docsize')]
+QUEUE = 'HARNESS_QUEUE'
+PERCENTILES = (50, 90, 99)
+
+
+class FakeRedisStore(object):
+    ''' Lists, sets, strings and streams of a Redis server, the commands used by the client and the server '''
+    def __init__(self):
+        self.lists = collections.defaultdict(collections.deque)
+        self.sets = collections.defaultdict(set)
+        self.streams = {}
+        self.strings = {}
+        self.expirations = {}
+        self.condition = threading.Condition()
+        self.scripts = {
+            transport_utils.MULTI_POP_LUA: self._multi_pop,
+            transport_utils.MULTI_POP_PROCESSING_LUA: self._multi_pop,
+            transport_utils.RECLAIM_LUA: self._reclaim,
+        }
+
+    def _get_list(self, key):
+        # Called with the lock held, empty lists don't exist
+        items = self.lists.get(key)
+        return items if items else None
+
+    def _expire(self, key):
+        expiration = self.expirations.get(key)
+        if expiration is not None and expiration <= time.time():
+            self.strings.pop(key, None)
+            self.expirations.pop(key)
+
+    def get(self, key):
+        with self.condition:
+            self._expire(key)
+            return self.strings.get(key)
+
+    def set(self, key, value, ex=None):
+        with self.condition:
+            self.strings[key] = str(value)
+            if ex:
+                self.expirations[key] = time.time() + ex
+            else:
+                self.expirations.pop(key, None)
+            return True
+
+    def incr(self, key):
+        with self.condition:
+            value = int(self.strings.get(key) or 0) + 1
+            self.strings[key] = str(value)
+            return value
+
+    def exists(self, key):
+        with self.condition:
+            self._expire(key)
+            return key in self.strings or self._get_list(key) is not None or key in self.streams
+
+    def delete(self, *keys):
+        with self.condition:
+            deleted = 0
+            for key in keys:
+                if self.strings.pop(key, None) is not None:
+                    deleted += 1
+                if self.lists.pop(key, None):
+                    deleted += 1
+                if self.sets.pop(key, None):
+                    deleted += 1
+                if self.streams.pop(key, None):
+                    deleted += 1
+            return deleted
+
+    def sadd(self, key, *values):
+        with self.condition:
+            added = len(set(values) - self.sets[key])
+            self.sets[key].update(values)
+            return added
+
+    def smembers(self, key):
+        with self.condition:
+            return set(self.sets.get(key, ()))
+
+    def rpush(self, key, *values):
+        with self.condition:
+            self.lists[key].extend(values)
+            self.condition.notify_all()
+            return len(self.lists[key])
+
+    def lpush(self, key, *values):
+        with self.condition:
+            self.lists[key].extendleft(values)
+            self.condition.notify_all()
+            return len(self.lists[key])
+
+    def llen(self, key):
+        with self.condition:
+            return len(self.lists.get(key, ()))
+
+    def blpop(self, keys, timeout=0):
+        keys = [keys] if isinstance(keys, basestring) else keys
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                for key in keys:
+                    if self._get_list(key) is not None:
+                        return key, self.lists[key].popleft()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+    def brpoplpush(self, source, destination, timeout=0):
+        deadline = time.time() + timeout
+        with self.condition:
+            while self._get_list(source) is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            item = self.lists[source].pop()
+            self.lists[destination].appendleft(item)
+            return item
+
+    def execute_command(self, *args):
+        ''' Stream commands, with the arguments used by transport_utils '''
+        function = getattr(self, '_{0}'.format(args[0].lower()), None)
+        if function is None:
+            raise NotImplementedError('Command not known by the harness: {0}'.format(args[0]))
+        with self.condition:
+            return function(*args[1:])
+
+    def _get_stream(self, key):
+        stream = self.streams.get(key)
+        if stream is None:
+            # Ordered entry ids, id -> fields, group -> {'last': last delivered id, 'pending': id -> [consumer, delivery time, deliveries]}
+            stream = self.streams[key] = {'ids': collections.deque(), 'entries': {}, 'groups': {}, 'last': (0, 0)}
+        return stream
+
+    def _xgroup(self, subcommand, key, group, start, *args):
+        stream = self._get_stream(key)
+        if group in stream['groups']:
+            raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+        stream['groups'][group] = {'last': (0, 0), 'pending': {}}
+        return True
+
+    def _xadd(self, key, entry_id, *fields):
+        stream = self._get_stream(key)
+        milliseconds = int(time.time() * 1000)
+        stream['last'] = (milliseconds, 0) if milliseconds > stream['last'][0] else (stream['last'][0], stream['last'][1] + 1)
+        entry_id = '{0}-{1}'.format(*stream['last'])
+        stream['ids'].append(stream['last'])
+        stream['entries'][stream['last']] = list(fields)
+        self.condition.notify_all()
+        return entry_id
+
+    def _xlen(self, key):
+        return len(self.streams[key]['entries']) if key in self.streams else 0
+
+    def _xreadgroup(self, *args):
+        args = list(args)
+        group, consumer = args[1], args[2]
+        count = int(args[args.index('COUNT') + 1]) if 'COUNT' in args else None
+        block = int(args[args.index('BLOCK') + 1]) if 'BLOCK' in args else None
+        # The keys after STREAMS, then as many start ids
+        streams = args[args.index('STREAMS') + 1:]
+        keys, starts = streams[:len(streams) / 2], streams[len(streams) / 2:]
+        if starts[0] != '>':
+            key, start = keys[0], starts[0]
+            stream_group = self.streams[key]['groups'][group]
+            # Pending entries of the consumer after start, deleted ones without fields
+            entry_ids = sorted(entry_id for entry_id, (owner, delivered, deliveries) in stream_group['pending'].items() if owner == consumer and entry_id > get_entry_id(start))
+            entries = self.streams[key]['entries']
+            return [[key, [['{0}-{1}'.format(*entry_id), entries.get(entry_id)] for entry_id in entry_ids[:count]]]]
+        deadline = time.time() + block / 1000.0 if block else None
+        while True:
+            response = []
+            for key in keys:
+                # Streams can be deleted while waiting
+                stream = self._get_stream(key)
+                stream_group = stream['groups'].get(group)
+                entry_ids = stream_group and [entry_id for entry_id in stream['ids'] if entry_id > stream_group['last'] and entry_id in stream['entries']][:count]
+                if entry_ids:
+                    response.append((key, stream, stream_group, entry_ids))
+            if response or deadline is None or time.time() >= deadline:
+                break
+            self.condition.wait(deadline - time.time())
+        if not response:
+            return None
+        now = time.time()
+        for key, stream, stream_group, entry_ids in response:
+            for entry_id in entry_ids:
+                stream_group['pending'][entry_id] = [consumer, now, 1]
+            stream_group['last'] = entry_ids[-1]
+        return [[key, [['{0}-{1}'.format(*entry_id), stream['entries'][entry_id]] for entry_id in entry_ids]] for key, stream, stream_group, entry_ids in response]
+
+    def _xack(self, key, group, *entry_ids):
+        pending = self.streams[key]['groups'][group]['pending']
+        return len([entry_id for entry_id in map(get_entry_id, entry_ids) if pending.pop(entry_id, None)])
+
+    def _xdel(self, key, *entry_ids):
+        stream = self.streams[key]
+        deleted = [entry_id for entry_id in map(get_entry_id, entry_ids) if stream['entries'].pop(entry_id, None) is not None]
+        while stream['ids'] and stream['ids'][0] not in stream['entries']:
+            stream['ids'].popleft()
+        return len(deleted)
+
+    def _xpending(self, key, group, start=None, end=None, count=None):
+        pending = self.streams[key]['groups'][group]['pending']
+        entry_ids = sorted(pending)
+        if start is None:
+            consumers = collections.Counter(consumer for consumer, delivered, deliveries in pending.values())
+            return [len(entry_ids), '{0}-{1}'.format(*entry_ids[0]) if entry_ids else None, '{0}-{1}'.format(*entry_ids[-1]) if entry_ids else None, [[consumer, str(n)] for consumer, n in consumers.items()]]
+        if start != '-':
+            entry_ids = [entry_id for entry_id in entry_ids if entry_id >= get_entry_id(start)]
+        now = time.time()
+        return [['{0}-{1}'.format(*entry_id), pending[entry_id][0], int((now - pending[entry_id][1]) * 1000), pending[entry_id][2]] for entry_id in entry_ids[:int(count)]]
+
+    def _xclaim(self, key, group, consumer, min_idle, *entry_ids):
+        stream = self.streams[key]
+        pending = stream['groups'][group]['pending']
+        now = time.time()
+        claimed = []
+        for entry_id in map(get_entry_id, entry_ids):
+            entry = pending.get(entry_id)
+            if entry and (now - entry[1]) * 1000 >= int(min_idle):
+                pending[entry_id] = [consumer, now, entry[2] + 1]
+                claimed.append(['{0}-{1}'.format(*entry_id), stream['entries'].get(entry_id)])
+        return claimed
+
+    def scan_iter(self, match='*', count=None):
+        with self.condition:
+            keys = [key for key, items in self.lists.items() if items] + self.strings.keys()
+        return iter(fnmatch.filter(keys, match))
+
+    def run_script(self, script, keys, args):
+        function = self.scripts.get(script)
+        if function is None:
+            raise NotImplementedError('Lua script not known by the harness: {0}'.format(script))
+        with self.condition:
+            return function(keys, args)
+
+    def _multi_pop(self, keys, args):
+        items = self._get_list(keys[0])
+        if items is None:
+            return []
+        popped = [items.popleft() for i in xrange(min(int(args[0]), len(items)))]
+        if len(keys) > 1:
+            self.lists[keys[1]].extend(popped)
+        return popped
+
+    def _reclaim(self, keys, args):
+        items = self.lists.pop(keys[0], ())
+        self.lists[keys[1]].extendleft(reversed(items))
+        self.condition.notify_all()
+        return len(items)
+
+
+def get_entry_id(entry_id):
+    milliseconds, sequence = entry_id.split('-')
+    return int(milliseconds), int(sequence)
+
+
+class FakeRedis(object):
+    ''' Connection to a FakeRedisStore. Every command, pipeline or script call waits latency seconds
+        (a round trip) and fails with redis.ConnectionError with probability failure_rate
+    '''
+    def __init__(self, store, latency=0, failure_rate=0):
+        self.store = store
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise redis.ConnectionError('Injected failure')
+
+    def __getattr__(self, name):
+        command = getattr(self.store, name)
+
+        def call(*args, **kwargs):
+            self.round_trip()
+            return command(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        def call(keys=[], args=[]):
+            self.round_trip()
+            return self.store.run_script(script, keys, args)
+        return call
+
+
+class FakePipeline(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.connection.store, name)
+
+        def add(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return add
+
+    def execute(self):
+        self.connection.round_trip()
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+class FakeMongo(object):
+    ''' Stands for every Mongo target. Every bulk waits latency seconds plus document_latency per document
+        and fails with probability failure_rate. Written documents are only counted, along with their
+        latency since the ts field set by the producers
+    '''
+    def __init__(self, latency=0, document_latency=0, failure_rate=0):
+        self.latency = latency
+        self.document_latency = document_latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.start_measure()
+
+    def start_measure(self):
+        with self.lock:
+            self.measure_start = time.time()
+            self.written = 0
+            self.bulks = 0
+            self.failed_bulks = 0
+            self.latencies = []
+
+    def get_client(self, uri):
+        return FakeMongoClient(self)
+
+    def write(self, documents):
+        time.sleep(self.latency + self.document_latency * len(documents))
+        if self.failure_rate and random.random() < self.failure_rate:
+            with self.lock:
+                self.failed_bulks += 1
+            raise AutoReconnect('Injected failure')
+        now = time.time()
+        with self.lock:
+            self.bulks += 1
+            self.written += len(documents)
+            for document in documents:
+                ts = document.get('ts') or document.get('$set', {}).get('ts')
+                if ts:
+                    self.latencies.append(now - ts)
+
+
+class FakeMongoClient(object):
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    def __getitem__(self, database):
+        return FakeDatabase(self.mongo)
+
+    def close(self):
+        pass
+
+
+class FakeDatabase(object):
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    def __getitem__(self, collection):
+        return FakeCollection(self.mongo)
+
+
+class FakeCollection(object):
+    def __init__(self, mongo):
+        self.mongo = mongo
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self.mongo)
+
+    def update(self, selector, document, upsert=False):
+        self.mongo.write([document])
+
+
+class FakeBulk(object):
+    ''' bulk.find(selector).upsert().replace_one(document) and update_one(document) '''
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.documents = []
+
+    def find(self, selector):
+        return self
+
+    def upsert(self):
+        return self
+
+    def replace_one(self, document):
+        self.documents.append(document)
+
+    def update_one(self, document):
+        self.documents.append(document)
+
+    def execute(self):
+        self.mongo.write(self.documents)
+
+
+class HarnessServer(redongo_server.RedongoServer):
+    redis_connection = None
+
+    def create_redis_connection(self):
+        self.redis = self.redis_connection
+
+
+class Producer(object):
+    ''' Saves batches of documents of doc_size bytes, round robin over applications, at rate documents
+        per second (0 for as fast as possible), retrying the batches that fail
+    '''
+    def __init__(self, number, client, applications, doc_size, batch, rate):
+        self.number = number
+        self.client = client
+        self.applications = itertools.cycle(applications)
+        self.data = 'x' * doc_size
+        self.batch = batch
+        self.rate = rate
+        self.sent = 0
+        self.errors = 0
+        self.keep_going = True
+        self._thread = threading.Thread(target=self._run, name='harness-producer-{0}'.format(number))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.keep_going = False
+        self._thread.join()
+
+    def _run(self):
+        next_batch = time.time()
+        while self.keep_going:
+            if self.rate:
+                wait = next_batch - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                next_batch += float(self.batch) / self.rate
+            application_name = next(self.applications)
+            ts = time.time()
+            documents = [{'_id': 'p{0}-{1}'.format(self.number, self.sent + i), 'ts': ts, 'data': self.data} for i in xrange(self.batch)]
+            while self.keep_going:
+                try:
+                    self.client.save_to_mongo(application_name, documents)
+                    break
+                except redis.RedisError:
+                    self.errors += 1
+                    time.sleep(0.01)
+            else:
+                return
+            self.sent += self.batch
+
+
+def get_percentiles(values):
+    values = sorted(values)
+    result = dict(('p{0}'.format(percentile), values[min(len(values) * percentile / 100, len(values) - 1)] if values else None) for percentile in PERCENTILES)
+    result['max'] = values[-1] if values else None
+    return result
+
+
+def get_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def run_configuration(options, configuration):
+    ''' Runs one configuration in this process (the reactor can't be restarted), returns its results '''
+    directory = tempfile.mkdtemp(prefix='redongo-harness-')
+    store = FakeRedisStore()
+    mongo = FakeMongo(options.mongoLatency, options.mongoDocumentLatency, options.mongoFailures)
+    server_args = [
+        '--redis', 'harness', '--redisdb', '0', '--redisqueue', QUEUE,
+        '--popsize', str(configuration['popSize']), '--queuesize', str(configuration['redisQueueSize']),
+        '--diskqueue', os.path.join(directory, 'disk_queue'), '--transport', options.transport,
+    ] + shlex.split(options.serverOptions or '')
+    redongo_server.options = redongo_server.get_option_parser().parse_args(server_args)[0]
+    HarnessServer.redis_connection = FakeRedis(store, options.redisLatency)
+    rs = redongo_server.rs = HarnessServer('Redis')
+    rs.mongo_pool = mongo_utils.MongoClientPool(rs.cipher, client_factory=mongo.get_client)
+
+    applications = ['harness_app_{0}'.format(i) for i in range(configuration['apps'])]
+    producers = []
+    for i in range(options.producers):
+        client = RedongoSentinelClient(FakeRedis(store, options.redisLatency, options.redisFailures), QUEUE, transport=options.transport)
+        producers.append(Producer(i, client, applications, configuration['docSize'], options.batch, float(options.rate) / options.producers))
+    # Settings are kept by the first producer and read from Redis by the others
+    for application_name in applications:
+        producers[0].client.set_application_settings(application_name, 'harness', 27017, 'harness', application_name, 'harness', 'harness', bulk_size=configuration['bulkSize'], bulk_expiration=options.bulkExpiration, serializer_type=options.serializer, weight=options.weight)
+
+    results = {}
+
+    def collect():
+        # Before the server returns its bulks to disk
+        for producer in producers:
+            producer.stop()
+        elapsed = time.time() - mongo.measure_start
+        with mongo.lock:
+            latencies = mongo.latencies
+            written = mongo.written
+        results.update({
+            'produced': sum(producer.sent for producer in producers),
+            'written': written,
+            'docs_per_sec': written / elapsed,
+            'latency': get_percentiles(latencies),
+            'bulks': mongo.bulks,
+            'failed_bulks': mongo.failed_bulks,
+            'failed_objects': store.llen('{0}_FAILED'.format(QUEUE)),
+            'producer_errors': sum(producer.errors for producer in producers),
+            'spill': rs.spill_worker.stats(),
+            'redis_queue_length': rs.transport.length(),
+            'disk_queue_length': sum(disk_queue._length for disk_queue in rs.disk_queues.values()),
+            'seconds': elapsed,
+        })
+
+    reactor.addSystemEventTrigger('before', 'shutdown', collect)
+    reactor.addSystemEventTrigger('before', 'shutdown', redongo_server.sigtermHandler)
+    rs.spill_worker.start()
+    reactor.callInThread(rs.run)
+    for producer in producers:
+        producer.start()
+    reactor.callLater(options.warmup, mongo.start_measure)
+    reactor.callLater(options.warmup + options.duration, redongo_server.stopApp)
+    reactor.run(installSignalHandlers=False)
+    shutil.rmtree(directory, ignore_errors=True)
+    results['peak_rss_mb'] = get_rss_mb()
+    return results
+
+
+def get_configurations(options):
+    names = [name for name, flag in SWEEP_OPTIONS]
+    values = [getattr(options, name).split(',') for name in names]
+    for combination in itertools.product(*values):
+        yield dict(zip(names, [int(value) for value in combination]))
+
+
+def format_value(value, template):
+    return template.format(value) if value is not None else '-'
+
+
+def main():
+    parser = optparse.OptionParser(description='Redongo load harness')
+    parser.add_option('--popsize', '-p', dest='popSize', help='Comma separated server pop sizes', metavar='POP_SIZES', default='1000')
+    parser.add_option('--queuesize', '-s', dest='redisQueueSize', help='Comma separated max Redis queue sizes', metavar='QUEUE_SIZES', default='10000')
+    parser.add_option('--bulksize', '-b', dest='bulkSize', help='Comma separated application bulk sizes', metavar='BULK_SIZES', default='100')
+    parser.add_option('--apps', '-a', dest='apps', help='Comma separated application counts', metavar='APPS', default='1')
+    parser.add_option('--docsize', '-D', dest='docSize', help='Comma separated document sizes in bytes', metavar='DOC_SIZES', default='200')
+    parser.add_option('--bulkexpiration', dest='bulkExpiration', help='Application bulk expiration', metavar='SECONDS', type='int', default=1)
+    parser.add_option('--serializer', dest='serializer', help='Application serializer type', metavar='SERIALIZER', default='json')
+    parser.add_option('--transport', dest='transport', help='Queue type of the clients and the server: list or stream', metavar='TRANSPORT', type='choice', choices=transport_utils.TRANSPORTS, default='list')
+    parser.add_option('--weight', dest='weight', help='Weight of the applications, 0 to send them through the shared queue', metavar='WEIGHT', type='int', default=0)
+    parser.add_option('--producers', dest='producers', help='Producer threads', metavar='PRODUCERS', type='int', default=2)
+    parser.add_option('--batch', dest='batch', help='Documents per save_to_mongo call', metavar='BATCH', type='int', default=100)
+    parser.add_option('--rate', dest='rate', help='Documents per second of all the producers (0 for as fast as possible)', metavar='RATE', type='int', default=0)
+    parser.add_option('--duration', dest='duration', help='Seconds measured', metavar='SECONDS', type='float', default=10)
+    parser.add_option('--warmup', dest='warmup', help='Seconds run before measuring', metavar='SECONDS', type='float', default=2)
+    parser.add_option('--redislatency', dest='redisLatency', help='Seconds of every Redis round trip', metavar='SECONDS', type='float', default=0)
+    parser.add_option('--redisfailures', dest='redisFailures', help='Rate of producer Redis calls failing', metavar='RATE', type='float', default=0)
+    parser.add_option('--mongolatency', dest='mongoLatency', help='Seconds of every Mongo bulk', metavar='SECONDS', type='float', default=0.005)
+    parser.add_option('--mongodoclatency', dest='mongoDocumentLatency', help='Extra seconds of every Mongo bulk per document', metavar='SECONDS', type='float', default=0)
+    parser.add_option('--mongofailures', dest='mongoFailures', help='Rate of Mongo bulks failing', metavar='RATE', type='float', default=0)
+    parser.add_option('--serveroptions', dest='serverOptions', help='Extra redongo_server options', metavar='OPTIONS')
+    parser.add_option('--log', '-l', dest='logLevel', help='Server logger level, injected failures are logged as errors', metavar='LOG_LEVEL', default='critical')
+    parser.add_option('--output', '-o', dest='output', help='Write the results as JSON to this file', metavar='FILE')
+    parser.add_option('--single', dest='single', help=optparse.SUPPRESS_HELP, action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    if options.single:
+        logging.getLogger().setLevel(getattr(logging, options.logLevel.upper(), logging.CRITICAL))
+        print json.dumps(run_configuration(options, next(get_configurations(options))))
+        return
+
+    results = []
+    print '{0:>8} {1:>9} {2:>8} {3:>4} {4:>7} | {5:>9} {6:>8} {7:>8} {8:>8} {9:>8} {10:>9} {11:>7}'.format(
+        'popsize', 'queuesize', 'bulksize', 'apps', 'docsize', 'docs/s', 'p50 ms', 'p99 ms', 'max ms', 'rss MB', 'spilled', 'failed')
+    for configuration in get_configurations(options):
+        # The last value of an option wins
+        argv = [sys.executable, os.path.abspath(__file__), '--single'] + sys.argv[1:]
+        argv.extend('{0}={1}'.format(flag, configuration[name]) for name, flag in SWEEP_OPTIONS)
+        process = subprocess.Popen(argv, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode:
+            sys.exit('Configuration {0} failed with status {1}'.format(configuration, process.returncode))
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append({'configuration': configuration, 'results': result})
+        latency = result['latency']
+        print '{0:>8} {1:>9} {2:>8} {3:>4} {4:>7} | {5:>9.0f} {6:>8} {7:>8} {8:>8} {9:>8.1f} {10:>9} {11:>7}'.format(
+            configuration['popSize'], configuration['redisQueueSize'], configuration['bulkSize'], configuration['apps'], configuration['docSize'],
+            result['docs_per_sec'], format_value(latency['p50'] and latency['p50'] * 1000, '{0:.1f}'), format_value(latency['p99'] and latency['p99'] * 1000, '{0:.1f}'),
+            format_value(latency['max'] and latency['max'] * 1000, '{0:.1f}'), result['peak_rss_mb'], result['spill']['spilled_items'], result['failed_objects'])
+        sys.stdout.flush()
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump({
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'options': dict((name, value) for name, value in options.__dict__.iteritems() if name not in [sweep_name for sweep_name, flag in SWEEP_OPTIONS] + ['output', 'single']),
+                'runs': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import atexit
+import threading
+import time
+import weakref
+
+BUFFER_FULL_POLICIES = ['block', 'drop']
+# Buffers to close at exit. Open ones are kept alive by their thread, closed ones can be collected
+_open_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def close_buffers():
+    for item_buffer in list(_open_buffers):
+        item_buffer.close()
+
+
+class ItemBuffer(object):
+    ''' Collects queue items and sends them with push_function(queue, items), one call per queue.
+        A background thread flushes when flush_size items are buffered or the oldest one is max_age
+        seconds old, flush() and close() (also run at exit) flush right away.
+        At most max_items are kept: add() blocks until the next flush with the 'block' policy and
+        drops the new items with the 'drop' policy.
+    '''
+    def __init__(self, push_function, flush_size=500, max_age=1, max_items=None, full_policy='block'):
+        self.push_function = push_function
+        self.flush_size = flush_size
+        self.max_age = max_age
+        self.max_items = max_items or flush_size * 10
+        self.full_policy = full_policy
+        self.dropped = 0
+        self._buffers = {}
+        self._length = 0
+        self._oldest = None
+        self._keep_going = True
+        self._condition = threading.Condition()
+        # Keeps flushes in order when flush() is called while the thread flushes
+        self._flush_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='redongo-client-buffer')
+        self._thread.daemon = True
+        self._thread.start()
+        _open_buffers.add(self)
+
+    def __len__(self):
+        return self._length
+
+    def add(self, queue, items):
+        ''' Returns False when the items are dropped, because the buffer is full or closed '''
+        with self._condition:
+            if not self._keep_going:
+                # The thread is gone, nothing would push them
+                self.dropped += len(items)
+                return False
+            # A call bigger than the buffer only waits for it to be empty
+            while self._length and self._length + len(items) > self.max_items:
+                if self.full_policy == 'drop' or not self._keep_going:
+                    self.dropped += len(items)
+                    return False
+                self._condition.notify_all()
+                self._condition.wait()
+            self._buffers.setdefault(queue, []).extend(items)
+            self._length += len(items)
+            if self._oldest is None:
+                # The thread starts counting the age of the buffer
+                self._oldest = time.time()
+                self._condition.notify_all()
+            elif self._length >= self.flush_size:
+                self._condition.notify_all()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._condition:
+                buffers = self._buffers
+                self._buffers = {}
+                self._length = 0
+                self._oldest = None
+                self._condition.notify_all()
+            while buffers:
+                queue, items = buffers.popitem()
+                try:
+                    self.push_function(queue, items)
+                except:
+                    # Back to the front of the buffer, the next flush will retry them
+                    buffers[queue] = items
+                    with self._condition:
+                        for queue, items in buffers.iteritems():
+                            self._buffers[queue] = items + self._buffers.get(queue, [])
+                            self._length += len(items)
+                        if self._oldest is None:
+                            self._oldest = time.time()
+                    raise
+
+    def _run(self):
+        while self._keep_going:
+            with self._condition:
+                while self._keep_going and self._length < self.flush_size:
+                    if self._oldest is None:
+                        self._condition.wait()
+                    elif time.time() - self._oldest < self.max_age:
+                        self._condition.wait(self.max_age - (time.time() - self._oldest))
+                    else:
+                        break
+            if not self._keep_going:
+                return
+            try:
+                self.flush()
+            except:
+                # Redis not available, retry later
+                time.sleep(self.max_age)
+
+    def close(self):
+        with self._condition:
+            if not self._keep_going:
+                return
+            self._keep_going = False
+            self._condition.notify_all()
+        self._thread.join()
+        self.flush()
@@ -0,0 +1,38 @@
+import collections
+import envelope_utils
+
+
+class BufferedObject(object):
+    ''' An object waiting in a bulk, kept only as its serialized payload. It is decoded when its bulk is
+        written and encoded back into a queue item by get_item() if it has to be failed or returned to disk
+    '''
+    __slots__ = ('payload', 'serializer_type', 'command', 'envelope_format', 'handle')
+
+    def __init__(self, payload, serializer_type, command, envelope_format, handle):
+        self.payload = payload
+        self.serializer_type = serializer_type
+        self.command = command
+        self.envelope_format = envelope_format
+        # Transport ack handle
+        self.handle = handle
+
+    def get_item(self, application_name):
+        return envelope_utils.dumps((application_name, self.serializer_type, self.command), [self.payload], self.envelope_format)
+
+
+class Bulk(object):
+    ''' Buffered objects of one application, written to Mongo with the latest settings received '''
+    __slots__ = ('settings', 'entries', 'size')
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.entries = collections.deque()
+        # Bytes of the payloads
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entries, size):
+        self.entries.extend(entries)
+        self.size += size
@@ -36,3 +36,35 @@ class Register_NoValidSerializer(Exception):
 
     def __str__(self):
         return repr(self.parameter)
+
+
+class Client_NoValidEnvelopeFormat(Exception):
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+
+class Client_NoValidBufferPolicy(Exception):
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+
+class Client_NoValidTransport(Exception):
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
+
+
+class Client_Closed(Exception):
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
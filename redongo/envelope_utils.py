@@ -0,0 +1,92 @@
+import struct
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+# Compact items: MAGIC, version, header field lengths, payload count, header fields, the length of
+# every payload and the payloads. Pickled items never start with MAGIC
+MAGIC = '\xfe'
+VERSION = 1
+ENVELOPE_FORMATS = ['pickle', 'compact']
+_prefix = struct.Struct('!cBHBBI')
+_length = struct.Struct('!I')
+# Same as _prefix skipping MAGIC
+_unpack_prefix = struct.Struct('!xBHBBI').unpack_from
+_unpack_length = _length.unpack_from
+# Payload count -> unpack_from of the payload lengths
+_unpack_lengths = {}
+
+
+def dumps(header, payloads, envelope_format='pickle'):
+    ''' Builds a queue item for the serialized payloads of one (application_name, serializer_type, command) header.
+        With the pickle format a single payload gives the classic [header, payload] item, several payloads
+        give a frame [header, [payload1, payload2, ...]] that carries all of them in one list element.
+    '''
+    if envelope_format == 'compact':
+        application_name, serializer_type, command = header
+        if type(application_name) is unicode:
+            application_name = application_name.encode('utf-8')
+        if len(payloads) == 1:
+            return ''.join((_prefix.pack(MAGIC, VERSION, len(application_name), len(serializer_type), len(command), 1), application_name, serializer_type, command, _length.pack(len(payloads[0])), payloads[0]))
+        return ''.join((
+            _prefix.pack(MAGIC, VERSION, len(application_name), len(serializer_type), len(command), len(payloads)),
+            application_name,
+            serializer_type,
+            command,
+            struct.pack('!{0}I'.format(len(payloads)), *map(len, payloads)),
+            ''.join(payloads),
+        ))
+    if len(payloads) == 1:
+        return pickle.dumps([header, payloads[0]])
+    return pickle.dumps([header, list(payloads)])
+
+
+def get_format(item):
+    return 'compact' if item[:1] == MAGIC else 'pickle'
+
+
+def _get_unpack_lengths(count):
+    unpack_lengths = _unpack_lengths.get(count)
+    if unpack_lengths is None:
+        unpack_lengths = _unpack_lengths.setdefault(count, struct.Struct('!{0}I'.format(count)).unpack_from)
+    return unpack_lengths
+
+
+def loads(item):
+    ''' Returns (header, payloads) of a queue item in any format, payloads is always a list '''
+    if item[:1] == MAGIC:
+        # Inlined, this is the server hot path
+        try:
+            version, application_name_end, serializer_type_end, command_end, count = _unpack_prefix(item)
+            if version != VERSION:
+                raise ValueError('Envelope version {0} not supported'.format(version))
+            # Field lengths to offsets
+            application_name_end += _prefix.size
+            serializer_type_end += application_name_end
+            command_end += serializer_type_end
+            header = (item[_prefix.size:application_name_end], item[application_name_end:serializer_type_end], item[serializer_type_end:command_end])
+            if count == 1:
+                end = command_end + 4 + _unpack_length(item, command_end)[0]
+                payloads = [item[command_end + 4:end]]
+            else:
+                end = command_end + 4 * count
+                payloads = []
+                append = payloads.append
+                for length in _get_unpack_lengths(count)(item, command_end):
+                    append(item[end:end + length])
+                    end += length
+        except struct.error, e:
+            raise ValueError(str(e))
+        if end != len(item):
+            raise ValueError('Envelope length not valid')
+        return header, payloads
+    obj = pickle.loads(item)
+    if type(obj) != list or len(obj) != 2:
+        raise ValueError('Type not valid')
+    header, payload = obj
+    if len(header) != 3:
+        raise ValueError('Header not valid')
+    if type(payload) is list:
+        return header, payload
+    return header, [payload]
@@ -0,0 +1,97 @@
+import collections
+import threading
+
+
+class FlushExecutor(object):
+    ''' Runs flush_function(application_name, bulk) on a pool of threads.
+        Bulks of different applications are flushed concurrently, bulks of the same application
+        are flushed one at a time and in submission order.
+        When threads are busy, the next bulk is the one of the application with the least cost flushed
+        relative to its weight (stride scheduling), so each application gets a share of the threads
+        proportional to its weight.
+        max_pending bounds the submitted bulks not flushed yet, see wait_for_capacity.
+    '''
+    def __init__(self, flush_function, threads=4, max_pending=None):
+        self.flush_function = flush_function
+        self.max_pending = max_pending or threads * 2
+        self.pending = 0
+        self._keep_going = True
+        self._condition = threading.Condition()
+        # application_name -> deque of submitted (bulk, weight, cost)
+        self._queued = {}
+        # Applications with queued bulks and no bulk being flushed
+        self._ready = collections.deque()
+        # application_name -> cost / weight flushed by the ready applications, on the virtual time scale
+        self._passes = {}
+        self._virtual_time = 0.0
+        self._running = set()
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._work, name='redongo-flush-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, application_name, bulk, weight=1, cost=1):
+        with self._condition:
+            queued = self._queued.setdefault(application_name, collections.deque())
+            queued.append((bulk, max(weight, 1), cost))
+            self.pending += 1
+            if len(queued) == 1 and application_name not in self._running:
+                self._set_ready(application_name)
+                self._condition.notify_all()
+
+    def _set_ready(self, application_name):
+        # Called with the lock held. Applications don't save credit while they have nothing to flush
+        self._passes[application_name] = max(self._passes.get(application_name, 0), self._virtual_time)
+        self._ready.append(application_name)
+
+    def wait_for_capacity(self, timeout=None):
+        ''' Returns True when less than max_pending bulks are waiting to be flushed '''
+        with self._condition:
+            if self.pending >= self.max_pending and self._keep_going:
+                self._condition.wait(timeout)
+            return self.pending < self.max_pending
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready and self._keep_going:
+                    self._condition.wait()
+                if not self._keep_going:
+                    return
+                application_name = min(self._ready, key=self._passes.get)
+                self._ready.remove(application_name)
+                bulk, weight, cost = self._queued[application_name].popleft()
+                self._virtual_time = self._passes[application_name]
+                self._passes[application_name] += float(cost) / weight
+                self._running.add(application_name)
+            try:
+                self.flush_function(application_name, bulk)
+            finally:
+                with self._condition:
+                    self._running.discard(application_name)
+                    self.pending -= 1
+                    if self._queued[application_name]:
+                        self._set_ready(application_name)
+                    else:
+                        self._queued.pop(application_name)
+                        self._passes.pop(application_name)
+                    self._condition.notify_all()
+
+    def shutdown(self):
+        ''' Waits for the flushes in progress and returns the (application_name, bulk) not flushed '''
+        with self._condition:
+            self._keep_going = False
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        with self._condition:
+            not_flushed = []
+            for application_name, queued in self._queued.iteritems():
+                not_flushed.extend((application_name, bulk) for bulk, weight, cost in queued)
+            self._queued.clear()
+            self._ready.clear()
+            self._passes.clear()
+            self.pending = 0
+        return not_flushed
@@ -0,0 +1,127 @@
+import bisect
+import threading
+from twisted.web import resource
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def format_labels(names, values, extra=''):
+    labels = ['{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{{{0}}}'.format(','.join(labels)) if labels else ''
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric(object):
+    ''' Values by label values tuple, updated under a lock so concurrent updates are never lost '''
+    metric_type = 'untyped'
+
+    def __init__(self, name, description, labels=(), function=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # Called on every scrape to get the value of a metric without labels
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_lines(self):
+        if self.function:
+            return ['{0} {1}'.format(self.name, _format_value(self.function()))]
+        with self._lock:
+            values = self._values.items()
+        return ['{0}{1} {2}'.format(self.name, format_labels(self.labels, labels), _format_value(value)) for labels, value in sorted(values)]
+
+    def render(self):
+        return '# HELP {0} {1}\n# TYPE {0} {2}\n{3}'.format(self.name, self.description, self.metric_type, ''.join(line + '\n' for line in self.get_lines()))
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = 'gauge'
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    ''' Values are [count of every bucket, sum, count] '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, buckets, labels=()):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(labels)
+            if values is None:
+                values = self._values[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            values[0][index] += 1
+            values[1] += value
+            values[2] += 1
+
+    def get_lines(self):
+        with self._lock:
+            values = [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.iteritems()]
+        lines = []
+        for labels, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{0}_bucket{1} {2}'.format(self.name, format_labels(self.labels, labels, 'le="{0}"'.format(bound)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(self.name, format_labels(self.labels, labels), _format_value(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, format_labels(self.labels, labels), count))
+        return lines
+
+
+class MetricsRegistry(object):
+    ''' Metrics rendered in the Prometheus text format, rates (like objects per second) are left to
+        the scraper: rate(redongo_objects_total[1m])
+    '''
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=(), function=None):
+        return self.add(Counter(name, description, labels, function))
+
+    def gauge(self, name, description, labels=(), function=None):
+        return self.add(Gauge(name, description, labels, function))
+
+    def histogram(self, name, description, buckets, labels=()):
+        return self.add(Histogram(name, description, buckets, labels))
+
+    def render(self):
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
@@ -0,0 +1,156 @@
+import hashlib
+import threading
+import time
+import pymongo
+from pymongo.errors import BulkWriteError, PyMongoError
+
+try:
+    from bson.errors import InvalidDocument
+except ImportError:
+    from pymongo.objectid import InvalidDocument
+
+
+class MongoClientPool(object):
+    ''' Keeps one MongoClient per Mongo target so consecutive bulks reuse sockets and authentication.
+        Targets are keyed by (host, port, database, user, password hash), the password is only
+        decrypted the first time a given encrypted value is seen.
+        Clients and decrypted passwords not requested for idle_timeout seconds are dropped.
+    '''
+    def __init__(self, cipher, idle_timeout=300, client_factory=pymongo.MongoClient):
+        self.cipher = cipher
+        self.idle_timeout = idle_timeout
+        self.client_factory = client_factory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clients = {}
+        self._passwords = {}
+        self._last_eviction = time.time()
+        self._lock = threading.Lock()
+
+    def _get_password(self, encrypted_password, now):
+        # Called with the lock held. Encrypted value -> [plain password, password hash, last used]
+        password = self._passwords.get(encrypted_password)
+        if password is None:
+            plain_password = self.cipher.decrypt(encrypted_password)
+            password = self._passwords[encrypted_password] = [plain_password, hashlib.sha1(plain_password or '').hexdigest(), now]
+        else:
+            password[2] = now
+        return password
+
+    def get_key(self, settings, password_hash):
+        return (
+            settings['mongo_host'],
+            settings['mongo_port'],
+            settings['mongo_database'],
+            settings['mongo_user'],
+            password_hash,
+        )
+
+    def get_client(self, settings):
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            plain_password, password_hash, last_used = self._get_password(settings['mongo_password'], now)
+            key = self.get_key(settings, password_hash)
+            entry = self._clients.get(key)
+            if entry:
+                entry[1] = now
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # Connecting can be slow, don't keep other flushes waiting for it
+        client = self.client_factory('mongodb://{0}:{1}@{2}:{3}/{4}'.format(settings['mongo_user'], plain_password, settings['mongo_host'], settings['mongo_port'], settings['mongo_database']))
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry:
+                # Another flush created the same client meanwhile
+                entry[1] = now
+                duplicated_client, client = client, entry[0]
+            else:
+                self._clients[key] = [client, now]
+                duplicated_client = None
+        if duplicated_client:
+            duplicated_client.close()
+        return client
+
+    def get_collection(self, settings):
+        return self.get_client(settings)[settings['mongo_database']][settings['mongo_collection']]
+
+    def _evict_idle(self, now):
+        # Called with the lock held, runs at most once per second
+        if now - self._last_eviction < 1:
+            return
+        self._last_eviction = now
+        for key, (client, last_used) in self._clients.items():
+            if now - last_used > self.idle_timeout:
+                self._clients.pop(key)
+                client.close()
+                self.evictions += 1
+        for encrypted_password, (plain_password, password_hash, last_used) in self._passwords.items():
+            if now - last_used > self.idle_timeout:
+                self._passwords.pop(encrypted_password)
+
+    def stats(self):
+        return {
+            'clients': len(self._clients),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            for client, last_used in self._clients.values():
+                client.close()
+            self._clients.clear()
+            self._passwords.clear()
+
+
+def get_id_key(_id):
+    # _id values can be dicts or lists, which are not hashable
+    try:
+        hash(_id)
+        return _id
+    except TypeError:
+        return repr(_id)
+
+
+def bulk_upsert(collection, operations, replace=False):
+    ''' Sends operations, a list of (_id, document, entries), to Mongo as one unordered bulk of upserts.
+        document is an update query, or the whole object to store when replace is True.
+        entries are the buffered objects each operation writes.
+        Returns the entries of the operations that could not be written.
+    '''
+    if not operations:
+        return []
+    bulk = collection.initialize_unordered_bulk_op()
+    for _id, document, entries in operations:
+        if replace:
+            bulk.find({'_id': _id}).upsert().replace_one(document)
+        else:
+            bulk.find({'_id': _id}).upsert().update_one(document)
+    try:
+        bulk.execute()
+    except BulkWriteError, e:
+        failed = []
+        for error in e.details.get('writeErrors', []):
+            failed.extend(operations[error['index']][2])
+        return failed
+    except InvalidDocument:
+        # An encoding error aborts the whole bulk, only the bad documents have to fail
+        failed = []
+        for _id, document, entries in operations:
+            try:
+                collection.update({'_id': _id}, document, upsert=True)
+            except (PyMongoError, InvalidDocument):
+                failed.extend(entries)
+        return failed
+    except PyMongoError:
+        failed = []
+        for _id, document, entries in operations:
+            failed.extend(entries)
+        return failed
+    return []
@@ -0,0 +1,162 @@
+import collections
+import os
+import sys
+import threading
+import time
+import metrics_utils
+
+PERCENTILES = (50, 90, 99)
+
+
+class StageClock(object):
+    ''' Adds up the time spent in every stage while processing a batch '''
+    __slots__ = ('totals', 'last')
+
+    def __init__(self):
+        self.totals = collections.defaultdict(float)
+        self.last = time.time()
+
+    def start(self):
+        self.last = time.time()
+
+    def lap(self, stage):
+        now = time.time()
+        self.totals[stage] += now - self.last
+        self.last = now
+
+
+class StageTimers(object):
+    ''' Keeps the last window durations of every stage to get rolling percentiles.
+        When not enabled clock() returns None, callers only pay a truth test per stage:
+            clock = stage_timers.clock()
+            ...
+            if clock:
+                clock.lap('stage')
+    '''
+    def __init__(self, enabled=False, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def clock(self):
+        if self.enabled:
+            return StageClock()
+
+    def add(self, stage, seconds):
+        samples = self._samples.get(stage)
+        if samples is None:
+            with self._lock:
+                samples = self._samples.setdefault(stage, collections.deque(maxlen=self.window))
+        samples.append(seconds)
+
+    def add_clock(self, clock):
+        for stage, seconds in clock.totals.iteritems():
+            self.add(stage, seconds)
+
+    def stats(self):
+        ''' stage -> {'count': samples, 'max': seconds, 'p50': seconds, ...} '''
+        stats = {}
+        for stage, samples in self._samples.items():
+            samples = sorted(samples)
+            if not samples:
+                continue
+            stage_stats = stats[stage] = {'count': len(samples), 'max': samples[-1]}
+            for percentile in PERCENTILES:
+                stage_stats['p{0}'.format(percentile)] = samples[min(len(samples) * percentile / 100, len(samples) - 1)]
+        return stats
+
+    def report(self):
+        lines = []
+        for stage, stage_stats in sorted(self.stats().iteritems()):
+            lines.append('{0}: {1}'.format(stage, ' '.join('{0}={1:.6f}'.format(name, stage_stats[name]) for name in ['p{0}'.format(p) for p in PERCENTILES] + ['max'])))
+        return lines
+
+
+class StageSummary(metrics_utils.Metric):
+    ''' Rolling percentiles of StageTimers as a Prometheus summary '''
+    metric_type = 'summary'
+
+    def __init__(self, name, description, stage_timers):
+        metrics_utils.Metric.__init__(self, name, description, labels=('stage',))
+        self.stage_timers = stage_timers
+
+    def get_lines(self):
+        lines = []
+        for stage, stage_stats in sorted(self.stage_timers.stats().iteritems()):
+            for percentile in PERCENTILES:
+                lines.append('{0}{1} {2!r}'.format(self.name, metrics_utils.format_labels(('stage', 'quantile'), (stage, percentile / 100.0)), stage_stats['p{0}'.format(percentile)]))
+            lines.append('{0}_count{1} {2}'.format(self.name, metrics_utils.format_labels(('stage',), (stage,)), stage_stats['count']))
+        return lines
+
+
+class SamplingProfiler(object):
+    ''' Samples the stacks of all the threads every interval seconds for duration seconds, then writes
+        the functions seen most often and the folded stacks (for flame graph tools) to a file in
+        output_directory. The process keeps running, start() does nothing while sampling.
+        Intended to be started by a signal: signal.signal(signal.SIGUSR1, profiler.handle_signal)
+        report() returns extra lines for the file
+    '''
+    def __init__(self, output_directory='.', duration=10, interval=0.005, report=None):
+        self.output_directory = output_directory
+        self.duration = duration
+        self.interval = interval
+        self.report = report
+        self.last_file = None
+        self._thread = None
+
+    def handle_signal(self, signum, frame):
+        self.start()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return False
+        self._thread = threading.Thread(target=self._run, name='redongo-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def _run(self):
+        own_thread = threading.current_thread().ident
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        stacks = collections.Counter()
+        samples = 0
+        end = time.time() + self.duration
+        while time.time() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append('{0}:{1}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stacks[tuple(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        self.last_file = self.write(stacks, samples)
+
+    def write(self, stacks, samples):
+        own = collections.Counter()
+        total = collections.Counter()
+        for stack, count in stacks.iteritems():
+            own[stack[-1]] += count
+            for function in set(stack[1:]):
+                total[function] += count
+        path = os.path.join(self.output_directory, 'redongo-profile-{0}-{1}.txt'.format(os.getpid(), time.strftime('%Y%m%d%H%M%S')))
+        with open(path, 'w') as f:
+            f.write('# {0} samples every {1}s for {2}s\n'.format(samples, self.interval, self.duration))
+            if self.report:
+                f.write('\n# Stage timers\n')
+                for line in self.report():
+                    f.write(line + '\n')
+            f.write('\n# Own samples\n')
+            for function, count in own.most_common(50):
+                f.write('{0} {1}\n'.format(count, function))
+            f.write('\n# Total samples\n')
+            for function, count in total.most_common(50):
+                f.write('{0} {1}\n'.format(count, function))
+            f.write('\n# Folded stacks\n')
+            for stack, count in stacks.most_common():
+                f.write('{0} {1}\n'.format(';'.join(stack), count))
+        return path
@@ -1,5 +1,251 @@
+import errno
+import glob
+import io
+import json
+import os
+import struct
+import threading
+import time
 from queuelib.queue import FifoDiskQueue
 
+_record_header = struct.Struct('!I')
+
+
+class SegmentLog(object):
+    ''' Append-only FIFO of strings stored in the directory path.
+        Records (4 bytes length + data) are appended to segment files of about segment_size bytes,
+        push_many() writes all its records with one write and one fsync.
+        The read position, the write position and the number of records are kept in the meta file,
+        so opening doesn't read the records, only the ones written after the last metadata update.
+        The meta file is written at most every meta_interval seconds, and whenever segments are added,
+        removed or truncated. After a crash the records popped since the last write are popped again.
+        Files are opened on first use and kept open, segments are deleted once fully read and the
+        last one is truncated when everything has been read.
+        A directory with a queuelib FifoDiskQueue is migrated on open.
+    '''
+    def __init__(self, path, segment_size=64 * 1024 * 1024, fsync=True, read_size=256 * 1024, meta_interval=1):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.read_size = read_size
+        self.meta_interval = meta_interval
+        self._meta_saved = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._segments = sorted(int(os.path.basename(name)[8:]) for name in glob.glob(os.path.join(path, 'segment-*')))
+        self._reader = None
+        # Read but not parsed data of the head segment
+        self._read_buffer = ''
+        self._read_position = 0
+        self._writer = None
+        meta = self._load_meta()
+        if meta and meta['head'][0] in self._segments and meta['tail'][0] in self._segments:
+            self._head_segment, self._head_offset = meta['head']
+            self._length = meta['length']
+            # Records written after the last metadata update, usually none
+            self._length += self._count_records(*meta['tail'])
+        else:
+            self._head_segment, self._head_offset = 0, 0
+            self._length = None
+        # Segments before the head were read already
+        while self._segments and self._segments[0] < self._head_segment:
+            self._remove_segment(self._segments.pop(0))
+        if not self._segments:
+            self._segments = [self._head_segment]
+            self._head_offset = 0
+        elif self._segments[0] != self._head_segment:
+            self._head_segment, self._head_offset = self._segments[0], 0
+        if self._length is None:
+            self._length = self._count_records(self._head_segment, self._head_offset)
+        self._tail_size = self._get_size(self._segments[-1])
+        if os.path.exists(os.path.join(path, 'info.json')):
+            self._migrate()
+
+    def __len__(self):
+        return self._length
+
+    def _get_segment_path(self, number):
+        return os.path.join(self.path, 'segment-{0:010d}'.format(number))
+
+    def _get_size(self, number):
+        try:
+            return os.path.getsize(self._get_segment_path(number))
+        except OSError:
+            return 0
+
+    def _remove_segment(self, number):
+        try:
+            os.remove(self._get_segment_path(number))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _load_meta(self):
+        try:
+            with open(os.path.join(self.path, 'meta')) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _save_meta(self, force=False):
+        # Not synced: after a crash the records read since the last sync are read again
+        now = time.time()
+        if not force and now - self._meta_saved < self.meta_interval:
+            return
+        self._meta_saved = now
+        meta_path = os.path.join(self.path, 'meta')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({
+                'head': [self._head_segment, self._head_offset],
+                'tail': [self._segments[-1], self._tail_size],
+                'length': self._length,
+            }, f)
+        os.rename(meta_path + '.tmp', meta_path)
+
+    def _count_records(self, first_segment, offset):
+        ''' Counts the records from offset of first_segment to the end of the log '''
+        length = 0
+        for number in self._segments:
+            if number < first_segment:
+                continue
+            if number > first_segment:
+                offset = 0
+            size = self._get_size(number)
+            if offset >= size:
+                continue
+            with io.open(self._get_segment_path(number), 'rb') as f:
+                f.seek(offset)
+                while offset < size:
+                    header = f.read(_record_header.size)
+                    if len(header) < _record_header.size:
+                        break
+                    end = offset + _record_header.size + _record_header.unpack(header)[0]
+                    if end > size:
+                        break
+                    offset = end
+                    f.seek(offset)
+                    length += 1
+            if offset < size:
+                # A record partially written before a crash, only possible at the end of the last segment
+                with open(self._get_segment_path(number), 'r+b') as f:
+                    f.truncate(offset)
+        return length
+
+    def _sync(self):
+        self._writer.flush()
+        if self.fsync:
+            os.fsync(self._writer.fileno())
+
+    def push_many(self, objs):
+        if not objs:
+            return
+        if self._writer is None:
+            self._writer = open(self._get_segment_path(self._segments[-1]), 'ab')
+        data = ''.join(_record_header.pack(len(obj)) + obj for obj in objs)
+        self._writer.write(data)
+        self._sync()
+        self._length += len(objs)
+        self._tail_size += len(data)
+        if self._tail_size >= self.segment_size:
+            self._writer.close()
+            self._segments.append(self._segments[-1] + 1)
+            self._writer = open(self._get_segment_path(self._segments[-1]), 'ab')
+            self._tail_size = 0
+            self._save_meta(force=True)
+        else:
+            self._save_meta()
+
+    def _read(self, size):
+        # Reads more data of the head segment, returns False at its end
+        if self._reader is None:
+            self._reader = io.open(self._get_segment_path(self._head_segment), 'rb', buffering=0)
+            self._reader.seek(self._head_offset)
+        data = self._reader.read(max(size, self.read_size))
+        if not data:
+            return False
+        self._read_buffer = self._read_buffer[self._read_position:] + data
+        self._read_position = 0
+        return True
+
+    def pop_many(self, count):
+        objs = []
+        segments = len(self._segments)
+        while len(objs) < count and self._length:
+            position = self._read_position
+            available = len(self._read_buffer) - position
+            if available >= _record_header.size:
+                size = _record_header.unpack_from(self._read_buffer, position)[0]
+                if available >= _record_header.size + size:
+                    position += _record_header.size
+                    objs.append(self._read_buffer[position:position + size])
+                    self._read_position = position + size
+                    self._head_offset += _record_header.size + size
+                    self._length -= 1
+                    continue
+                if self._read(_record_header.size + size):
+                    continue
+            elif self._read(_record_header.size):
+                continue
+            self._read_buffer = ''
+            self._read_position = 0
+            if self._head_segment == self._segments[-1]:
+                # Records lost, the segment was modified by someone else
+                self._length = 0
+                break
+            # Segment fully read
+            self._reader.close()
+            self._reader = None
+            self._remove_segment(self._segments.pop(0))
+            self._head_segment, self._head_offset = self._segments[0], 0
+        if not self._length and (self._head_offset or len(self._segments) > 1):
+            self._truncate()
+            self._save_meta(force=True)
+        elif len(self._segments) != segments:
+            self._save_meta(force=True)
+        elif objs:
+            self._save_meta()
+        return objs
+
+    def _truncate(self):
+        # Everything was read, the last segment starts over keeping the files open
+        if self._head_segment != self._segments[-1] and self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        for number in self._segments[:-1]:
+            self._remove_segment(number)
+        self._segments = self._segments[-1:]
+        if self._writer is None:
+            with open(self._get_segment_path(self._segments[-1]), 'ab') as f:
+                f.truncate(0)
+        else:
+            self._writer.truncate(0)
+        if self._reader is not None:
+            self._reader.seek(0)
+        self._read_buffer = ''
+        self._read_position = 0
+        self._head_segment, self._head_offset = self._segments[-1], 0
+        self._tail_size = 0
+
+    def _migrate(self):
+        legacy_queue = FifoDiskQueue(self.path)
+        while len(legacy_queue):
+            objs = []
+            while len(legacy_queue) and len(objs) < 10000:
+                objs.append(legacy_queue.pop())
+            self.push_many(objs)
+        # Removes its files, the queue is empty
+        legacy_queue.close()
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._writer is not None:
+            self._sync()
+            self._writer.close()
+            self._writer = None
+        self._save_meta(force=True)
+
 
 class Queue(object):
 
@@ -12,48 +258,37 @@ class Queue(object):
     def __init__(self, queue_name, size=0):
         self._size_queue = size
         self._disk_queue_name = queue_name
-        self._disk_queue = FifoDiskQueue(queue_name)
+        self._disk_queue = SegmentLog(queue_name)
         self._is_open = True
+        # Pushed and popped from different threads
+        self._lock = threading.Lock()
 
-        if self._disk_queue.__len__() > 0:
-            self._length = self._disk_queue.__len__()
-            self._empty_disk = False
-            self._is_open_dq = True
-        else:
-            self._length = 0
-            self._empty_disk = True
-            self._disk_queue.close()
-            self._is_open_dq = False
+    @property
+    def _length(self):
+        return len(self._disk_queue)
 
     def push(self, obj):
-        if not self._is_open:
-            raise self.PushInClosedQueue()
-        else:
-            if not self._is_open_dq:
-                self._disk_queue = FifoDiskQueue(self._disk_queue_name)
-                self._is_open_dq = True
+        self.push_many([obj])
 
-            self._disk_queue.push(obj)
-            self._empty_disk = False
-
-            self._length += 1
+    def push_many(self, objs):
+        with self._lock:
+            if not self._is_open:
+                raise self.PushInClosedQueue()
+            self._disk_queue.push_many(objs)
 
     def pop(self):
-        if not self._is_open:
-            raise self.PopInClosedQueue()
-        else:
-            if self._is_open and (self._length > 0):
-                self._length -= 1
-                obj = self._disk_queue.pop()
-
-                if self._disk_queue.__len__() == 0:
-                    self._disk_queue.close()
-                    self._is_open_dq = False
-                    self._empty_disk = True
+        objs = self.pop_many(1)
+        if objs:
+            return objs[0]
 
-                return obj
+    def pop_many(self, count):
+        with self._lock:
+            if not self._is_open:
+                raise self.PopInClosedQueue()
+            return self._disk_queue.pop_many(count)
 
     def close(self):
-        if self._is_open_dq:
-            self._disk_queue.close()
-        self._is_open = False
+        with self._lock:
+            if self._is_open:
+                self._disk_queue.close()
+            self._is_open = False
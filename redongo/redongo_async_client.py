@@ -0,0 +1,170 @@
+import Queue
+try:
+    import cPickle as pickle
+except:
+    import pickle
+import client_exceptions
+import threading
+import time
+from redongo_client import RedongoClient
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+class AsyncRedongoClient(RedongoClient):
+    ''' RedongoClient for Twisted applications: every method returns a Deferred instead of blocking
+        the reactor on Redis. Redis is only used from a writer thread, which sends all the orders
+        waiting at a time (up to max_pipeline) in one pipeline. Queue items are built by the same
+        code as RedongoClient, so servers can't tell them apart.
+        Objects are serialized on the calling thread, so they can be modified once the call returns.
+        Application settings read from Redis are cached for settings_ttl seconds.
+    '''
+    def __init__(self, redis_host, redis_db, redis_queue, redis_port=6379, frame_size=1, envelope_format='pickle', max_pipeline=100, transport='list', settings_ttl=60):
+        RedongoClient.__init__(self, redis_host, redis_db, redis_queue, redis_port=redis_port, frame_size=frame_size, envelope_format=envelope_format, transport=transport)
+        self.max_pipeline = max_pipeline
+        self.settings_ttl = settings_ttl
+        # application_name -> (settings, expiration), written by the writer thread
+        self._order_settings = {}
+        # Settings calls not run yet, orders can't use the cached settings meanwhile
+        self._pending_calls = 0
+        self._closed = False
+        # Nothing is queued after a close request
+        self._lock = threading.Lock()
+        self._requests = Queue.Queue()
+        self._writer = threading.Thread(target=self._write, name='redongo-async-client')
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _fire(self, d, result):
+        if isinstance(result, failure.Failure):
+            reactor.callFromThread(d.errback, result)
+        else:
+            reactor.callFromThread(d.callback, result)
+
+    def _put(self, kind, arguments):
+        with self._lock:
+            if self._closed:
+                return defer.fail(client_exceptions.Client_Closed('Client closed'))
+            if kind == 'call':
+                self._pending_calls += 1
+            elif kind == 'close':
+                self._closed = True
+            d = defer.Deferred()
+            self._requests.put((kind, d, arguments))
+        return d
+
+    def _call(self, function, *args, **kwargs):
+        return self._put('call', (function, args, kwargs))
+
+    def set_application_settings(self, application_name, *args, **kwargs):
+        self._order_settings.pop(application_name, None)
+        return self._call(RedongoClient.set_application_settings, self, application_name, *args, **kwargs)
+
+    def get_application_settings(self, application_name):
+        return self._call(RedongoClient.get_application_settings, self, application_name)
+
+    def remove_application_settings(self, application_name):
+        self._order_settings.pop(application_name, None)
+        return self._call(RedongoClient.remove_application_settings, self, application_name)
+
+    def get_cached_order_settings(self, application_name):
+        ''' Settings set by this client or cached, None when they have to be read from Redis '''
+        if application_name in self.app_data:
+            return self.app_data[application_name]
+        entry = self._order_settings.get(application_name)
+        if entry and entry[1] > time.time():
+            return entry[0]
+
+    def read_order_settings(self, application_name):
+        # Writer thread
+        application_config = self.get_cached_order_settings(application_name)
+        if application_config is None:
+            application_config = self.get_order_settings(application_name)
+            self._order_settings[application_name] = (application_config, time.time() + self.settings_ttl)
+        return application_config
+
+    def order_to_server(self, application_name, objects_to_deal, command):
+        try:
+            final_objects_to_deal = self.serialize_objects(objects_to_deal)
+            application_config = None if self._pending_calls else self.get_cached_order_settings(application_name)
+            if application_config is None:
+                # The serializer is not known yet, the writer serializes a copy of the objects
+                return self._put('copy', (application_name, pickle.dumps(final_objects_to_deal, pickle.HIGHEST_PROTOCOL), command))
+            items = self.get_queue_items(application_name, application_config, final_objects_to_deal, command)
+            return self._put('order', (self.get_queue(application_name, application_config), items))
+        except Exception:
+            return defer.fail()
+
+    def save_to_mongo(self, application_name, objects_to_save):
+        return self.order_to_server(application_name, objects_to_save, 'save')
+
+    def add_in_mongo(self, application_name, objects_to_update):
+        return self.order_to_server(application_name, objects_to_update, 'add')
+
+    def close(self):
+        ''' Returns a Deferred fired once every previous call has been sent, later calls fail with Client_Closed '''
+        return self._put('close', None)
+
+    def _write(self):
+        while True:
+            requests = [self._requests.get()]
+            while len(requests) < self.max_pipeline:
+                try:
+                    requests.append(self._requests.get_nowait())
+                except Queue.Empty:
+                    break
+
+            orders = []
+            for kind, d, arguments in requests:
+                if kind == 'call':
+                    # Keep the orders received before the call in front of it
+                    self._send(orders)
+                    orders = []
+                    function, args, kwargs = arguments
+                    try:
+                        self._fire(d, function(*args, **kwargs))
+                    except Exception:
+                        self._fire(d, failure.Failure())
+                    with self._lock:
+                        self._pending_calls -= 1
+                elif kind == 'order':
+                    queue, items = arguments
+                    orders.append((d, queue, items))
+                elif kind == 'copy':
+                    application_name, objects, command = arguments
+                    try:
+                        application_config = self.read_order_settings(application_name)
+                        items = self.get_queue_items(application_name, application_config, pickle.loads(objects), command)
+                        queue = self.get_queue(application_name, application_config)
+                    except Exception:
+                        self._fire(d, failure.Failure())
+                    else:
+                        orders.append((d, queue, items))
+                else:
+                    self._send(orders)
+                    orders = []
+                    self._fire(d, None)
+                    return
+
+            self._send(orders)
+
+    def _send(self, orders):
+        pipe = self.redis.pipeline(transaction=False)
+        # (Deferred, number of commands)
+        to_send = []
+        for d, queue, items in orders:
+            if items:
+                to_send.append((d, self.add_push_commands(pipe, queue, items)))
+            else:
+                self._fire(d, None)
+        if not to_send:
+            return
+        try:
+            results = pipe.execute(raise_on_error=False)
+        except Exception, e:
+            results = [e] * sum(commands for d, commands in to_send)
+        offset = 0
+        for d, commands in to_send:
+            errors = [result for result in results[offset:offset + commands] if isinstance(result, Exception)]
+            offset += commands
+            self._fire(d, failure.Failure(errors[0]) if errors else None)
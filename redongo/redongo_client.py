@@ -1,7 +1,10 @@
 import os
 import utils
+import buffer_utils
 import cipher_utils
+import envelope_utils
 import serializer_utils
+import transport_utils
 import client_exceptions
 import general_exceptions
 import stoneredis
@@ -19,11 +22,43 @@ try:
     import cPickle as pickle
 except:
     import pickle
-import copy
+
+
+class SerializationPlan(object):
+    ''' What serialize_object needs to know about a class, worked out once per class '''
+    __slots__ = ('is_django', 'columns', 'objectid_fields', 'pk_name')
+
+    def __init__(self, obj_class):
+        self.is_django = False
+        base_class = obj_class
+        while base_class.__bases__:
+            base_class = base_class.__bases__[0]
+            if base_class.__module__ == 'django.db.models.base' and base_class.__name__ == 'Model':
+                self.is_django = True
+                break
+        self.columns = ()
+        self.objectid_fields = ()
+        self.pk_name = None
+        if self.is_django:
+            self.columns = tuple(field.column for field in obj_class._meta.fields)
+            self.objectid_fields = tuple(field.column for field in obj_class._meta.fields if getattr(field, 'to_fields', None))
+            if obj_class._meta.pk:
+                self.pk_name = obj_class._meta.pk.name
+
+
+# Class -> SerializationPlan
+serialization_plans = {}
 
 
 class RedongoClient():
-    def __init__(self, redis_host, redis_db, redis_queue, redis_port=6379):
+    def __init__(self, redis_host, redis_db, redis_queue, redis_port=6379, frame_size=1, envelope_format='pickle', buffer_size=0, buffer_max_age=1, buffer_max_items=None, buffer_full_policy='block', transport='list'):
+        ''' frame_size > 1 packs up to frame_size objects of the same call into each queue item
+            envelope_format='compact' sends items in the binary format of envelope_utils instead of pickle,
+            the server reads both
+            buffer_size > 0 buffers queue items and sends them from a background thread, see buffer_utils.ItemBuffer
+            transport='stream' adds items as entries of a Redis stream instead of a list, servers must use
+            the same transport
+        '''
         self.serializer_types = ['json', 'ujson', 'pickle']
         self.redis = stoneredis.StoneRedis(redis_host, db=redis_db, port=redis_port, socket_connect_timeout=5, socket_timeout=5)
         self.redis.connect()
@@ -32,9 +67,30 @@ class RedongoClient():
         else:
             raise client_exceptions.Client_NoQueueParameter('Not valid queue received: {0}'.format(redis_queue))
 
+        self.set_order_options(frame_size, envelope_format, buffer_size, buffer_max_age, buffer_max_items, buffer_full_policy, transport)
         self.app_data = {}
 
-    def set_application_settings(self, application_name, mongo_host, mongo_port, mongo_database, mongo_collection, mongo_user, mongo_password, bulk_size=100, bulk_expiration=60, serializer_type='pickle'):
+    def set_order_options(self, frame_size, envelope_format, buffer_size, buffer_max_age, buffer_max_items, buffer_full_policy, transport='list'):
+        self.frame_size = max(int(frame_size), 1)
+        if transport not in transport_utils.TRANSPORTS:
+            raise client_exceptions.Client_NoValidTransport('Not valid transport received: {0}'.format(transport))
+        self.transport = transport
+        if envelope_format not in envelope_utils.ENVELOPE_FORMATS:
+            raise client_exceptions.Client_NoValidEnvelopeFormat('Not valid envelope format received: {0}'.format(envelope_format))
+        self.envelope_format = envelope_format
+        if buffer_full_policy not in buffer_utils.BUFFER_FULL_POLICIES:
+            raise client_exceptions.Client_NoValidBufferPolicy('Not valid buffer full policy received: {0}'.format(buffer_full_policy))
+        if buffer_size:
+            self.buffer = buffer_utils.ItemBuffer(self.push_items, flush_size=buffer_size, max_age=buffer_max_age, max_items=buffer_max_items, full_policy=buffer_full_policy)
+        else:
+            self.buffer = None
+
+    def set_application_settings(self, application_name, mongo_host, mongo_port, mongo_database, mongo_collection, mongo_user, mongo_password, bulk_size=100, bulk_expiration=60, serializer_type='pickle', max_buffered_bytes=0, weight=0):
+        ''' max_buffered_bytes > 0 limits the payload bytes of the application buffered by each server,
+            instead of the server --appbufferedbytes option.
+            weight > 0 sends the objects of the application to its own queue, which the servers pop in turns
+            with the shared queue and the other weighted applications, in proportion to their weights
+        '''
 
         def __get_sk__():
             result = self.redis.get('redongo_sk')
@@ -66,11 +122,18 @@ class RedongoClient():
         for key, value in app_data.iteritems():
             if not value:
                 raise client_exceptions.Register_NoAttributeReceived('Can\'t set application {1} settings: No value set for {0}'.format(key, application_name))
+        if max_buffered_bytes:
+            app_data['max_buffered_bytes'] = int(max_buffered_bytes)
+        if weight:
+            app_data['weight'] = int(weight)
 
         # APP_DATA OK!
         self.app_data[application_name] = app_data
 
-        self.redis.set('redongo_{0}'.format(application_name), pickle.dumps(self.app_data[application_name]))
+        pipe = self.redis.pipeline()
+        pipe.set('redongo_{0}'.format(application_name), pickle.dumps(self.app_data[application_name]))
+        pipe.incr(utils.SETTINGS_VERSION_KEY)
+        pipe.execute()
 
     def get_application_settings(self, application_name):
         if application_name in self.app_data:
@@ -84,40 +147,37 @@ class RedongoClient():
 
         if application_name in self.app_data:
             self.app_data.pop(application_name)
-        self.redis.delete('redongo_{0}'.format(application_name))
+        pipe = self.redis.pipeline()
+        pipe.delete('redongo_{0}'.format(application_name))
+        pipe.incr(utils.SETTINGS_VERSION_KEY)
+        pipe.execute()
+
+    def get_serialization_plan(self, obj_class):
+        plan = serialization_plans.get(obj_class)
+        if plan is None:
+            plan = SerializationPlan(obj_class)
+            serialization_plans[obj_class] = plan
+        return plan
 
     def serialize_django_object(self, obj):
-        copied_obj = copy.deepcopy(obj)
-        fields = set()
-        objectid_fields = []
-        excluded_fields = set(['_id'])
-        if not getattr(copied_obj, '_id', None) and getattr(copied_obj, 'pk', None):
-            pk_name = copied_obj._meta.pk.name
-            copied_obj._id = getattr(copied_obj, pk_name)
-            delattr(copied_obj, pk_name)
-        for field in copied_obj._meta.fields:
-            if getattr(field, 'to_fields', None):
-                objectid_fields.append(field.column)
-            fields.add(field.column)
-        fields_to_delete = set()
-        for attr, value in copied_obj.__dict__.iteritems():
-            if attr not in fields:
-                fields_to_delete.add(attr)
-        for ftd in fields_to_delete-excluded_fields:
-            copied_obj.__delattr__(ftd)
-        obj_serialized = copied_obj.__dict__
-        obj_serialized['objectid_fields'] = objectid_fields
-        return copied_obj.__dict__
+        # Only the model fields are kept and the pk becomes _id, the object itself is not modified
+        plan = self.get_serialization_plan(type(obj))
+        obj_dict = obj.__dict__
+        obj_serialized = {}
+        pk_name = None
+        if not getattr(obj, '_id', None) and getattr(obj, 'pk', None):
+            pk_name = plan.pk_name
+            obj_serialized['_id'] = getattr(obj, pk_name)
+        elif '_id' in obj_dict:
+            obj_serialized['_id'] = obj_dict['_id']
+        for column in plan.columns:
+            if column in obj_dict and column != pk_name:
+                obj_serialized[column] = obj_dict[column]
+        obj_serialized['objectid_fields'] = list(plan.objectid_fields)
+        return obj_serialized
 
     def is_django_object(self, obj):
-        obj_class = type(obj)
-        django_object = False
-        while obj_class.__bases__:
-            obj_class = obj_class.__bases__[0]
-            if obj_class.__module__ == 'django.db.models.base' and obj_class.__name__ == 'Model':
-                django_object = True
-                break
-        return django_object
+        return self.get_serialization_plan(type(obj)).is_django
 
     def serialize_object_by_type(self, obj):
         obj_serialized = None
@@ -151,20 +211,72 @@ class RedongoClient():
                 obj['_id'] = str(obj['_id'])
         return obj
 
-    def order_to_server(self, application_name, objects_to_deal, command):
-        application_config = {}
+    def get_order_settings(self, application_name):
         if not ((application_name in self.app_data) or self.redis.exists('redongo_{0}'.format(application_name))):
             raise client_exceptions.Save_InexistentAppSettings('Application settings for app {0} does not exist'.format(application_name))
-        application_config = self.get_application_settings(application_name)
+        if application_name in self.app_data:
+            return self.app_data[application_name]
+        return utils.get_application_settings(application_name, self.redis)
+
+    def serialize_objects(self, objects_to_deal):
         if not hasattr(objects_to_deal, '__iter__') or type(objects_to_deal) == dict:
             objects_to_deal = [objects_to_deal]
         final_objects_to_deal = []
         for obj in objects_to_deal:
             obj = self.serialize_object(obj)
             final_objects_to_deal.append(obj)
+        return final_objects_to_deal
+
+    def get_queue_items(self, application_name, application_config, final_objects_to_deal, command):
+        ser = serializer_utils.serializer(application_config['serializer_type'])
+        header = (application_name, application_config['serializer_type'], command)
+        payloads = map(ser.dumps, final_objects_to_deal)
+        return [envelope_utils.dumps(header, payloads[i:i + self.frame_size], self.envelope_format) for i in xrange(0, len(payloads), self.frame_size)]
+
+    def get_queue(self, application_name, application_config):
+        if application_config.get('weight'):
+            return transport_utils.get_application_queue(self.redis_queue, application_name)
+        return self.redis_queue
+
+    def order_to_server(self, application_name, objects_to_deal, command):
+        application_config = self.get_order_settings(application_name)
+        final_objects_to_deal = self.serialize_objects(objects_to_deal)
         if final_objects_to_deal:
-            ser = serializer_utils.serializer(application_config['serializer_type'])
-            self.redis.rpush(self.redis_queue, *map(lambda x: pickle.dumps([(application_name, application_config['serializer_type'], command), ser.dumps(x)]), final_objects_to_deal))
+            items = self.get_queue_items(application_name, application_config, final_objects_to_deal, command)
+            queue = self.get_queue(application_name, application_config)
+            if self.buffer:
+                self.buffer.add(queue, items)
+            else:
+                self.push_items(queue, items)
+
+    def push_items(self, queue, items):
+        if self.transport == 'list' and queue == self.redis_queue:
+            self.redis.rpush(queue, *items)
+        else:
+            pipe = self.redis.pipeline(transaction=False)
+            self.add_push_commands(pipe, queue, items)
+            pipe.execute()
+
+    def add_push_commands(self, pipe, queue, items):
+        ''' Adds to the pipeline pipe the commands sending items to queue, registering application queues
+            for the servers. Returns how many were added
+        '''
+        commands = transport_utils.add_push_commands(pipe, self.transport, queue, items)
+        if queue != self.redis_queue:
+            pipe.sadd(transport_utils.get_application_queues_key(self.redis_queue), queue)
+            commands += 1
+        return commands
+
+    def flush(self):
+        ''' Sends the buffered queue items '''
+        if self.buffer:
+            self.buffer.flush()
+
+    def close(self):
+        ''' Sends the buffered queue items and stops buffering '''
+        if self.buffer:
+            self.buffer.close()
+            self.buffer = None
 
     def save_to_mongo(self, application_name, objects_to_save):
         self.order_to_server(application_name, objects_to_save, 'save')
@@ -175,7 +287,7 @@ class RedongoClient():
 
 class RedongoSentinelClient(RedongoClient):
     ''' Just like the regular Redongo but accepts a redis connection instead of connection parameters '''
-    def __init__(self, redis_conn, redis_queue):
+    def __init__(self, redis_conn, redis_queue, frame_size=1, envelope_format='pickle', buffer_size=0, buffer_max_age=1, buffer_max_items=None, buffer_full_policy='block', transport='list'):
         self.serializer_types = ['json', 'ujson', 'pickle']
         self.redis = redis_conn
         if redis_queue:
@@ -183,4 +295,5 @@ class RedongoSentinelClient(RedongoClient):
         else:
             raise client_exceptions.Client_NoQueueParameter('Not valid queue received: {0}'.format(redis_queue))
 
+        self.set_order_options(frame_size, envelope_format, buffer_size, buffer_max_age, buffer_max_items, buffer_full_policy, transport)
         self.app_data = {}
@@ -1,26 +1,38 @@
-import datetime
+import collections
+import itertools
 import logging
 import logging.handlers
 import os
-import pymongo
 import redis
 from redis.sentinel import Sentinel
-import server_exceptions
 import general_exceptions
 import signal
+import socket
 import stoneredis
 import sys
+import threading
 import time
 import traceback
+import urllib
 import utils
+import bulk_utils
 import cipher_utils
+import envelope_utils
+import flush_utils
+import metrics_utils
+import mongo_utils
+import profiling_utils
 import serializer_utils
 import queue_utils
+import scheduling_utils
+import spill_utils
+import transport_utils
 from optparse import OptionParser
-from pymongo.errors import DuplicateKeyError, PyMongoError
+from pymongo.errors import PyMongoError
 from twisted.internet import reactor
 from twisted.internet.error import ReactorNotRunning
 from twisted.internet.task import LoopingCall
+from twisted.web.server import Site
 
 try:
     from bson.objectid import ObjectId
@@ -41,6 +53,11 @@ logger = logging.getLogger()
 
 formatter = logging.Formatter('PID:%(process)s %(filename)s %(funcName)s %(levelname)s %(message)s')
 
+# Seconds between reads of the application queues set
+APPLICATION_QUEUES_INTERVAL = 1
+# Max seconds waited for an application over budget when the queues not skipped are empty
+SKIPPED_QUEUES_WAIT = 0.1
+
 rs = None
 options = None
 args = None
@@ -63,9 +80,33 @@ class RedongoServer(object):
         self.popSize = int(options.popSize)
         self.redisQueueSize = int(options.redisQueueSize)
         self.bulks = {}
-        self.completed_bulks = set()
-        self.objs = []
+        # self.bulks is changed by the run thread and by expiration timers on the reactor thread
+        self.bulks_lock = threading.Lock()
+        # Notified when the buffered bytes go back within the budgets
+        self.buffer_condition = threading.Condition(self.bulks_lock)
+        self.flushing = True
+        # application_name -> payload bytes of its bulks not written yet
+        self.buffered_bytes = {}
+        self.total_buffered_bytes = 0
+        # 0 for no limit, applications can set their own max_buffered_bytes
+        self.max_buffered_bytes = int(options.maxBufferedBytes)
+        self.max_application_buffered_bytes = int(options.maxApplicationBufferedBytes)
+        # application_name -> buffered bytes allowed, from its latest settings
+        self.buffer_budgets = {}
+        # Applications over their budget
+        self.full_applications = set()
+        # Applications with their own queue, only that queue stops being popped when they are over budget
+        self.fair_applications = set()
+        # The run loop stops popping while True
+        self.buffer_full = False
+        self.buffer_full_seconds = 0.0
+        self.objs = collections.deque()
+        self.settings_cache = utils.ApplicationSettingsCache(self.redis, ttl=int(options.settingsTTL))
         self.cipher = cipher_utils.AESCipher(__get_sk__())
+        self.mongo_pool = mongo_utils.MongoClientPool(self.cipher, idle_timeout=int(options.mongoIdleTimeout))
+        self.flush_executor = flush_utils.FlushExecutor(self.flush_bulk, threads=int(options.flushThreads))
+        # Bulks taken out of self.bulks that could not be written to Mongo before stopping
+        self.unflushed_bulks = []
         disk_queue_load_time = time.time()
         logger.info('Loading disk queues...')
         self.disk_queue = queue_utils.Queue(queue_name=options.diskQueue)
@@ -73,7 +114,69 @@ class RedongoServer(object):
         ret_disk_queue_load_time = time.time()
         self.returned_disk_queue = queue_utils.Queue(queue_name='{0}_returned'.format(options.diskQueue))
         logger.info('Loading returned disk queue took {0}'.format(time.time() - ret_disk_queue_load_time))
-        self.lock_key = '{0}_LOCK'.format(self.redisQueue)
+        # Stream entries are always acked
+        self.reliable = options.reliable or options.transport == 'stream'
+        if self.reliable:
+            # The consumer name has to be unique among the servers of the queue
+            self.consumer = options.consumer or '{0}_{1}'.format(socket.gethostname(), options.diskQueue)
+            logger.info('Reliable mode as consumer {0}'.format(self.consumer))
+        self.transport = self.create_transport(self.redisQueue)
+        # Redis queue -> disk queue its objects are spilled to, popped in the turn of the Redis queue
+        self.disk_queues = {self.redisQueue: self.disk_queue}
+        # Queues of the applications with a weight, popped in turns with the shared queue
+        self.application_transports = {}
+        # Application queue -> application_name
+        self.queue_applications = {}
+        self.application_queues_refresh = 0
+        self.shared_queue_weight = int(options.sharedQueueWeight)
+        self.scheduler = scheduling_utils.DeficitRoundRobin(quantum=int(options.fairQuantum))
+        self.scheduler.set_queues({self.redisQueue: self.shared_queue_weight})
+        self.spill_worker = spill_utils.SpillWorker(
+            self.transport,
+            self.save_to_disk_queue,
+            self.ack,
+            self.redisQueueSize,
+            low_watermark=int(options.redisQueueLowSize) if options.redisQueueLowSize is not None else None,
+            pop_size=self.popSize,
+            max_items=int(options.spillItems),
+            max_bytes=int(options.spillBytes),
+            on_error=lambda: reactor.callFromThread(stopApp),
+            get_transports=lambda: self.application_transports.values(),
+        )
+        self.stage_timers = profiling_utils.StageTimers(enabled=options.stageTimers)
+        self.create_metrics()
+
+    def create_metrics(self):
+        self.metrics = metrics_utils.MetricsRegistry()
+        self.objects_metric = self.metrics.counter('redongo_objects_total', 'Objects read from the queues', labels=('application',))
+        self.discarded_metric = self.metrics.counter('redongo_discarded_objects_total', 'Objects discarded because they could not be decoded or had no application settings', labels=('reason',))
+        self.failed_metric = self.metrics.counter('redongo_failed_objects_total', 'Objects moved to the failed queue', labels=('application',))
+        self.bulk_size_metric = self.metrics.histogram('redongo_bulk_objects', 'Objects of the flushed bulks', metrics_utils.SIZE_BUCKETS, labels=('application',))
+        self.flush_metric = self.metrics.histogram('redongo_flush_seconds', 'Time writing a bulk to Mongo', metrics_utils.LATENCY_BUCKETS, labels=('application',))
+        self.add_objects_metric = self.metrics.counter('redongo_add_objects_total', 'Add objects sent to Mongo')
+        self.add_updates_metric = self.metrics.counter('redongo_add_updates_total', 'Mongo updates of the coalesced add objects')
+        self.buffered_bytes_metric = self.metrics.gauge('redongo_buffered_bytes', 'Payload bytes of the objects buffered and not written yet', labels=('application',))
+        self.buffer_budget_metric = self.metrics.gauge('redongo_buffer_budget_bytes', 'Buffered bytes allowed per application (0 for no limit)', labels=('application',))
+        self.metrics.gauge('redongo_total_buffered_bytes', 'Payload bytes buffered by all the applications', function=lambda: self.total_buffered_bytes)
+        self.metrics.gauge('redongo_max_buffered_bytes', 'Buffered bytes allowed for all the applications (0 for no limit)', function=lambda: self.max_buffered_bytes)
+        self.forced_flushes_metric = self.metrics.counter('redongo_forced_flushes_total', 'Bulks flushed before their size or expiration because of the buffer budgets', labels=('application',))
+        self.metrics.counter('redongo_buffer_full_seconds_total', 'Time popping was stopped because of the buffer budgets', function=lambda: self.buffer_full_seconds)
+        self.metrics.gauge('redongo_application_queues', 'Application queues popped in turns with the shared queue', function=lambda: len(self.application_transports))
+        self.metrics.gauge('redongo_redis_queue_length', 'Redis queue length, application queues included, as last seen by the spill worker', function=lambda: self.spill_worker.queue_length)
+        self.metrics.gauge('redongo_disk_queue_length', 'Objects in the disk queues', function=lambda: sum(disk_queue._length for disk_queue in self.disk_queues.values()))
+        self.metrics.gauge('redongo_returned_disk_queue_length', 'Objects in the returned disk queue', function=lambda: self.returned_disk_queue._length)
+        self.metrics.gauge('redongo_pending_bulks', 'Bulks waiting to be written to Mongo', function=lambda: self.flush_executor.pending)
+        self.metrics.counter('redongo_spills_total', 'Times the Redis queue went over its size', function=lambda: self.spill_worker.spills)
+        self.metrics.counter('redongo_spilled_objects_total', 'Objects spilled to the disk queue', function=lambda: self.spill_worker.spilled_items)
+        self.metrics.counter('redongo_spilled_bytes_total', 'Bytes spilled to the disk queue', function=lambda: self.spill_worker.spilled_bytes)
+        self.metrics.counter('redongo_spill_throttled_seconds_total', 'Time spilling waited for its per second budget', function=lambda: self.spill_worker.throttled_seconds)
+        self.metrics.gauge('redongo_mongo_clients', 'Open Mongo clients', function=lambda: len(self.mongo_pool._clients))
+        self.metrics.counter('redongo_mongo_client_hits_total', 'Bulks that reused a Mongo client', function=lambda: self.mongo_pool.hits)
+        self.metrics.counter('redongo_mongo_client_misses_total', 'Bulks that created a Mongo client', function=lambda: self.mongo_pool.misses)
+        self.metrics.counter('redongo_mongo_client_evictions_total', 'Idle Mongo clients closed', function=lambda: self.mongo_pool.evictions)
+        self.metrics.counter('redongo_settings_cache_hits_total', 'Application settings read from the cache', function=lambda: self.settings_cache.hits)
+        self.metrics.counter('redongo_settings_cache_misses_total', 'Application settings read from Redis', function=lambda: self.settings_cache.misses)
+        self.metrics.add(profiling_utils.StageSummary('redongo_stage_seconds', 'Time of every stage per popped batch or flushed bulk (with --stagetimers)', self.stage_timers))
 
     def create_redis_connection(self):
         if self.mode == 'Redis':
@@ -93,19 +196,107 @@ class RedongoServer(object):
                 socket_connect_timeout=5,
             )
 
-    def check_object(self, obj):
-        if type(obj) != list or len(obj) != 2:
-            raise server_exceptions.ObjectValidationError('Type not valid')
+    def create_transport(self, queue):
+        if not self.reliable:
+            return transport_utils.ListTransport(self.redis, queue)
+        if options.transport == 'stream':
+            transport = transport_utils.StreamTransport(self.redis, queue, self.consumer, group=options.streamGroup, claim_timeout=int(options.claimTimeout))
+        else:
+            transport = transport_utils.ListTransport(self.redis, queue, consumer=self.consumer, heartbeat_ttl=int(options.heartbeatTTL))
+        transport.heartbeat()
+        # Objects popped by a previous run of this consumer were never acked
+        logger.info('{0} objects reclaimed from queue {1}'.format(transport.reclaim(own=True), queue))
+        return transport
 
     def get_application_settings(self, application_name):
-        return utils.get_application_settings(application_name, self.redis)
+        return self.settings_cache.get(application_name)
 
-    def save_to_failed_queue(self, application_name, bulk):
-        i = 0
-        for obj, command, original_object in bulk['data']:
-            self.redis.rpush('{0}_FAILED'.format(self.redisQueue), original_object)
-            i += 1
-        logger.warning('Moved {0} objects from application {1} to queue {2}_FAILED'.format(i, application_name, self.redisQueue))
+    def refresh_application_queues(self):
+        # Every APPLICATION_QUEUES_INTERVAL seconds, adds the new application queues and updates the weights
+        now = time.time()
+        if now < self.application_queues_refresh:
+            return
+        self.application_queues_refresh = now + APPLICATION_QUEUES_INTERVAL
+        prefix = transport_utils.get_application_queue(self.redisQueue, '')
+        weights = {self.redisQueue: self.shared_queue_weight}
+        for queue in self.redis.smembers(transport_utils.get_application_queues_key(self.redisQueue)):
+            if queue not in self.application_transports:
+                application_name = queue[len(prefix):]
+                # Spilled objects of the application keep their turn
+                self.disk_queues[queue] = queue_utils.Queue(queue_name='{0}_app_{1}'.format(options.diskQueue, urllib.quote(application_name, safe='')))
+                self.application_transports[queue] = self.create_transport(queue)
+                self.queue_applications[queue] = application_name
+                logger.info('Popping application queue {0}'.format(queue))
+            try:
+                weights[queue] = self.get_application_settings(self.queue_applications[queue]).get('weight') or 1
+            except general_exceptions.ApplicationSettingsError:
+                # Its objects are discarded
+                weights[queue] = 1
+        self.scheduler.set_queues(weights)
+        with self.bulks_lock:
+            self.fair_applications = set(self.queue_applications.itervalues())
+
+    def pop_next(self):
+        ''' Returns the next batch of (item, ack handle). With application queues they take turns with the
+            shared queue in weighted round robin. Waits up to a second for new objects if all of them are empty
+        '''
+        self.refresh_application_queues()
+        if not self.application_transports:
+            return self.pop_shared(self.popSize, 1)
+        # Applications over their buffer budget wait for their bulks to be written
+        skip = set(queue for queue, application_name in self.queue_applications.iteritems() if application_name in self.full_applications)
+        for i in xrange(len(self.scheduler)):
+            turn = self.scheduler.next(skip)
+            if turn is None:
+                break
+            queue, credit = turn
+            count = min(credit, self.popSize)
+            if queue == self.redisQueue:
+                objs = self.pop_shared(count, 0)
+            else:
+                objs = self.pop_queue(self.application_transports[queue], count, 0)
+            self.scheduler.served(queue, count, len(objs))
+            if objs:
+                return objs
+        if skip:
+            # Queues of applications over budget may have objects, they are popped again once their bulks are written
+            with self.bulks_lock:
+                if self.full_applications & self.fair_applications:
+                    self.buffer_condition.wait(SKIPPED_QUEUES_WAIT)
+            return []
+        # Every queue is empty
+        return self.pop_transport(self.transport, self.popSize, 1, others=self.application_transports.values())
+
+    def pop_shared(self, count, timeout):
+        return self.pop_queue(self.transport, count, timeout)
+
+    def pop_queue(self, transport, count, timeout):
+        # Objects spilled to the disk queue of a Redis queue go before it
+        disk_queue = self.disk_queues[transport.queue]
+        if disk_queue._length > 0:
+            objs = [(obj, None) for obj in disk_queue.pop_many(count)]
+            logger.debug('Got {0} objects from disk queue {1}'.format(len(objs), disk_queue._disk_queue_name))
+            return objs
+        return self.pop_transport(transport, count, timeout)
+
+    def pop_transport(self, transport, count, timeout, others=()):
+        clock = self.stage_timers.clock()
+        if others:
+            # Waits for the first of the queues getting objects
+            transport, items, handles = transport.pop_first(others, count, timeout=timeout)
+        else:
+            items, handles = transport.pop(count, timeout=timeout)
+        if items:
+            if clock:
+                clock.lap('pop')
+                self.stage_timers.add_clock(clock)
+            logger.debug('Got {0} objects from redis queue {1}'.format(len(items), transport.queue))
+        return zip(items, handles)
+
+    def save_to_failed_queue(self, application_name, entries):
+        self.redis.rpush('{0}_FAILED'.format(self.redisQueue), *[entry.get_item(application_name) for entry in entries])
+        self.failed_metric.inc(len(entries), (application_name,))
+        logger.warning('Moved {0} objects from application {1} to queue {2}_FAILED'.format(len(entries), application_name, self.redisQueue))
 
     def run(self):
         global run_stopped
@@ -116,87 +307,117 @@ class RedongoServer(object):
             while self.keep_going:
                 object_found = False
 
-                lock = self.redis.wait_for_lock(self.lock_key, 60, auto_renewal=True)
+                if not self.flush_executor.wait_for_capacity(1):
+                    # Too many bulks waiting for Mongo, stop popping until some of them are written
+                    continue
+
+                if not self.wait_for_buffer(1):
+                    # Too many bytes buffered, stop popping until some bulks are written
+                    continue
 
                 if first_run:
                     while self.returned_disk_queue._length > 0:
-                        self.objs.append(self.returned_disk_queue.pop())
+                        self.objs.extend((obj, None) for obj in self.returned_disk_queue.pop_many(self.popSize))
                         object_found = True
                     first_run = False
                     if object_found:
                         logger.info('Got {0} objects from returned disk queue {1}'.format(len(self.objs), self.returned_disk_queue._disk_queue_name))
 
-                if self.disk_queue._length > 0:
-                    for i in range(0, self.popSize):
-                        if self.disk_queue._length:
-                            self.objs.append(self.disk_queue.pop())
-                            object_found = True
-                            logger.debug('Got {0} objects from disk queue {1}'.format(len(self.objs), self.disk_queue._disk_queue_name))
-                        else:
-                            break
+                if self.objs:
+                    # Left by the previous batch when the buffer was full
+                    object_found = True
                 else:
-                    try:
-                        self.objs.append(self.redis.blpop(self.redisQueue)[1])
-                        logger.debug('Got {0} objects from redis queue {1}'.format(len(self.objs), self.redisQueue))
-                        object_found = True
-                    except redis.TimeoutError:
-                        pass
-                    if object_found:
-                        self.objs.extend(self.redis.multi_lpop(self.redisQueue, self.popSize-1))
-
-                if lock:
-                    self.redis.release_lock(lock)
+                    self.objs.extend(self.pop_next())
+                    object_found = bool(self.objs)
 
                 if object_found:
-                    while self.objs:
+                    self.settings_cache.refresh()
+                    clock = self.stage_timers.clock()
+                    while self.objs and not self.buffer_full:
                         try:
-                            orig_obj = self.objs.pop(0)
-                            obj = pickle.loads(orig_obj)
+                            orig_obj, batch = self.objs.popleft()
+                            if clock:
+                                clock.start()
+                            header, payloads = envelope_utils.loads(orig_obj)
+                            if clock:
+                                clock.lap('envelope')
+                            application_name, serializer_type, command = header
                             try:
-                                self.check_object(obj)
-                                application_settings = self.get_application_settings(obj[0][0])
-                            except (server_exceptions.ObjectValidationError, general_exceptions.ApplicationSettingsError), e:
-                                logger.error('Discarding {0} object because of {1}'.format(obj[0], e))
+                                application_settings = self.get_application_settings(application_name)
+                                if clock:
+                                    clock.lap('settings')
+                            except general_exceptions.ApplicationSettingsError, e:
+                                logger.error('Discarding {0} object because of {1}'.format(header, e))
+                                self.discarded_metric.inc(1, ('settings',))
+                                self.ack([batch])
                                 continue
-                            application_bulk = self.bulks.setdefault(obj[0][0], {'serializer': obj[0][1], 'data': []})
-                            application_bulk.setdefault('inserted_date', datetime.datetime.utcnow())
-                            application_bulk.update(application_settings)
-                            ser = serializer_utils.serializer(obj[0][1])
-                            obj_data = ser.loads(obj[1])
-                            application_bulk['data'].append((self.normalize_object(obj_data), obj[0][2], orig_obj))
-                        except (ValueError, TypeError, IndexError, ImportError, pickle.PickleError), e:
+                            serializer_utils.serializer(serializer_type)
+                            size = sum(map(len, payloads))
+                        except (ValueError, TypeError, IndexError, KeyError, EOFError, ImportError, pickle.PickleError), e:
                             logger.error('Discarding {0} object because of {1}'.format(orig_obj, e))
+                            self.discarded_metric.inc(1, ('decode',))
+                            self.ack([batch])
                             continue
-
-                while self.completed_bulks:
-                    self.consume_application(self.completed_bulks.pop())
-
-                # Guarantee that the looping call can access the lock
-                time.sleep(.05)
-
+                        if len(payloads) != 1:
+                            # Every object of a frame is acked on its own
+                            if batch is not None:
+                                batch.transport.extend(batch, len(payloads))
+                            self.ack([batch])
+                        # Objects are decoded when their bulk is written, objects of a frame are kept (and returned
+                        # or failed) as single object items
+                        envelope_format = envelope_utils.get_format(orig_obj)
+                        entries = [bulk_utils.BufferedObject(payload, serializer_type, command, envelope_format, batch) for payload in payloads]
+                        if entries:
+                            self.add_to_bulk(application_name, application_settings, entries, size)
+                            if clock:
+                                clock.lap('bulk')
+                    if clock:
+                        self.stage_timers.add_clock(clock)
+
+            self.stop_flushing()
             logger.info('Setting run_stopped to True')
             run_stopped = True
 
         except:
             logger.error('Stopping redongo because unexpected exception: {0}'.format(traceback.format_exc()))
+            self.stop_flushing()
             logger.info('Setting run_stopped to True')
             run_stopped = True
             stopApp()
 
     def back_to_disk(self):
         logger.info('Returning memory data to Disk Queue')
-        objects_returned = 0
-        for application_name, bulk in self.bulks.iteritems():
-            for obj, command, original_object in bulk['data']:
-                self.returned_disk_queue.push(original_object)
-                objects_returned += 1
-        logger.info('{0} objects returned to Disk Queue'.format(objects_returned))
+        objects_returned = []
+        batches = []
+        for application_name, bulk in self.bulks.items() + self.unflushed_bulks:
+            for entry in bulk.entries:
+                objects_returned.append(entry.get_item(application_name))
+                batches.append(entry.handle)
+        # Popped and not processed because the buffer was full
+        for obj, batch in self.objs:
+            objects_returned.append(obj)
+            batches.append(batch)
+        self.objs.clear()
+        self.returned_disk_queue.push_many(objects_returned)
+        logger.info('{0} objects returned to Disk Queue'.format(len(objects_returned)))
+        # Safe in the disk queue now
+        self.ack(batches)
+
+    def ack(self, batches):
+        # Handles go back to the transport of their queue
+        transports = {}
+        for batch in batches:
+            if batch is not None:
+                transports.setdefault(batch.transport, []).append(batch)
+        try:
+            for transport, transport_batches in transports.iteritems():
+                transport.ack(transport_batches)
+        except redis.RedisError, e:
+            # The batches will be reclaimed and processed again
+            logger.warning('Could not ack {0} objects: {1}'.format(len(batches), e))
 
     def get_mongo_collection(self, bulk):
-        mongo_client = pymongo.MongoClient('mongodb://{0}:{1}@{2}:{3}/{4}'.format(bulk['mongo_user'], self.cipher.decrypt(bulk['mongo_password']), bulk['mongo_host'], bulk['mongo_port'], bulk['mongo_database']))
-        mongo_db = mongo_client[bulk['mongo_database']]
-        collection = mongo_db[bulk['mongo_collection']]
-        return collection
+        return self.mongo_pool.get_collection(bulk.settings)
 
     def normalize_object(self, obj):
         objectid_fields = obj.pop('objectid_fields', [])
@@ -211,83 +432,90 @@ class RedongoServer(object):
 
         return obj
 
-    def deal_with_mongo(self, application_name):
-        bulk = self.bulks[application_name]
-        set_of_objects = []
+    def decode_bulk(self, application_name, bulk):
+        # [(normalized object, entry)] of the objects of bulk, the ones that can't be decoded are discarded
+        objects = []
+        serializers = {}
+        for entry in bulk.entries:
+            try:
+                ser = serializers.get(entry.serializer_type)
+                if ser is None:
+                    ser = serializers[entry.serializer_type] = serializer_utils.serializer(entry.serializer_type)
+                objects.append((self.normalize_object(ser.loads(entry.payload)), entry))
+            except (ValueError, TypeError, IndexError, KeyError, EOFError, ImportError, AttributeError, pickle.PickleError), e:
+                logger.error('Discarding {0} object because of {1}'.format(entry.get_item(application_name), e))
+                self.discarded_metric.inc(1, ('decode',))
+                self.ack([entry.handle])
+        return objects
+
+    def deal_with_mongo(self, application_name, bulk):
         to_failed = []
-        result = None
+        clock = self.stage_timers.clock()
+        objects = self.decode_bulk(application_name, bulk)
+        if clock:
+            clock.lap('decode')
+        if not objects:
+            # None of its objects could be decoded
+            return
+        # Every object is acked once written to Mongo or to the failed queue
+        batches = [entry.handle for obj, entry in objects]
         try:
             collection = self.get_mongo_collection(bulk)
+            if clock:
+                clock.lap('mongo_connect')
         except (PyMongoError, InvalidDocument), e:
-            logger.error('Not saving bulk {0} (moving to failed queue) from application {1} due to connection bad data: {2}'.format(bulk, application_name, e))
-            self.save_to_failed_queue(application_name, bulk)
+            logger.error('Not saving {0} objects (moving to failed queue) from application {1} due to connection bad data: {2}'.format(len(objects), application_name, e))
+            self.save_to_failed_queue(application_name, [entry for obj, entry in objects])
+            self.ack(batches)
             return
         # Separates objects with different commands. When appears any object with other command, executes current command for all readed objects
-        current_command = bulk['data'][0][1]
-        while bulk['data']:
-            obj, command, original_object = bulk['data'].pop(0)
-            if command == current_command:
-                set_of_objects.append((obj, command, original_object))
-            else:
-                # Execute command for all readed objects
-                if current_command == 'save':
-                    result = self.save_to_mongo(collection, set_of_objects)
-                elif current_command == 'add':
-                    result = self.add_in_mongo(collection, set_of_objects)
-                # Notify on failure
-                if result:
-                    logger.error('Not saving {0} objects (moving to failed queue) from application {1} due to connection bad data'.format(len(result), application_name))
-                    to_failed += result
-                current_command = command
-                set_of_objects = [(obj, command, original_object)]
-        # Last set
-        if current_command == 'save':
-            result = self.save_to_mongo(collection, set_of_objects)
-        elif current_command == 'add':
-            result = self.add_in_mongo(collection, set_of_objects)
-        # Notify on failure
-        if result:
-            logger.error('Not saving {0} objects (moving to failed queue) from application {1} due to connection bad data'.format(len(result), application_name))
-            to_failed += result
+        for command, set_of_objects in itertools.groupby(objects, lambda full_object: full_object[1].command):
+            result = None
+            if command == 'save':
+                result = self.save_to_mongo(collection, list(set_of_objects))
+            elif command == 'add':
+                result = self.add_in_mongo(collection, list(set_of_objects))
+            # Notify on failure
+            if result:
+                logger.error('Not saving {0} objects (moving to failed queue) from application {1} due to connection bad data'.format(len(result), application_name))
+                to_failed.extend(entry for obj, entry in result)
+
+        if clock:
+            clock.lap('mongo_write')
 
         # If an error occurred, it notifies and inserts the required objects
         if to_failed:
-            bulk['data'] = to_failed
-            self.save_to_failed_queue(application_name, bulk)
+            self.save_to_failed_queue(application_name, to_failed)
+        self.ack(batches)
+        if clock:
+            clock.lap('ack')
+            self.stage_timers.add_clock(clock)
 
     def save_to_mongo(self, collection, objs):
-        to_insert = []
-        to_update = []
-        to_failed = []
-        differents = set()
-        while objs:
-            full_object = objs.pop(0)
-            if '_id' not in full_object[0]:
-                to_insert.append(full_object)
-            elif full_object[0]['_id'] not in differents:
-                to_insert.append(full_object)
-                differents.add(full_object[0]['_id'])
+        # Every object is written as a replace upsert, so new and existing _ids cost the same.
+        # Only the last object of each _id is sent, it would replace the previous ones anyway,
+        # but if it fails all of them are returned
+        operations = []
+        operation_index = {}
+        for full_object in objs:
+            obj = full_object[0]
+            if '_id' not in obj:
+                obj['_id'] = ObjectId()
+            id_key = mongo_utils.get_id_key(obj['_id'])
+            index = operation_index.get(id_key)
+            if index is None:
+                operation_index[id_key] = len(operations)
+                operations.append((obj['_id'], obj, [full_object]))
             else:
-                to_update.append(full_object)
-        # Bulk insert
-        try:
-            collection.insert(map(lambda x: x[0], to_insert))
-        except DuplicateKeyError:
-            to_update = to_insert + to_update
-        except (PyMongoError, InvalidDocument):
-            to_failed.extend(to_insert)
-
-        # One-to-one update
-        while to_update:
-            full_obj = to_update.pop(0)
-            try:
-                collection.update({'_id': full_obj[0]['_id']}, full_obj[0])
-            except (PyMongoError, InvalidDocument):
-                to_failed.extend(to_update)
+                entries = operations[index][2]
+                entries.append(full_object)
+                operations[index] = (obj['_id'], obj, entries)
         # Return unsaved objects
-        return to_failed
+        return mongo_utils.bulk_upsert(collection, operations, replace=True)
 
-    def create_add_query(self, obj, previous_field='', query={}):
+    def create_add_query(self, obj, previous_field='', query=None):
+        if query is None:
+            query = {}
         for field, value in obj.iteritems():
             if field == '_id':
                 continue
@@ -308,69 +536,213 @@ class RedongoServer(object):
             elif type_field is dict:
                 query = self.create_add_query(value, '{0}{1}.'.format(previous_field, field), query)
             else:
-                query.setdefault('$set', {(previous_field + field): value})
+                x = query.setdefault('$set', {})
+                x[previous_field + field] = value
         return query
 
+    def merge_add_query(self, update, query):
+        ''' Merges query into update = [merged query, {path: operator}, entries] if both fit in one
+            Mongo update: $inc values are summed, $push lists concatenated and the last $set wins.
+            Returns False when a path is used with another operator or overlaps another path
+        '''
+        merged_query, paths = update[0], update[1]
+        for operator, fields in query.iteritems():
+            for path in fields:
+                merged_operator = paths.get(path)
+                if merged_operator is None:
+                    for merged_path in paths:
+                        if merged_path.startswith(path + '.') or path.startswith(merged_path + '.'):
+                            return False
+                elif merged_operator != operator:
+                    return False
+        for operator, fields in query.iteritems():
+            merged_fields = merged_query.setdefault(operator, {})
+            for path, value in fields.iteritems():
+                if path not in merged_fields:
+                    paths[path] = operator
+                    if operator == '$push':
+                        value = {'$each': list(value['$each'])}
+                    merged_fields[path] = value
+                elif operator == '$inc':
+                    merged_fields[path] += value
+                elif operator == '$push':
+                    merged_fields[path]['$each'].extend(value['$each'])
+                else:
+                    merged_fields[path] = value
+        return True
+
     def add_in_mongo(self, collection, objs):
         to_failed = []
-        # One-to-one update
-        while objs:
-            full_object = objs.pop(0)
+        # All the adds of one _id are merged into as few updates as possible
+        updates_by_id = collections.OrderedDict()
+        merged_objects = 0
+        for full_object in objs:
             obj = full_object[0]
-            try:
-                collection.update({'_id': obj['_id']}, self.create_add_query(obj), upsert=True)
-            except (PyMongoError, InvalidDocument):
+            if '_id' not in obj:
                 to_failed.append(full_object)
-        # Return unadded objects and info
+                continue
+            query = self.create_add_query(obj)
+            if not query:
+                # Nothing to add
+                continue
+            merged_objects += 1
+            updates = updates_by_id.setdefault(mongo_utils.get_id_key(obj['_id']), (obj['_id'], []))[1]
+            if not updates or not self.merge_add_query(updates[-1], query):
+                updates.append([{}, {}, []])
+                self.merge_add_query(updates[-1], query)
+            updates[-1][2].append(full_object)
+        # An unordered bulk doesn't keep the order of the updates of one _id, so the nth update
+        # of every _id goes in the nth round. Usually there is a single round
+        rounds = []
+        for _id, updates in updates_by_id.itervalues():
+            for n, (query, paths, entries) in enumerate(updates):
+                if n == len(rounds):
+                    rounds.append([])
+                rounds[n].append((_id, query, entries))
+        if merged_objects:
+            updates = sum(len(operations) for operations in rounds)
+            logger.debug('Coalesced {0} add objects into {1} updates'.format(merged_objects, updates))
+            self.add_objects_metric.inc(merged_objects)
+            self.add_updates_metric.inc(updates)
+        for operations in rounds:
+            to_failed.extend(mongo_utils.bulk_upsert(collection, operations))
+        # Return unadded objects
         return to_failed
 
+    def add_to_bulk(self, application_name, application_settings, entries, size):
+        with self.bulks_lock:
+            bulk = self.bulks.get(application_name)
+            if bulk is None:
+                bulk = self.bulks[application_name] = bulk_utils.Bulk(application_settings)
+                # Twisted keeps its timers in a heap, the bulk is flushed right at its deadline
+                reactor.callFromThread(reactor.callLater, application_settings['bulk_expiration'], self.expire_bulk, application_name, bulk)
+            else:
+                bulk.settings = application_settings
+            budget = application_settings.get('max_buffered_bytes') or self.max_application_buffered_bytes
+            if self.buffer_budgets.get(application_name) != budget:
+                self.buffer_budgets[application_name] = budget
+                self.buffer_budget_metric.set(budget, (application_name,))
+            was_full = application_name in self.full_applications
+            bulk.add(entries, size)
+            self.update_buffered_bytes(application_name, size)
+            self.objects_metric.inc(len(entries), (application_name,))
+            if len(bulk) >= bulk.settings['bulk_size']:
+                self.consume_application(application_name)
+            elif application_name in self.full_applications and not was_full:
+                # Applications with their own queue don't stop the run loop, their bulk is flushed now
+                self.forced_flushes_metric.inc(1, (application_name,))
+                self.consume_application(application_name)
+
+    def update_buffered_bytes(self, application_name, size):
+        # Called with bulks_lock held
+        buffered_bytes = self.buffered_bytes[application_name] = self.buffered_bytes.get(application_name, 0) + size
+        self.buffered_bytes_metric.set(buffered_bytes, (application_name,))
+        self.total_buffered_bytes += size
+        budget = self.buffer_budgets.get(application_name)
+        if budget and buffered_bytes >= budget:
+            self.full_applications.add(application_name)
+        elif application_name in self.full_applications:
+            self.full_applications.remove(application_name)
+            if application_name in self.fair_applications:
+                # Its queue can be popped again
+                self.buffer_condition.notify_all()
+        buffer_full = bool(self.full_applications - self.fair_applications) or bool(self.max_buffered_bytes and self.total_buffered_bytes >= self.max_buffered_bytes)
+        if self.buffer_full and not buffer_full:
+            self.buffer_condition.notify_all()
+        self.buffer_full = buffer_full
+
+    def wait_for_buffer(self, timeout):
+        ''' Returns True when the buffered bytes are within the budgets. Otherwise the bulks over them are
+            flushed right away and it waits up to timeout seconds for them to be written
+        '''
+        with self.bulks_lock:
+            if not self.buffer_full:
+                return True
+            start = time.time()
+            self.flush_over_budget()
+            self.buffer_condition.wait(timeout)
+            self.buffer_full_seconds += time.time() - start
+            return not self.buffer_full
+
+    def flush_over_budget(self):
+        # Called with bulks_lock held. Flushes the bulks of the applications over their budget, then the
+        # biggest bulks until the ones left are within the global budget
+        for application_name in self.full_applications & set(self.bulks):
+            self.forced_flushes_metric.inc(1, (application_name,))
+            self.consume_application(application_name)
+        if self.max_buffered_bytes and self.total_buffered_bytes >= self.max_buffered_bytes:
+            bulks_bytes = sum(bulk.size for bulk in self.bulks.itervalues())
+            for application_name, bulk in sorted(self.bulks.items(), key=lambda item: item[1].size, reverse=True):
+                if bulks_bytes < self.max_buffered_bytes:
+                    break
+                bulks_bytes -= bulk.size
+                self.forced_flushes_metric.inc(1, (application_name,))
+                self.consume_application(application_name)
+
+    def expire_bulk(self, application_name, bulk):
+        # Reactor thread, bulk_expiration seconds after bulk got its first object
+        with self.bulks_lock:
+            # Unless it was flushed because of its size
+            if self.flushing and self.bulks.get(application_name) is bulk:
+                self.consume_application(application_name)
+
     def consume_application(self, application_name):
-        # In case that check_completed_bulks reads while main thread was saving on previous iteration
-        if application_name in self.bulks:
-            self.deal_with_mongo(application_name)
-            self.bulks.pop(application_name)
+        # Called with bulks_lock held. New objects of the application start a new bulk while this one is written
+        bulk = self.bulks.pop(application_name)
+        self.flush_executor.submit(application_name, bulk, weight=bulk.settings.get('weight') or 1, cost=len(bulk))
 
-    def check_completed_bulks(self):
+    def flush_bulk(self, application_name, bulk):
+        # Runs on a flush executor thread
+        start = time.time()
         try:
-            for application_name, bulk in self.bulks.items():
-                if len(bulk['data']) >= bulk['bulk_size'] or bulk['inserted_date'] + datetime.timedelta(seconds=bulk['bulk_expiration']) <= datetime.datetime.utcnow():
-                    self.completed_bulks.add(application_name)
+            self.deal_with_mongo(application_name, bulk)
+            # The expiration timer keeps the bulk until its deadline
+            bulk_size = len(bulk)
+            bulk.entries.clear()
+            self.flush_metric.observe(time.time() - start, (application_name,))
+            self.bulk_size_metric.observe(bulk_size, (application_name,))
         except:
-            stopApp()
-
-    def check_redis_queue(self):
+            logger.error('Stopping redongo because unexpected exception flushing application {0}: {1}'.format(application_name, traceback.format_exc()))
+            self.unflushed_bulks.append((application_name, bulk))
+            reactor.callFromThread(stopApp)
+        with self.bulks_lock:
+            self.update_buffered_bytes(application_name, -bulk.size)
+
+    def stop_flushing(self):
+        with self.bulks_lock:
+            # Bulks left are returned to disk
+            self.flushing = False
+        logger.info('Waiting for {0} bulks being written to Mongo'.format(self.flush_executor.pending))
+        self.unflushed_bulks.extend(self.flush_executor.shutdown())
+
+    def check_consumer(self):
+        # Reliable mode: keeps this consumer alive and gives back the batches of dead ones
         try:
-            if self.redis.llen(self.redisQueue) > self.redisQueueSize or self.disk_queue._length > 0:
-                to_disk_queue = []
-                object_found = False
-                lock = self.redis.wait_for_lock(self.lock_key, 60, auto_renewal=True)
-                while self.redis.llen(self.redisQueue) > self.redisQueueSize:
-                    try:
-                        to_disk_queue.append(self.redis.blpop(self.redisQueue)[1])
-                        object_found = True
-                    except redis.TimeoutError:
-                        pass
-                    if object_found:
-                        to_disk_queue.extend(self.redis.multi_lpop(self.redisQueue, self.popSize-1))
-                    self.save_to_disk_queue(to_disk_queue)
-                self.redis.release_lock(lock)
-        except redis.TimeoutError:
-            pass
+            for transport in [self.transport] + self.application_transports.values():
+                transport.heartbeat()
+                reclaimed = transport.reclaim()
+                if reclaimed:
+                    logger.warning('Reclaimed {0} objects of queue {1} from dead consumers'.format(reclaimed, transport.queue))
+        except redis.RedisError, e:
+            logger.warning('Could not check consumers: {0}'.format(e))
+
+    def save_to_disk_queue(self, queue, objs):
+        self.disk_queues[queue].push_many(objs)
+
+    def stop_spilling(self):
+        self.spill_worker.stop()
+        logger.info('Spill worker stopped: {0}'.format(self.spill_worker.stats()))
 
-    def save_to_disk_queue(self, objs):
-        while objs:
-            obj = objs.pop(0)
-            self.disk_queue.push(obj)
+    def close_mongo_clients(self):
+        logger.info('Closing Mongo clients: {0}'.format(self.mongo_pool.stats()))
+        self.mongo_pool.close()
 
     def close_disk_queues(self):
-        try:
-            self.disk_queue.close()
-        except:
-            logger.error('Could not close disk queue {0}: {1}'.format(self.disk_queue._disk_queue_name, traceback.format_exc()))
-        try:
-            self.returned_disk_queue.close()
-        except:
-            logger.error('Could not close disk queue {0}: {1}'.format(self.returned_disk_queue._disk_queue_name, traceback.format_exc()))
+        for disk_queue in self.disk_queues.values() + [self.returned_disk_queue]:
+            try:
+                disk_queue.close()
+            except:
+                logger.error('Could not close disk queue {0}: {1}'.format(disk_queue._disk_queue_name, traceback.format_exc()))
 
 
 def sigtermHandler():
@@ -381,8 +753,10 @@ def sigtermHandler():
     logger.info('Waiting for run_stopped')
     while not run_stopped:
         time.sleep(0.1)
+    rs.stop_spilling()
     rs.back_to_disk()
     rs.close_disk_queues()
+    rs.close_mongo_clients()
     logger.info('Exiting program!')
 
 
@@ -438,12 +812,7 @@ def validateArgs(parser, options):
     return mode
 
 
-def main():
-    global rs
-    global options
-    global args
-    global logger
-
+def get_option_parser():
     parser = OptionParser(description='Startup options')
     parser.add_option('--redis', '-r', dest='redisIP', help='Redis server IP Address', metavar='REDIS')
     parser.add_option('--redisdb', '-d', dest='redisDB', help='Redis server DB', metavar='REDIS_DB')
@@ -452,10 +821,40 @@ def main():
     parser.add_option('--port', '-P', dest='redisPort', help='Redis Port', metavar='REDIS_PORT', default=6379)
     parser.add_option('--sentinelservers', '-S', dest='sentinelServers', help='Sentinel Servers (-S host1 port1 -S host2 port2 .. -S hostN portN)', metavar='SENTINEL_SERVERS', action='append', nargs=2)
     parser.add_option('--sentinelname', '-n', dest='sentinelName', help='Sentinel Group Name', metavar='SENTINEL_NAME')
-    parser.add_option('--queuesize', '-s', dest='redisQueueSize', help='Max Redis Queue Size', metavar='REDIS_QUEUE_SIZE', default=10000)
-    parser.add_option('--diskqueue', '-Q', dest='diskQueue', help='Disk Queue', metavar='DISK_QUEUE', default='redongo_disk_queue')
+    parser.add_option('--queuesize', '-s', dest='redisQueueSize', help='Max Redis Queue Size, application queues included', metavar='REDIS_QUEUE_SIZE', default=10000)
+    parser.add_option('--queuelowsize', dest='redisQueueLowSize', help='Redis Queue Size where spilling to disk stops (default 80% of REDIS_QUEUE_SIZE)', metavar='REDIS_QUEUE_LOW_SIZE')
+    parser.add_option('--spillitems', dest='spillItems', help='Max objects spilled to disk per second (0 for no limit)', metavar='SPILL_ITEMS', default=0)
+    parser.add_option('--spillbytes', dest='spillBytes', help='Max bytes spilled to disk per second (0 for no limit)', metavar='SPILL_BYTES', default=0)
+    parser.add_option('--maxbufferedbytes', dest='maxBufferedBytes', help='Max payload bytes buffered by all the applications, popping stops and the biggest bulks are flushed when reached (0 for no limit)', metavar='MAX_BUFFERED_BYTES', default=0)
+    parser.add_option('--appbufferedbytes', dest='maxApplicationBufferedBytes', help='Max payload bytes buffered per application unless set in its settings (0 for no limit)', metavar='APP_BUFFERED_BYTES', default=0)
+    parser.add_option('--fairquantum', dest='fairQuantum', help='Objects popped per weight unit when application queues take turns', metavar='FAIR_QUANTUM', default=100)
+    parser.add_option('--sharedqueueweight', dest='sharedQueueWeight', help='Weight of the shared queue among the application queues', metavar='SHARED_QUEUE_WEIGHT', default=1)
+    parser.add_option('--diskqueue', '-Q', dest='diskQueue', help='Disk Queue, application queues spill to DISK_QUEUE_app_<application>', metavar='DISK_QUEUE', default='redongo_disk_queue')
+    parser.add_option('--flushthreads', '-t', dest='flushThreads', help='Threads writing bulks to Mongo', metavar='FLUSH_THREADS', default=4)
+    parser.add_option('--settingsttl', dest='settingsTTL', help='Seconds application settings are cached', metavar='SETTINGS_TTL', default=60)
+    parser.add_option('--mongoidletimeout', dest='mongoIdleTimeout', help='Seconds before an unused Mongo connection is closed', metavar='MONGO_IDLE_TIMEOUT', default=300)
+    parser.add_option('--transport', dest='transport', help='Queue type: list or stream (Redis stream read through a consumer group)', metavar='TRANSPORT', type='choice', choices=transport_utils.TRANSPORTS, default='list')
+    parser.add_option('--streamgroup', dest='streamGroup', help='Consumer group of the stream transport', metavar='STREAM_GROUP', default='redongo')
+    parser.add_option('--claimtimeout', dest='claimTimeout', help='Seconds before entries pending in another stream consumer are claimed', metavar='CLAIM_TIMEOUT', default=300)
+    parser.add_option('--reliable', dest='reliable', help='Keep popped objects in Redis until written (at-least-once)', action='store_true', default=False)
+    parser.add_option('--consumer', dest='consumer', help='Unique consumer name for reliable mode (default HOSTNAME_DISK_QUEUE)', metavar='CONSUMER')
+    parser.add_option('--heartbeatttl', dest='heartbeatTTL', help='Seconds without heartbeat before a reliable consumer is considered dead', metavar='HEARTBEAT_TTL', default=30)
+    parser.add_option('--metricsport', dest='metricsPort', help='Port serving metrics in the Prometheus text format (disabled by default)', metavar='METRICS_PORT')
+    parser.add_option('--stagetimers', dest='stageTimers', help='Time the stages of the run loop and Mongo writes', action='store_true', default=False)
+    parser.add_option('--profiledir', dest='profileDir', help='Directory of the profiles sampled on SIGUSR1', metavar='PROFILE_DIR', default='/tmp')
+    parser.add_option('--profileseconds', dest='profileSeconds', help='Seconds sampled on SIGUSR1', metavar='PROFILE_SECONDS', default=10)
     parser.add_option('--logger', '-L', dest='logger', help='Logger Usage', metavar='LOGGER_USAGE', default='1')
     parser.add_option('--log', '-l', dest='logLevel', help='Logger Level', metavar='LOG_LEVEL', default='debug')
+    return parser
+
+
+def main():
+    global rs
+    global options
+    global args
+    global logger
+
+    parser = get_option_parser()
     (options, args) = parser.parse_args()
 
     logger.setLevel(getattr(logging, options.logLevel.upper(), 'DEBUG'))
@@ -479,11 +878,19 @@ def main():
 
     rs = RedongoServer(mode)
 
-    lc = LoopingCall(rs.check_completed_bulks)
-    lc.start(1, now=False)
+    # kill -USR1 writes a profile of the next PROFILE_SECONDS to PROFILE_DIR
+    profiler = profiling_utils.SamplingProfiler(options.profileDir, duration=int(options.profileSeconds), report=rs.stage_timers.report)
+    signal.signal(signal.SIGUSR1, profiler.handle_signal)
+
+    rs.spill_worker.start()
+
+    if options.metricsPort:
+        reactor.listenTCP(int(options.metricsPort), Site(metrics_utils.MetricsResource(rs.metrics)))
+        logger.info('Serving metrics on port {0}'.format(options.metricsPort))
 
-    lc_redis_queue = LoopingCall(rs.check_redis_queue)
-    lc_redis_queue.start(1, now=False)
+    if rs.reliable:
+        lc_consumer = LoopingCall(rs.check_consumer)
+        lc_consumer.start(max(int(options.heartbeatTTL) / 3, 1), now=False)
 
     reactor.callInThread(rs.run)
 
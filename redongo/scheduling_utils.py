@@ -0,0 +1,55 @@
+import collections
+
+
+class DeficitRoundRobin(object):
+    ''' Weighted deficit round robin over queues. When its turn comes a queue gets quantum * weight items
+        of credit and is popped until the credit is spent or the queue is found empty, which drops the
+        credit left, then the next queue takes its turn:
+            queue, count = scheduler.next()
+            items = pop(queue, count)
+            scheduler.served(queue, count, len(items))
+    '''
+    def __init__(self, quantum=100):
+        self.quantum = quantum
+        self._queues = collections.deque()
+        self._weights = {}
+        self._deficits = {}
+
+    def __len__(self):
+        return len(self._queues)
+
+    def set_queues(self, weights):
+        ''' weights is queue -> weight, the queues not in it are removed '''
+        for queue in list(self._queues):
+            if queue not in weights:
+                self._queues.remove(queue)
+                self._weights.pop(queue)
+                self._deficits.pop(queue)
+        for queue, weight in weights.iteritems():
+            if queue not in self._weights:
+                self._queues.append(queue)
+                self._deficits[queue] = 0
+            self._weights[queue] = max(weight, 1)
+
+    def next(self, skip=()):
+        ''' Returns (queue, items of credit) of the queue to pop, None when every queue is in skip '''
+        for i in xrange(len(self._queues)):
+            queue = self._queues[0]
+            if queue in skip:
+                self._deficits[queue] = 0
+                self._queues.rotate(-1)
+                continue
+            if self._deficits[queue] <= 0:
+                self._deficits[queue] = self.quantum * self._weights[queue]
+            return queue, self._deficits[queue]
+        return None
+
+    def served(self, queue, requested, count):
+        ''' count items were popped from queue, which was asked for requested items '''
+        if count < requested:
+            # Empty, it takes its turn again with new credit
+            self._deficits[queue] = 0
+        else:
+            self._deficits[queue] -= count
+        if self._deficits[queue] <= 0:
+            self._queues.rotate(-1)
@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+import traceback
+import redis
+
+logger = logging.getLogger()
+
+
+class SpillWorker(object):
+    ''' Moves items from the Redis queue to disk on a background thread with save_function(queue, items),
+        acking them with ack_function(handles) once saved.
+        Spilling starts when the queue is longer than high_watermark and goes on until it is down to
+        low_watermark, moving at most max_items items and max_bytes bytes per second (0 for no limit).
+        on_error() is called if saving fails, the worker stops then.
+        get_transports() returns more queues, counted in the queue length. The longest one is spilled first,
+        queue tells which one the items come from.
+    '''
+    def __init__(self, transport, save_function, ack_function, high_watermark, low_watermark=None, pop_size=1000, max_items=0, max_bytes=0, interval=1, on_error=None, get_transports=None):
+        self.transport = transport
+        self.get_transports = get_transports
+        self.save_function = save_function
+        self.ack_function = ack_function
+        self.high_watermark = high_watermark
+        self.low_watermark = min(high_watermark, low_watermark if low_watermark is not None else high_watermark * 8 / 10)
+        self.pop_size = pop_size
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.on_error = on_error
+        self.spilling = False
+        self.queue_length = 0
+        self.spills = 0
+        self.spilled_items = 0
+        self.spilled_bytes = 0
+        self.throttled_seconds = 0.0
+        self._window_start = 0
+        self._window_items = 0
+        self._window_bytes = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='redongo-spill')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def _get_budget(self):
+        # Items that can be spilled in the current second, 0 if the budget is spent
+        now = time.time()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_items = 0
+            self._window_bytes = 0
+        if self.max_bytes and self._window_bytes >= self.max_bytes:
+            return 0
+        if self.max_items:
+            return max(self.max_items - self._window_items, 0)
+        return self.pop_size
+
+    def _spill(self):
+        # One step of a spill, returns False when the queue is under the watermark
+        transports = [self.transport]
+        if self.get_transports:
+            transports.extend(self.get_transports())
+        lengths = [transport.length() for transport in transports]
+        self.queue_length = sum(lengths)
+        if self.queue_length <= (self.low_watermark if self.spilling else self.high_watermark):
+            return False
+        if not self.spilling:
+            self.spilling = True
+            self.spills += 1
+            self._spill_start = time.time()
+            self._spill_items = 0
+        budget = self._get_budget()
+        if not budget:
+            wait = self._window_start + 1 - time.time()
+            self.throttled_seconds += wait
+            self._stopped.wait(wait)
+            return True
+        longest = max(lengths)
+        transport = transports[lengths.index(longest)]
+        items, handles = transport.pop(min(budget, self.pop_size, self.queue_length - self.low_watermark, longest), timeout=0)
+        if not items:
+            return False
+        self.save_function(transport.queue, items)
+        self.ack_function(handles)
+        size = sum(len(item) for item in items)
+        self._window_items += len(items)
+        self._window_bytes += size
+        self._spill_items += len(items)
+        self.spilled_items += len(items)
+        self.spilled_bytes += size
+        return True
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self._spill():
+                    continue
+            except redis.RedisError, e:
+                logger.warning('Could not spill Redis queue: {0}'.format(e))
+            except:
+                logger.error('Stopping spill worker because unexpected exception: {0}'.format(traceback.format_exc()))
+                if self.on_error:
+                    self.on_error()
+                return
+            if self.spilling:
+                self.spilling = False
+                logger.info('Spilled {0} objects to disk in {1:.2f} seconds, Redis queue length {2}'.format(self._spill_items, time.time() - self._spill_start, self.queue_length))
+            self._stopped.wait(self.interval)
+
+    def stats(self):
+        return {
+            'spilling': self.spilling,
+            'queue_length': self.queue_length,
+            'spills': self.spills,
+            'spilled_items': self.spilled_items,
+            'spilled_bytes': self.spilled_bytes,
+            'throttled_seconds': self.throttled_seconds,
+        }
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
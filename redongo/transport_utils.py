@@ -0,0 +1,355 @@
+import collections
+import itertools
+import redis
+import threading
+
+TRANSPORTS = ['list', 'stream']
+# Field of the stream entries holding the queue item
+STREAM_FIELD = 'i'
+
+# Pops up to ARGV[1] items from the head of the list KEYS[1] in one atomic step
+MULTI_POP_LUA = '''
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+end
+return items
+'''
+
+# Same as MULTI_POP_LUA, also appending the popped items to the processing list KEYS[2]
+MULTI_POP_PROCESSING_LUA = '''
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    for i = 1, #items, 1000 do
+        redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+    end
+end
+return items
+'''
+
+# Moves the processing list KEYS[1] back to the head of the queue KEYS[2], keeping its order
+RECLAIM_LUA = '''
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = #items, 1, -1 do
+    redis.call('LPUSH', KEYS[2], items[i])
+end
+redis.call('DEL', KEYS[1])
+return #items
+'''
+
+
+def get_application_queue(queue, application_name):
+    ''' Queue of an application with a weight in its settings, popped in turns with queue '''
+    return '{0}_APP:{1}'.format(queue, application_name)
+
+
+def get_application_queues_key(queue):
+    ''' Set of the application queues of queue, read by the servers '''
+    return '{0}_APPS'.format(queue)
+
+
+def add_push_commands(pipe, transport, queue, items):
+    ''' Adds to the pipeline pipe the commands sending items to queue, returns how many were added '''
+    if transport == 'stream':
+        for item in items:
+            pipe.execute_command('XADD', queue, '*', STREAM_FIELD, item)
+        return len(items)
+    pipe.rpush(queue, *items)
+    return 1
+
+
+class Batch(object):
+    ''' Popped items kept in Redis under key until all of them are acked through transport '''
+    __slots__ = ('key', 'pending', 'transport')
+
+    def __init__(self, key, pending, transport):
+        self.key = key
+        self.pending = pending
+        self.transport = transport
+
+
+class Transport(object):
+    ''' Server side of a queue. pop() returns the items along with one ack handle per item (None when
+        items need no ack), handles are given back to ack() once their items are safe
+    '''
+    def __init__(self):
+        self._ack_lock = threading.Lock()
+
+    def extend(self, batch, count):
+        ''' The next count acks of batch are needed to release it, for items split in several objects '''
+        if batch is not None:
+            with self._ack_lock:
+                batch.pending += count
+
+    def _release(self, batches):
+        # Keys of the batches fully acked
+        done = []
+        with self._ack_lock:
+            for batch in batches:
+                if batch is not None:
+                    batch.pending -= 1
+                    if not batch.pending:
+                        done.append(batch.key)
+        return done
+
+    def heartbeat(self):
+        pass
+
+    def reclaim(self, own=False):
+        return 0
+
+    def pop_first(self, others, count, timeout=1):
+        ''' Waits up to timeout seconds (integer) for items in this queue or the queues of others, transports
+            of the same class and Redis connection. Returns (transport, items, handles) of the first one
+            with items. This implementation only waits for this queue
+        '''
+        items, handles = self.pop(count, timeout=timeout)
+        return self, items, handles
+
+
+class ListTransport(Transport):
+    ''' Server side of a Redis list queue.
+        Batches are popped by a Lua script, so any number of servers can consume the same list
+        without a lock and without getting the same item twice.
+        With a consumer name (reliable mode) every popped batch is also moved to its own processing
+        list <queue>_PROCESSING:<consumer>:<n>, deleted once ack() has been called for all its items.
+        Processing lists of consumers whose heartbeat expired are moved back to the queue by reclaim().
+    '''
+    def __init__(self, redis_connection, queue, consumer=None, heartbeat_ttl=30):
+        Transport.__init__(self)
+        self.redis = redis_connection
+        self.queue = queue
+        self.consumer = consumer
+        self.heartbeat_ttl = heartbeat_ttl
+        self._multi_pop = self.redis.register_script(MULTI_POP_LUA)
+        if consumer:
+            self._multi_pop_processing = self.redis.register_script(MULTI_POP_PROCESSING_LUA)
+            self._reclaim = self.redis.register_script(RECLAIM_LUA)
+            self._batch_numbers = itertools.count()
+
+    @property
+    def processing_prefix(self):
+        return '{0}_PROCESSING:'.format(self.queue)
+
+    def get_heartbeat_key(self, consumer):
+        return '{0}_CONSUMER:{1}'.format(self.queue, consumer)
+
+    def length(self):
+        return self.redis.llen(self.queue)
+
+    def pop(self, count, timeout=1):
+        ''' Returns (items, handles) with up to count items, waiting up to timeout seconds (integer) if the
+            list is empty. Handles are None when not in reliable mode
+        '''
+        if self.consumer:
+            return self._pop_reliable(count, timeout)
+        try:
+            items = self._multi_pop(keys=[self.queue], args=[count])
+            if not items and timeout:
+                item = self.redis.blpop(self.queue, timeout=timeout)
+                if item:
+                    items = [item[1]]
+                    if count > 1:
+                        items.extend(self._multi_pop(keys=[self.queue], args=[count - 1]))
+        except redis.TimeoutError:
+            items = []
+        return items, [None] * len(items)
+
+    def pop_first(self, others, count, timeout=1):
+        # Reliable mode can only wait for one list, BRPOPLPUSH takes a single source
+        if self.consumer or not others:
+            return Transport.pop_first(self, others, count, timeout)
+        transports = dict((transport.queue, transport) for transport in others)
+        transports[self.queue] = self
+        try:
+            item = self.redis.blpop([self.queue] + [transport.queue for transport in others], timeout=timeout)
+        except redis.TimeoutError:
+            item = None
+        if not item:
+            return self, [], []
+        transport = transports[item[0]]
+        items = [item[1]]
+        if count > 1:
+            items.extend(transport.pop(count - 1, timeout=0)[0])
+        return transport, items, [None] * len(items)
+
+    def _pop_reliable(self, count, timeout):
+        key = '{0}{1}:{2}'.format(self.processing_prefix, self.consumer, next(self._batch_numbers))
+        items = []
+        try:
+            items = self._multi_pop_processing(keys=[self.queue, key], args=[count])
+            if not items and timeout:
+                # Takes the tail item, the only one when the list was empty
+                item = self.redis.brpoplpush(self.queue, key, timeout=timeout)
+                if item is not None:
+                    items = [item]
+                    if count > 1:
+                        items.extend(self._multi_pop_processing(keys=[self.queue, key], args=[count - 1]))
+        except redis.TimeoutError:
+            pass
+        return items, [Batch(key, len(items), self)] * len(items)
+
+    def ack(self, batches):
+        ''' Acks one item for each handle in batches, deleting the batches fully acked '''
+        if not self.consumer:
+            return
+        done = self._release(batches)
+        if done:
+            self.redis.delete(*done)
+
+    def heartbeat(self):
+        self.redis.set(self.get_heartbeat_key(self.consumer), 1, ex=self.heartbeat_ttl)
+
+    def reclaim(self, own=False):
+        ''' Moves back to the queue the processing lists of dead consumers, and this consumer's when own
+            is True (on startup, the lists left by a previous run). Returns the number of items moved
+        '''
+        reclaimed = 0
+        alive = {}
+        for key in self.redis.scan_iter(match='{0}*'.format(self.processing_prefix), count=1000):
+            consumer = key[len(self.processing_prefix):].rsplit(':', 1)[0]
+            if consumer == self.consumer:
+                if not own:
+                    continue
+            else:
+                if consumer not in alive:
+                    alive[consumer] = self.redis.exists(self.get_heartbeat_key(consumer))
+                if alive[consumer]:
+                    continue
+            reclaimed += self._reclaim(keys=[key, self.queue])
+        return reclaimed
+
+
+class StreamTransport(Transport):
+    ''' Server side of a Redis stream read through the consumer group group, every entry is one queue item.
+        Entries are acked and deleted once ack() has been called for them. Entries pending for more than
+        claim_timeout seconds in other consumers are claimed by reclaim() and popped again.
+    '''
+    def __init__(self, redis_connection, queue, consumer, group='redongo', claim_timeout=300):
+        Transport.__init__(self)
+        self.redis = redis_connection
+        self.queue = queue
+        self.consumer = consumer
+        self.group = group
+        self.claim_timeout = claim_timeout
+        # (entry id, item) popped before reading new entries
+        self._claimed = collections.deque()
+        try:
+            self.redis.execute_command('XGROUP', 'CREATE', queue, group, '0', 'MKSTREAM')
+        except redis.ResponseError, e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def length(self):
+        ''' Entries not delivered yet. Delivered entries stay in the stream until they are acked '''
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.execute_command('XLEN', self.queue)
+        pipe.execute_command('XPENDING', self.queue, self.group)
+        length, pending = pipe.execute()
+        return length - pending[0]
+
+    def pop(self, count, timeout=1):
+        ''' Returns (items, handles) with up to count items, waiting up to timeout seconds if there are no new entries '''
+        items = []
+        handles = []
+        while len(items) < count:
+            try:
+                entry_id, item = self._claimed.popleft()
+            except IndexError:
+                # The spill worker pops from another thread
+                break
+            items.append(item)
+            handles.append(Batch(entry_id, 1, self))
+        if len(items) < count:
+            args = ['XREADGROUP', 'GROUP', self.group, self.consumer, 'COUNT', count - len(items)]
+            if timeout and not items:
+                args.extend(['BLOCK', int(timeout * 1000)])
+            args.extend(['STREAMS', self.queue, '>'])
+            try:
+                response = self.redis.execute_command(*args)
+            except redis.TimeoutError:
+                response = None
+            if response:
+                # A single stream was read
+                for entry_id, item in self._get_entries(response[0][1]):
+                    items.append(item)
+                    handles.append(Batch(entry_id, 1, self))
+        return items, handles
+
+    def pop_first(self, others, count, timeout=1):
+        if self._claimed or not others or not timeout:
+            return Transport.pop_first(self, others, count, timeout)
+        transports = [self] + list(others)
+        args = ['XREADGROUP', 'GROUP', self.group, self.consumer, 'COUNT', count, 'BLOCK', int(timeout * 1000), 'STREAMS']
+        args.extend(transport.queue for transport in transports)
+        args.extend('>' for transport in transports)
+        try:
+            response = self.redis.execute_command(*args)
+        except redis.TimeoutError:
+            response = None
+        if not response:
+            return self, [], []
+        queues = dict((transport.queue, transport) for transport in transports)
+        # Entries of every stream read are popped next by their transport
+        for queue, entries in response:
+            queues[queue]._claimed.extend(queues[queue]._get_entries(entries))
+        transport = queues[response[0][0]]
+        items, handles = transport.pop(count, timeout=0)
+        return transport, items, handles
+
+    def _get_entries(self, entries):
+        # [(entry id, item)] of XREADGROUP or XCLAIM entries, acking the entries deleted meanwhile
+        result = []
+        deleted = []
+        for entry_id, fields in entries:
+            if fields:
+                result.append((entry_id, dict(zip(fields[::2], fields[1::2])).get(STREAM_FIELD)))
+            else:
+                deleted.append(entry_id)
+        if deleted:
+            self._ack_entries(deleted)
+        return result
+
+    def _ack_entries(self, entry_ids):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.execute_command('XACK', self.queue, self.group, *entry_ids)
+        pipe.execute_command('XDEL', self.queue, *entry_ids)
+        pipe.execute()
+
+    def ack(self, batches):
+        done = self._release(batches)
+        if done:
+            self._ack_entries(done)
+
+    def reclaim(self, own=False):
+        ''' Claims the entries pending in other consumers for more than claim_timeout, and when own is True
+            the entries still pending in this consumer (left by a previous run). Returns how many were claimed
+        '''
+        reclaimed = 0
+        if own:
+            last_id = '0'
+            while True:
+                response = self.redis.execute_command('XREADGROUP', 'GROUP', self.group, self.consumer, 'COUNT', 1000, 'STREAMS', self.queue, last_id)
+                if not response or not response[0][1]:
+                    break
+                last_id = response[0][1][-1][0]
+                entries = self._get_entries(response[0][1])
+                self._claimed.extend(entries)
+                reclaimed += len(entries)
+        start = '-'
+        while True:
+            pending = self.redis.execute_command('XPENDING', self.queue, self.group, start, '+', 1000)
+            if not pending:
+                break
+            to_claim = [entry_id for entry_id, consumer, idle, deliveries in pending if consumer != self.consumer and idle >= self.claim_timeout * 1000]
+            if to_claim:
+                entries = self._get_entries(self.redis.execute_command('XCLAIM', self.queue, self.group, self.consumer, self.claim_timeout * 1000, *to_claim))
+                self._claimed.extend(entries)
+                reclaimed += len(entries)
+            if len(pending) < 1000:
+                break
+            # Next id after the last one
+            milliseconds, sequence = pending[-1][0].split('-')
+            start = '{0}-{1}'.format(milliseconds, int(sequence) + 1)
+        return reclaimed
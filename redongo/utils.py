@@ -1,9 +1,13 @@
 import general_exceptions
+import time
 try:
     import cPickle as pickle
 except:
     import pickle
 
+# Incremented by RedongoClient on every application settings change
+SETTINGS_VERSION_KEY = 'REDONGO_SETTINGS_VERSION'
+
 
 def get_application_settings(application_name, redis):
         # TODO: Add settings validation
@@ -32,3 +36,46 @@ def get_application_settings(application_name, redis):
             raise general_exceptions.ApplicationSettingsError('Not existing conf for application {0}'.format(application_name))
         except ValueError:
             raise general_exceptions.ApplicationSettingsError('Invalid existing conf for application {0}'.format(application_name))
+
+
+class ApplicationSettingsCache(object):
+    ''' Keeps validated application settings in memory for ttl seconds.
+        refresh() is meant to be called once per popped batch: it drops the whole cache when
+        SETTINGS_VERSION_KEY has moved and expires old entries, so get() is a dict lookup.
+        Missing or invalid settings are cached too, as the exception to raise.
+    '''
+    def __init__(self, redis, ttl=60):
+        self.redis = redis
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._settings = {}
+        self._version = None
+        self._now = time.time()
+
+    def refresh(self):
+        self._now = time.time()
+        version = self.redis.get(SETTINGS_VERSION_KEY)
+        if version != self._version:
+            self._settings.clear()
+            self._version = version
+        else:
+            for application_name, (settings, expiration) in self._settings.items():
+                if expiration <= self._now:
+                    self._settings.pop(application_name)
+
+    def get(self, application_name):
+        entry = self._settings.get(application_name)
+        if entry is None:
+            self.misses += 1
+            try:
+                settings = get_application_settings(application_name, self.redis)
+            except general_exceptions.ApplicationSettingsError, e:
+                settings = e
+            entry = (settings, self._now + self.ttl)
+            self._settings[application_name] = entry
+        else:
+            self.hits += 1
+        if isinstance(entry[0], general_exceptions.ApplicationSettingsError):
+            raise entry[0]
+        return entry[0]
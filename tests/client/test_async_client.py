@@ -0,0 +1,90 @@
+import json
+import pytest
+import redis
+import time
+from redongo import redongo_async_client, redongo_client
+from redongo import client_exceptions
+from twisted.internet import reactor
+from twisted.python import failure
+
+import os
+env = os.getenv('TRAVIS')
+if env == 'true':
+    REDIS_HOST = 'localhost'
+    MONGO_HOST = 'localhost'
+else:
+    REDIS_HOST = 'dev-redis'
+    MONGO_HOST = 'dev-mongo'
+REDIS_DB = 0
+REDIS_QUEUE = 'REDONGO_TEST_ASYNC_QUEUE'
+APPNAME = 'testAppAsync'
+MONGO_PORT = 27017
+MONGO_DB = 'mydb_test'
+MONGO_COLLECTION = 'mycollection_test'
+MONGO_USER = 'test'
+MONGO_PASSWORD = 'test123'
+
+
+def get_result(d, timeout=5):
+    # Deferreds are fired through reactor.callFromThread, the reactor is not running in these tests
+    results = []
+    d.addBoth(results.append)
+    deadline = time.time() + timeout
+    while not results and time.time() < deadline:
+        reactor.runUntilCurrent()
+        time.sleep(0.01)
+    assert results, 'Deferred not fired'
+    return results[0]
+
+
+class TestAsyncClient:
+    def setup_method(self, method):
+        self.redis = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        self.redis.delete(REDIS_QUEUE)
+        # Set from another client, the async client reads them from Redis
+        self.sync_client = redongo_client.RedongoClient(REDIS_HOST, REDIS_DB, REDIS_QUEUE)
+        self.sync_client.set_application_settings(APPNAME, MONGO_HOST, MONGO_PORT, MONGO_DB, MONGO_COLLECTION, MONGO_USER, MONGO_PASSWORD, serializer_type='json')
+        self.client = redongo_async_client.AsyncRedongoClient(REDIS_HOST, REDIS_DB, REDIS_QUEUE)
+
+    def teardown_method(self, method):
+        get_result(self.client.close())
+        self.sync_client.remove_application_settings(APPNAME)
+        self.redis.delete(REDIS_QUEUE)
+
+    def get_queued_objects(self):
+        items = [redongo_client.envelope_utils.loads(item) for item in self.redis.lrange(REDIS_QUEUE, 0, -1)]
+        objects = [json.loads(payload) for header, payloads in items for payload in payloads]
+        for obj in objects:
+            obj.pop('objectid_fields', None)
+        return objects
+
+    def test__save_to_mongo__serialized_on_call(self):
+        obj = {'_id': 1, 'v': 'before'}
+        # The settings are not cached yet, then they are
+        for i in range(2):
+            d = self.client.save_to_mongo(APPNAME, obj)
+            obj['v'] = 'after'
+            assert get_result(d) is None
+            obj['v'] = 'before'
+        assert self.get_queued_objects() == [{'_id': 1, 'v': 'before'}] * 2
+
+    def test__save_to_mongo__settings_cached(self):
+        assert get_result(self.client.save_to_mongo(APPNAME, {'_id': 1})) is None
+        self.redis.delete('redongo_{0}'.format(APPNAME))
+        assert get_result(self.client.save_to_mongo(APPNAME, {'_id': 2})) is None
+        assert self.get_queued_objects() == [{'_id': 1}, {'_id': 2}]
+
+    def test__save_to_mongo__NoOK(self):
+        result = get_result(self.client.save_to_mongo('testAppAsyncFake', {'_id': 1}))
+        assert isinstance(result, failure.Failure)
+        assert result.check(client_exceptions.Save_InexistentAppSettings)
+        with pytest.raises(client_exceptions.Save_InvalidClass):
+            get_result(self.client.save_to_mongo(APPNAME, ['test'])).raiseException()
+
+    def test__close(self):
+        orders = [self.client.add_in_mongo(APPNAME, {'_id': i, 'count': 1}) for i in range(10)]
+        assert get_result(self.client.close()) is None
+        assert [get_result(d) for d in orders] == [None] * 10
+        assert len(self.get_queued_objects()) == 10
+        for d in (self.client.save_to_mongo(APPNAME, {'_id': 1}), self.client.get_application_settings(APPNAME), self.client.close()):
+            assert get_result(d).check(client_exceptions.Client_Closed)
@@ -0,0 +1,81 @@
+import threading
+import time
+from redongo import buffer_utils
+
+
+def wait_for(function, timeout=5):
+    deadline = time.time() + timeout
+    while not function() and time.time() < deadline:
+        time.sleep(0.01)
+    return function()
+
+
+class TestItemBuffer:
+    def setup_method(self, method):
+        self.pushed = []
+        self.buffer = None
+
+    def teardown_method(self, method):
+        if self.buffer:
+            self.buffer.close()
+
+    def push(self, queue, items):
+        self.pushed.append((queue, items))
+
+    def test__add__flush_size(self):
+        self.buffer = buffer_utils.ItemBuffer(self.push, flush_size=3, max_age=60)
+        assert self.buffer.add('queue1', ['a', 'b']) is True
+        time.sleep(0.05)
+        assert self.pushed == []
+        assert len(self.buffer) == 2
+        self.buffer.add('queue2', ['c'])
+        assert wait_for(lambda: self.pushed)
+        # One call per queue
+        assert sorted(self.pushed) == [('queue1', ['a', 'b']), ('queue2', ['c'])]
+        assert len(self.buffer) == 0
+
+    def test__add__max_age(self):
+        self.buffer = buffer_utils.ItemBuffer(self.push, flush_size=100, max_age=0.1)
+        start = time.time()
+        self.buffer.add('queue1', ['a'])
+        assert wait_for(lambda: self.pushed)
+        assert time.time() - start >= 0.1
+        assert self.pushed == [('queue1', ['a'])]
+
+    def test__add__drop(self):
+        self.buffer = buffer_utils.ItemBuffer(self.push, flush_size=100, max_age=60, max_items=3, full_policy='drop')
+        assert self.buffer.add('queue1', ['a', 'b']) is True
+        assert self.buffer.add('queue1', ['c', 'd']) is False
+        assert self.buffer.dropped == 2
+        self.buffer.flush()
+        # Once flushed there is room again
+        assert self.buffer.add('queue1', ['c', 'd']) is True
+        self.buffer.flush()
+        assert self.pushed == [('queue1', ['a', 'b']), ('queue1', ['c', 'd'])]
+
+    def test__add__block(self):
+        self.buffer = buffer_utils.ItemBuffer(self.push, flush_size=100, max_age=60, max_items=3)
+        self.buffer.add('queue1', ['a', 'b'])
+        added = threading.Event()
+
+        def add():
+            self.buffer.add('queue1', ['c', 'd'])
+            added.set()
+
+        threading.Thread(target=add).start()
+        assert not added.wait(0.1)
+        # Waits for the next flush
+        self.buffer.flush()
+        assert added.wait(5)
+        self.buffer.flush()
+        assert self.pushed == [('queue1', ['a', 'b']), ('queue1', ['c', 'd'])]
+        assert self.buffer.dropped == 0
+
+    def test__add__closed(self):
+        self.buffer = buffer_utils.ItemBuffer(self.push, flush_size=100, max_age=60)
+        self.buffer.add('queue1', ['a'])
+        self.buffer.close()
+        assert self.pushed == [('queue1', ['a'])]
+        assert self.buffer.add('queue1', ['b']) is False
+        assert self.buffer.dropped == 1
+        assert len(self.buffer) == 0
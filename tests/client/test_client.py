@@ -1,7 +1,7 @@
 import pytest
 import redis
 from redongo import redongo_client
-from redongo import client_exceptions, general_exceptions
+from redongo import client_exceptions, general_exceptions, transport_utils, utils
 try:
     from bson.objectid import ObjectId
 except ImportError:
@@ -14,6 +14,7 @@ APPNAME_FAKE = 'testAppFake'
 APPNAME_JSON = 'testAppJson'
 APPNAME_UJSON = 'testAppuJson'
 APPNAME_PICKLE = 'testAppPickle'
+APPNAME_WEIGHTED = 'testAppWeighted'
 import os
 env = os.getenv('TRAVIS')
 if env == 'true':
@@ -63,6 +64,10 @@ class TestClient:
         with pytest.raises(client_exceptions.Client_NoQueueParameter):
             redongo_client.RedongoClient(REDIS_HOST, REDIS_DB, None)
 
+    def test__RedongoClient__NoOK3(self):
+        with pytest.raises(client_exceptions.Client_NoValidTransport):
+            redongo_client.RedongoClient(REDIS_HOST, REDIS_DB, REDIS_QUEUE, transport='fake')
+
     def test__RedongoClient__OK(self):
         global test_redongo
         test_redongo = redongo_client.RedongoClient(REDIS_HOST, REDIS_DB, REDIS_QUEUE)
@@ -127,6 +132,11 @@ class TestClient:
         global test_redongo
         test_redongo.set_application_settings(APPNAME_PICKLE, MONGO_HOST, MONGO_PORT, MONGO_DB, MONGO_COLLECTION, MONGO_USER, MONGO_PASSWORD, bulk_size=1, serializer_type=SERIALIZER_PICKLE)
 
+    def test__set_application_settings__OK7(self):
+        global test_redongo
+        test_redongo.set_application_settings(APPNAME3, MONGO_HOST, MONGO_PORT, MONGO_DB, MONGO_COLLECTION, MONGO_USER, MONGO_PASSWORD, serializer_type=SERIALIZER_JSON, max_buffered_bytes=1024)
+        assert utils.get_application_settings(APPNAME3, test_redongo.redis)['max_buffered_bytes'] == 1024
+
     def test__save_to_mongo__NoOK1(self):
         global test_redongo
         with pytest.raises(client_exceptions.Save_InexistentAppSettings):
@@ -204,6 +214,24 @@ class TestClient:
         }
         test_redongo.add_in_mongo(APPNAME_PICKLE, [obj]*100)
 
+    def test__save_to_mongo__stream(self):
+        r = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        stream_redongo = redongo_client.RedongoClient(REDIS_HOST, REDIS_DB, '{0}_STREAM'.format(REDIS_QUEUE), transport='stream')
+        stream_redongo.save_to_mongo(APPNAME, [{'_id': i} for i in range(3)])
+        assert r.execute_command('XLEN', '{0}_STREAM'.format(REDIS_QUEUE)) == 3
+        r.delete('{0}_STREAM'.format(REDIS_QUEUE))
+
+    def test__save_to_mongo__weighted(self):
+        r = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        weighted_redongo = redongo_client.RedongoClient(REDIS_HOST, REDIS_DB, REDIS_QUEUE)
+        weighted_redongo.set_application_settings(APPNAME_WEIGHTED, MONGO_HOST, MONGO_PORT, MONGO_DB, MONGO_COLLECTION, MONGO_USER, MONGO_PASSWORD, serializer_type=SERIALIZER_JSON, weight=3)
+        weighted_redongo.save_to_mongo(APPNAME_WEIGHTED, [{'_id': i} for i in range(3)])
+        application_queue = transport_utils.get_application_queue(REDIS_QUEUE, APPNAME_WEIGHTED)
+        assert r.llen(application_queue) == 3
+        assert r.sismember(transport_utils.get_application_queues_key(REDIS_QUEUE), application_queue)
+        r.delete(application_queue, transport_utils.get_application_queues_key(REDIS_QUEUE))
+        weighted_redongo.remove_application_settings(APPNAME_WEIGHTED)
+
     def test__remove_application_settings__NoOK(self):
         global test_redongo
         with pytest.raises(general_exceptions.Register_NoApplicationName):
@@ -213,6 +241,13 @@ class TestClient:
         global test_redongo
         test_redongo.remove_application_settings(APPNAME3)
 
+    def test__remove_application_settings__version(self):
+        global test_redongo
+        r = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        version = int(r.get(utils.SETTINGS_VERSION_KEY) or 0)
+        test_redongo.remove_application_settings(APPNAME_FAKE)
+        assert int(r.get(utils.SETTINGS_VERSION_KEY)) == version + 1
+
     def test__get_application_settings__OK(self):
         global test_redongo
         test_redongo.get_application_settings(APPNAME)
@@ -0,0 +1,78 @@
+import os
+import pytest
+import redis
+from redongo import general_exceptions, utils
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+env = os.getenv('TRAVIS')
+if env == 'true':
+    REDIS_HOST = 'localhost'
+else:
+    REDIS_HOST = 'dev-redis'
+REDIS_DB = 0
+APPNAME = 'testAppCache'
+APPNAME_MISSING = 'testAppCacheMissing'
+
+
+def get_settings(bulk_size):
+    return {
+        'mongo_host': 'localhost',
+        'mongo_port': 27017,
+        'mongo_database': 'database',
+        'mongo_collection': 'collection',
+        'mongo_user': 'user',
+        'mongo_password': 'password',
+        'bulk_size': bulk_size,
+        'bulk_expiration': 60,
+        'serializer_type': 'pickle',
+    }
+
+
+class TestApplicationSettingsCache:
+    def setup_method(self, method):
+        self.redis = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        self.set_settings(100)
+        self.cache = utils.ApplicationSettingsCache(self.redis, ttl=60)
+        self.cache.refresh()
+
+    def teardown_method(self, method):
+        self.redis.delete('redongo_{0}'.format(APPNAME))
+
+    def set_settings(self, bulk_size):
+        # Without moving the settings version
+        self.redis.set('redongo_{0}'.format(APPNAME), pickle.dumps(get_settings(bulk_size)))
+
+    def test__get__cached(self):
+        assert self.cache.get(APPNAME)['bulk_size'] == 100
+        self.set_settings(200)
+        self.cache.refresh()
+        # Same version, served from the cache
+        assert self.cache.get(APPNAME)['bulk_size'] == 100
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    def test__get__version(self):
+        assert self.cache.get(APPNAME)['bulk_size'] == 100
+        self.set_settings(200)
+        self.redis.incr(utils.SETTINGS_VERSION_KEY)
+        # Served from the cache until the next refresh
+        assert self.cache.get(APPNAME)['bulk_size'] == 100
+        self.cache.refresh()
+        assert self.cache.get(APPNAME)['bulk_size'] == 200
+        assert (self.cache.hits, self.cache.misses) == (1, 2)
+
+    def test__get__ttl(self):
+        self.cache.ttl = 0
+        assert self.cache.get(APPNAME)['bulk_size'] == 100
+        self.set_settings(200)
+        self.cache.refresh()
+        assert self.cache.get(APPNAME)['bulk_size'] == 200
+
+    def test__get__missing(self):
+        # The error is cached too
+        for i in range(2):
+            with pytest.raises(general_exceptions.ApplicationSettingsError):
+                self.cache.get(APPNAME_MISSING)
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
@@ -0,0 +1,43 @@
+import pickle
+import pytest
+from redongo import envelope_utils
+
+HEADER = ('testApp', 'json', 'save')
+PAYLOADS = ['{"_id": 1}', '', '{"_id": 3, "text": "\xc3\xb1"}']
+
+
+class TestEnvelopeUtils:
+    def test__roundtrip__OK1(self):
+        for envelope_format in envelope_utils.ENVELOPE_FORMATS:
+            for payloads in (PAYLOADS[:1], PAYLOADS):
+                item = envelope_utils.dumps(HEADER, payloads, envelope_format)
+                header, loaded_payloads = envelope_utils.loads(item)
+                assert tuple(header) == HEADER
+                assert loaded_payloads == payloads
+
+    def test__roundtrip__unicode_application(self):
+        item = envelope_utils.dumps((u'app\xf1', 'json', 'add'), PAYLOADS, 'compact')
+        assert envelope_utils.loads(item) == (('app\xc3\xb1', 'json', 'add'), PAYLOADS)
+
+    def test__get_format__OK(self):
+        assert envelope_utils.get_format(envelope_utils.dumps(HEADER, PAYLOADS, 'compact')) == 'compact'
+        assert envelope_utils.get_format(envelope_utils.dumps(HEADER, PAYLOADS, 'pickle')) == 'pickle'
+        # Items pushed by clients older than the envelope formats
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            item = pickle.dumps([HEADER, PAYLOADS[0]], protocol)
+            assert envelope_utils.get_format(item) == 'pickle'
+            assert envelope_utils.loads(item) == (HEADER, [PAYLOADS[0]])
+
+    def test__loads__NoOK(self):
+        item = envelope_utils.dumps(HEADER, PAYLOADS, 'compact')
+        not_valid = [
+            item[:-1],
+            item + 'x',
+            item[:5],
+            item[:1] + '\x02' + item[2:],
+            pickle.dumps({'header': HEADER}),
+            pickle.dumps([HEADER[:2], PAYLOADS[0]]),
+        ]
+        for not_valid_item in not_valid:
+            with pytest.raises(ValueError):
+                envelope_utils.loads(not_valid_item)
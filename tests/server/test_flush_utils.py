@@ -0,0 +1,74 @@
+import threading
+import time
+from redongo import flush_utils
+
+
+class TestFlushExecutor:
+    def test__submit__application_order(self):
+        flushed = []
+        running = set()
+        overlapped = []
+        lock = threading.Lock()
+
+        def flush(application_name, bulk):
+            with lock:
+                overlapped.append(application_name in running)
+                running.add(application_name)
+            time.sleep(0.001)
+            with lock:
+                running.discard(application_name)
+                flushed.append((application_name, bulk))
+
+        executor = flush_utils.FlushExecutor(flush, threads=4, max_pending=1000)
+        for i in range(20):
+            for application_name in ('a', 'b', 'c'):
+                executor.submit(application_name, i)
+        deadline = time.time() + 5
+        while executor.pending and time.time() < deadline:
+            time.sleep(0.01)
+        assert executor.shutdown() == []
+        assert not any(overlapped)
+        for application_name in ('a', 'b', 'c'):
+            assert [bulk for name, bulk in flushed if name == application_name] == range(20)
+
+    def test__shutdown__not_flushed(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def flush(application_name, bulk):
+            started.set()
+            release.wait(5)
+
+        executor = flush_utils.FlushExecutor(flush, threads=1)
+        for i in range(3):
+            executor.submit('a', i)
+        executor.submit('b', 0)
+        assert started.wait(5)
+        assert executor.pending == 4
+        threading.Timer(0.1, release.set).start()
+        # Waits for the bulk being flushed, the queued ones are returned
+        not_flushed = executor.shutdown()
+        assert sorted(not_flushed) == [('a', 1), ('a', 2), ('b', 0)]
+        assert executor.pending == 0
+
+    def test__submit__weights(self):
+        release = threading.Event()
+        flushed = []
+
+        def flush(application_name, bulk):
+            release.wait(5)
+            flushed.append(application_name)
+
+        executor = flush_utils.FlushExecutor(flush, threads=1, max_pending=1000)
+        executor.submit('x', 0)
+        for i in range(8):
+            executor.submit('a', i, weight=1)
+            executor.submit('b', i, weight=3)
+        release.set()
+        deadline = time.time() + 5
+        while executor.pending and time.time() < deadline:
+            time.sleep(0.01)
+        assert executor.shutdown() == []
+        # While both have bulks queued, b gets three flushes for each one of a
+        assert flushed[:9] == ['x'] + ['a', 'b', 'b', 'b'] * 2
+        assert sorted(flushed[9:]) == ['a'] * 6 + ['b'] * 2
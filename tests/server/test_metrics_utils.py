@@ -0,0 +1,62 @@
+from redongo import metrics_utils
+from twisted.web.test.requesthelper import DummyRequest
+
+
+class TestMetricsRegistry:
+    def setup_method(self, method):
+        self.registry = metrics_utils.MetricsRegistry()
+        self.counter = self.registry.counter('test_objects_total', 'Objects read', labels=('application',))
+        self.registry.gauge('test_queue_length', 'Queue length', function=lambda: 7.0)
+        self.gauge = self.registry.gauge('test_buffered_bytes', 'Bytes buffered', labels=('application',))
+        self.histogram = self.registry.histogram('test_seconds', 'Flush time', (0.1, 1), labels=('application',))
+
+    def test__render__OK(self):
+        self.counter.inc(2, ('b',))
+        self.counter.inc(1, ('a"\\\n',))
+        self.counter.inc(3, ('b',))
+        self.gauge.set(1.5, ('a',))
+        for seconds in (0.25, 0.5, 5):
+            self.histogram.observe(seconds, ('a',))
+        self.histogram.observe(0.1, ('b',))
+        assert self.registry.render().split('\n') == [
+            '# HELP test_objects_total Objects read',
+            '# TYPE test_objects_total counter',
+            # Label values escaped, sorted by labels
+            'test_objects_total{application="a\\"\\\\\\n"} 1',
+            'test_objects_total{application="b"} 5',
+            '# HELP test_queue_length Queue length',
+            '# TYPE test_queue_length gauge',
+            'test_queue_length 7',
+            '# HELP test_buffered_bytes Bytes buffered',
+            '# TYPE test_buffered_bytes gauge',
+            'test_buffered_bytes{application="a"} 1.5',
+            '# HELP test_seconds Flush time',
+            '# TYPE test_seconds histogram',
+            # Cumulative buckets, a value on a bound is counted in it
+            'test_seconds_bucket{application="a",le="0.1"} 0',
+            'test_seconds_bucket{application="a",le="1"} 2',
+            'test_seconds_bucket{application="a",le="+Inf"} 3',
+            'test_seconds_sum{application="a"} 5.75',
+            'test_seconds_count{application="a"} 3',
+            'test_seconds_bucket{application="b",le="0.1"} 1',
+            'test_seconds_bucket{application="b",le="1"} 1',
+            'test_seconds_bucket{application="b",le="+Inf"} 1',
+            'test_seconds_sum{application="b"} 0.1',
+            'test_seconds_count{application="b"} 1',
+            '',
+        ]
+
+    def test__render__empty(self):
+        # Metrics with labels and no values only have their help and type
+        assert self.registry.render().split('\n')[:3] == [
+            '# HELP test_objects_total Objects read',
+            '# TYPE test_objects_total counter',
+            '# HELP test_queue_length Queue length',
+        ]
+
+    def test__render_GET__OK(self):
+        self.counter.inc(1, ('a',))
+        request = DummyRequest([''])
+        body = metrics_utils.MetricsResource(self.registry).render_GET(request)
+        assert body == self.registry.render()
+        assert request.outgoingHeaders['content-type'] == 'text/plain; version=0.0.4'
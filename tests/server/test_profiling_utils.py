@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import threading
+from redongo import profiling_utils
+
+
+class TestStageTimers:
+    def test__clock__disabled(self):
+        assert profiling_utils.StageTimers().clock() is None
+
+    def test__add_clock__OK(self):
+        stage_timers = profiling_utils.StageTimers(enabled=True)
+        clock = stage_timers.clock()
+        clock.last -= 0.5
+        clock.lap('pop')
+        clock.last -= 0.25
+        clock.lap('decode')
+        clock.last -= 0.5
+        # Laps of the same stage add up
+        clock.lap('pop')
+        assert round(clock.totals['pop'], 2) == 1.0
+        assert round(clock.totals['decode'], 2) == 0.25
+        stage_timers.add_clock(clock)
+        stats = stage_timers.stats()
+        assert sorted(stats) == ['decode', 'pop']
+        assert stats['pop']['count'] == 1
+
+    def test__stats__percentiles(self):
+        stage_timers = profiling_utils.StageTimers(enabled=True, window=100)
+        # Only the last window samples are kept
+        for seconds in range(200):
+            stage_timers.add('flush', seconds)
+        assert stage_timers.stats() == {'flush': {'count': 100, 'max': 199, 'p50': 150, 'p90': 190, 'p99': 199}}
+        assert stage_timers.report() == ['flush: p50=150.000000 p90=190.000000 p99=199.000000 max=199.000000']
+        summary = profiling_utils.StageSummary('test_stage_seconds', 'Stage time', stage_timers)
+        assert summary.get_lines() == [
+            'test_stage_seconds{stage="flush",quantile="0.5"} 150',
+            'test_stage_seconds{stage="flush",quantile="0.9"} 190',
+            'test_stage_seconds{stage="flush",quantile="0.99"} 199',
+            'test_stage_seconds_count{stage="flush"} 100',
+        ]
+
+
+def busy_function(stopped):
+    while not stopped.is_set():
+        sum(range(100))
+
+
+class TestSamplingProfiler:
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp(prefix='redongo-test-')
+        self.stopped = threading.Event()
+
+    def teardown_method(self, method):
+        self.stopped.set()
+        shutil.rmtree(self.directory)
+
+    def test__start__OK(self):
+        threading.Thread(target=busy_function, args=(self.stopped,), name='busy').start()
+        profiler = profiling_utils.SamplingProfiler(self.directory, duration=0.2, interval=0.01, report=lambda: ['stage: p50=1'])
+        assert profiler.start() is True
+        # Already sampling
+        assert profiler.start() is False
+        profiler._thread.join(5)
+        assert not profiler._thread.is_alive()
+        assert os.path.dirname(profiler.last_file) == self.directory
+        with open(profiler.last_file) as f:
+            lines = f.read().split('\n')
+        assert '# Stage timers' in lines
+        assert 'stage: p50=1' in lines
+        assert '# Folded stacks' in lines
+        folded = lines[lines.index('# Folded stacks') + 1:]
+        assert any(line.startswith('busy;') and 'test_profiling_utils.py:busy_function' in line for line in folded)
+        # Stopped, it can be started again
+        assert profiler.start() is True
+        profiler._thread.join(5)
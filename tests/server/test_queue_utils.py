@@ -0,0 +1,128 @@
+import collections
+import glob
+import os
+import pytest
+import random
+import shutil
+import tempfile
+from queuelib.queue import FifoDiskQueue
+from redongo import queue_utils
+
+
+class TestSegmentLog:
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp(prefix='redongo-test-')
+        self.path = os.path.join(self.directory, 'queue')
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.directory)
+
+    def get_segments(self):
+        return sorted(glob.glob(os.path.join(self.path, 'segment-*')))
+
+    def test__reopen__OK(self):
+        log = queue_utils.SegmentLog(self.path)
+        log.push_many(['a', 'b', 'c'])
+        log.push_many(['d'])
+        assert log.pop_many(2) == ['a', 'b']
+        log.close()
+        log = queue_utils.SegmentLog(self.path)
+        assert len(log) == 2
+        assert log.pop_many(10) == ['c', 'd']
+        log.close()
+        log = queue_utils.SegmentLog(self.path)
+        assert len(log) == 0
+        assert log.pop_many(10) == []
+
+    def test__reopen__not_closed(self):
+        # Records pushed after the last meta file update are counted on open
+        log = queue_utils.SegmentLog(self.path, meta_interval=60)
+        log.push_many(['a'])
+        log.push_many(['b', 'c'])
+        log = queue_utils.SegmentLog(self.path)
+        assert len(log) == 3
+        assert log.pop_many(10) == ['a', 'b', 'c']
+
+    def test__push_many__segments(self):
+        log = queue_utils.SegmentLog(self.path, segment_size=20)
+        objs = ['object{0:03d}'.format(i) for i in range(10)]
+        for obj in objs:
+            log.push_many([obj])
+        # 13 bytes records, a new segment every two of them
+        assert len(self.get_segments()) == 6
+        assert log.pop_many(3) == objs[:3]
+        log.close()
+        log = queue_utils.SegmentLog(self.path, segment_size=20)
+        assert len(self.get_segments()) == 5
+        assert log.pop_many(4) == objs[3:7]
+        assert len(log) == 3
+        assert log.pop_many(10) == objs[7:]
+        # Everything read, only the last segment is left and it is empty
+        assert len(self.get_segments()) == 1
+        assert os.path.getsize(self.get_segments()[0]) == 0
+        log.push_many(['last'])
+        assert log.pop_many(10) == ['last']
+
+    def test__partial_record(self):
+        log = queue_utils.SegmentLog(self.path)
+        log.push_many(['a', 'b'])
+        log.close()
+        # A record cut by a crash: its header says 100 bytes, only 3 were written
+        with open(self.get_segments()[-1], 'ab') as f:
+            f.write(queue_utils._record_header.pack(100) + 'abc')
+        log = queue_utils.SegmentLog(self.path)
+        assert len(log) == 2
+        log.push_many(['c'])
+        assert log.pop_many(10) == ['a', 'b', 'c']
+
+    def test__migrate__queuelib(self):
+        legacy_queue = FifoDiskQueue(self.path)
+        for i in range(5):
+            legacy_queue.push('legacy{0}'.format(i))
+        legacy_queue.pop()
+        legacy_queue.close()
+        log = queue_utils.SegmentLog(self.path)
+        assert not os.path.exists(os.path.join(self.path, 'info.json'))
+        assert len(log) == 4
+        log.push_many(['new'])
+        assert log.pop_many(10) == ['legacy1', 'legacy2', 'legacy3', 'legacy4', 'new']
+
+    def test__push_many__pop_many__interleaved(self):
+        expected = collections.deque()
+        log = queue_utils.SegmentLog(self.path, segment_size=200, read_size=16)
+        random.seed(1)
+        number = 0
+        for i in range(300):
+            if random.random() < 0.55:
+                objs = ['o{0}'.format(number + j) * random.randint(0, 5) for j in range(random.randint(0, 10))]
+                number += len(objs)
+                log.push_many(objs)
+                expected.extend(objs)
+            else:
+                count = random.randint(1, 12)
+                assert log.pop_many(count) == [expected.popleft() for j in range(min(count, len(expected)))]
+            assert len(log) == len(expected)
+            if i % 50 == 49:
+                log.close()
+                log = queue_utils.SegmentLog(self.path, segment_size=200, read_size=16)
+        assert log.pop_many(len(expected) + 1) == list(expected)
+
+
+class TestQueue:
+    def test__closed(self):
+        directory = tempfile.mkdtemp(prefix='redongo-test-')
+        try:
+            queue = queue_utils.Queue(queue_name=os.path.join(directory, 'queue'))
+            queue.push('a')
+            queue.push_many(['b', 'c'])
+            assert queue._length == 3
+            assert queue.pop() == 'a'
+            assert queue.pop_many(5) == ['b', 'c']
+            assert queue.pop() is None
+            queue.close()
+            with pytest.raises(queue_utils.Queue.PushInClosedQueue):
+                queue.push('d')
+            with pytest.raises(queue_utils.Queue.PopInClosedQueue):
+                queue.pop()
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,53 @@
+import collections
+from redongo import scheduling_utils
+
+
+class TestDeficitRoundRobin:
+    def setup_method(self, method):
+        self.scheduler = scheduling_utils.DeficitRoundRobin(quantum=10)
+        self.scheduler.set_queues(collections.OrderedDict([('a', 1), ('b', 3), ('c', 0)]))
+
+    def serve(self, turns, skip=()):
+        # Every queue always has objects, returns the objects popped per queue
+        popped = {}
+        for i in range(turns):
+            queue, credit = self.scheduler.next(skip)
+            count = min(credit, 4)
+            self.scheduler.served(queue, count, count)
+            popped[queue] = popped.get(queue, 0) + count
+        return popped
+
+    def test__next__weights(self):
+        assert len(self.scheduler) == 3
+        assert self.scheduler.next() == ('a', 10)
+        # Credit of 10 / 30 / 10 objects per round, popped 4 at a time
+        assert self.serve(3 + 8 + 3) == {'a': 10, 'b': 30, 'c': 10}
+        assert self.serve(3 * (3 + 8 + 3)) == {'a': 30, 'b': 90, 'c': 30}
+
+    def test__next__skip(self):
+        assert self.serve(1) == {'a': 4}
+        assert self.serve(9, skip=set(['a'])) == {'b': 30, 'c': 4}
+        assert self.scheduler.next() == ('c', 6)
+        self.scheduler.served('c', 4, 4)
+        self.scheduler.served('c', 2, 2)
+        # Skipped queues lose their credit
+        assert self.scheduler.next() == ('a', 10)
+        assert self.scheduler.next(skip=set(['a', 'b', 'c'])) is None
+
+    def test__served__empty(self):
+        assert self.scheduler.next() == ('a', 10)
+        self.scheduler.served('a', 4, 4)
+        # An empty queue ends its turn and drops the credit left
+        self.scheduler.served('a', 6, 1)
+        assert self.scheduler.next() == ('b', 30)
+        self.scheduler.served('b', 30, 0)
+        assert self.scheduler.next() == ('c', 10)
+        self.scheduler.served('c', 10, 10)
+        assert self.scheduler.next() == ('a', 10)
+
+    def test__set_queues__OK(self):
+        self.scheduler.set_queues({'b': 1, 'd': 2})
+        assert len(self.scheduler) == 2
+        assert self.scheduler.next() == ('b', 10)
+        self.scheduler.served('b', 10, 10)
+        assert self.scheduler.next() == ('d', 20)
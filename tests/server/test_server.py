@@ -1,7 +1,19 @@
+import collections
 import contextlib
 import pymongo
 import redis
+import shutil
+import tempfile
+import threading
+from redongo import profiling_utils
+from redongo import queue_utils
 from redongo import redongo_server
+from redongo import scheduling_utils
+from redongo import transport_utils
+from pymongo.errors import BulkWriteError
+from test_mongo_utils import FakeCollection
+from twisted.internet import reactor
+from twisted.internet import task
 import sys
 import signal
 
@@ -33,6 +45,73 @@ def redirect_argv(*args):
     sys.argv = sys._argv
 
 
+class FakeTransport(transport_utils.Transport):
+    def __init__(self, queue, items=()):
+        transport_utils.Transport.__init__(self)
+        self.queue = queue
+        self.items = collections.deque(items)
+
+    def length(self):
+        return len(self.items)
+
+    def pop(self, count, timeout=1):
+        items = [self.items.popleft() for i in range(min(count, len(self.items)))]
+        return items, [None] * len(items)
+
+
+class FakeReactor(task.Clock):
+    # Calls from other threads wait in thread_calls until run_thread_calls()
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.thread_calls = []
+
+    def callFromThread(self, function, *args, **kwargs):
+        self.thread_calls.append((function, args, kwargs))
+
+    def run_thread_calls(self):
+        thread_calls, self.thread_calls = self.thread_calls, []
+        for function, args, kwargs in thread_calls:
+            function(*args, **kwargs)
+
+
+class FakeFlushExecutor(object):
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, application_name, bulk, weight=1, cost=1):
+        self.submitted.append((application_name, bulk))
+
+
+def get_server(**attributes):
+    # A server without Redis, Mongo nor options, its bulks are submitted to a FakeFlushExecutor
+    server = redongo_server.RedongoServer.__new__(redongo_server.RedongoServer)
+    server.stage_timers = profiling_utils.StageTimers(enabled=False)
+    server.create_metrics()
+    server.bulks = {}
+    server.bulks_lock = threading.Lock()
+    server.buffer_condition = threading.Condition(server.bulks_lock)
+    server.flushing = True
+    server.buffered_bytes = {}
+    server.total_buffered_bytes = 0
+    server.max_buffered_bytes = 0
+    server.max_application_buffered_bytes = 0
+    server.buffer_budgets = {}
+    server.full_applications = set()
+    server.fair_applications = set()
+    server.buffer_full = False
+    server.buffer_full_seconds = 0.0
+    server.unflushed_bulks = []
+    server.flush_executor = FakeFlushExecutor()
+    server.__dict__.update(attributes)
+    return server
+
+
+def get_settings(**settings):
+    result = {'bulk_size': 100, 'bulk_expiration': 60, 'max_buffered_bytes': 0, 'weight': 0}
+    result.update(settings)
+    return result
+
+
 class TestServer:
     def test__RedongoServer__OK1(self):
         signal.alarm(10)
@@ -67,3 +146,253 @@ class TestServer:
         }
 
         assert search.next() == obj
+
+    def test__create_add_query__set(self):
+        server = redongo_server.RedongoServer.__new__(redongo_server.RedongoServer)
+        # str and other types both end in $set, the second one doesn't replace the first
+        query = server.create_add_query({'_id': 1, 'name': 'value', 'date': None, 'count': 2, 'inner': {'text': u'value', 'tags': ['a']}})
+        assert query == {
+            '$set': {'name': 'value', 'date': None, 'inner.text': u'value'},
+            '$inc': {'count': 2},
+            '$push': {'inner.tags': {'$each': ['a']}},
+        }
+        # Queries are not shared between calls
+        assert server.create_add_query({'_id': 2, 'other': None}) == {'$set': {'other': None}}
+
+    def test__add_in_mongo__merge(self):
+        server = get_server()
+        first = {'_id': 1, 'count': 1, 'tags': ['a'], 'name': 'first'}
+        objs = [(first, 'entry1'), ({'_id': 2, 'count': 5}, 'entry2'), ({'_id': 1, 'count': 2, 'tags': ['b'], 'name': 'last', 'other': 1.5}, 'entry3')]
+        collection = FakeCollection()
+        assert server.add_in_mongo(collection, objs) == []
+        # $inc values summed, $push lists concatenated and the last $set wins, in a single round
+        assert collection.bulks == [[
+            (1, 'update', {'$inc': {'count': 3, 'other': 1.5}, '$push': {'tags': {'$each': ['a', 'b']}}, '$set': {'name': 'last'}}),
+            (2, 'update', {'$inc': {'count': 5}}),
+        ]]
+        assert first['tags'] == ['a']
+
+    def test__add_in_mongo__rounds(self):
+        server = get_server()
+        objs = [
+            ({'_id': 1, 'count': 1}, 'entry1'),
+            ({'_id': 2, 'count': 1}, 'entry2'),
+            ({'_id': 3, 'inner': {'count': 1}}, 'entry3'),
+            # The same path with another operator
+            ({'_id': 1, 'count': 'reset'}, 'entry4'),
+            # A path inside another one
+            ({'_id': 3, 'inner': 'reset'}, 'entry5'),
+            ({'_id': 1, 'count': 2}, 'entry6'),
+        ]
+        collection = FakeCollection()
+        assert server.add_in_mongo(collection, objs) == []
+        # The nth update of every _id goes in the nth bulk
+        assert collection.bulks == [
+            [(1, 'update', {'$inc': {'count': 1}}), (2, 'update', {'$inc': {'count': 1}}), (3, 'update', {'$inc': {'inner.count': 1}})],
+            [(1, 'update', {'$set': {'count': 'reset'}}), (3, 'update', {'$set': {'inner': 'reset'}})],
+            [(1, 'update', {'$inc': {'count': 2}})],
+        ]
+
+    def test__add_in_mongo__failed(self):
+        server = get_server()
+        objs = [
+            ({'_id': 1, 'count': 1}, 'entry1'),
+            ({'_id': 2, 'count': 1}, 'entry2'),
+            ({'_id': 1, 'count': 2}, 'entry3'),
+            ({'count': 1}, 'entry4'),
+            ({'_id': 3}, 'entry5'),
+            ({'_id': 2, 'count': 'reset'}, 'entry6'),
+        ]
+        collection = FakeCollection(error=BulkWriteError({'writeErrors': [{'index': 0}]}))
+        # Objects without _id, then every object merged in the failed updates. Nothing is added with entry5
+        assert server.add_in_mongo(collection, objs) == [objs[3], objs[0], objs[2], objs[5]]
+        assert len(collection.bulks) == 2
+
+    def test__save_to_mongo__last_id(self):
+        server = get_server()
+        objs = [({'_id': 1, 'value': 'first'}, 'entry1'), ({'_id': 2}, 'entry2'), ({'_id': 1, 'value': 'last'}, 'entry3'), ({'value': 'new'}, 'entry4')]
+        collection = FakeCollection()
+        assert server.save_to_mongo(collection, objs) == []
+        # One replace per _id with its last object, objects without _id get one
+        assert collection.bulks[0][:2] == [(1, 'replace', {'_id': 1, 'value': 'last'}), (2, 'replace', {'_id': 2})]
+        assert collection.bulks[0][2][2] == {'_id': objs[3][0]['_id'], 'value': 'new'}
+        # Every object of a failed _id is returned
+        collection = FakeCollection(error=BulkWriteError({'writeErrors': [{'index': 0}]}))
+        assert server.save_to_mongo(collection, objs) == [objs[0], objs[2]]
+
+
+class TestPopNext:
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp(prefix='redongo-test-')
+        self.shared = FakeTransport(REDIS_QUEUE, ['shared{0}'.format(i) for i in range(30)])
+        self.application_queue = transport_utils.get_application_queue(REDIS_QUEUE, 'app')
+        self.application = FakeTransport(self.application_queue)
+        scheduler = scheduling_utils.DeficitRoundRobin(quantum=10)
+        scheduler.set_queues(collections.OrderedDict([(REDIS_QUEUE, 1), (self.application_queue, 1)]))
+        self.server = get_server(
+            redisQueue=REDIS_QUEUE,
+            popSize=10,
+            transport=self.shared,
+            application_transports={self.application_queue: self.application},
+            queue_applications={self.application_queue: 'app'},
+            application_queues_refresh=float('inf'),
+            scheduler=scheduler,
+            disk_queues={
+                REDIS_QUEUE: queue_utils.Queue(os.path.join(self.directory, 'shared')),
+                self.application_queue: queue_utils.Queue(os.path.join(self.directory, 'app')),
+            },
+        )
+
+    def teardown_method(self, method):
+        for disk_queue in self.server.disk_queues.values():
+            disk_queue.close()
+        shutil.rmtree(self.directory)
+
+    def pop_batches(self, count):
+        # Source of every batch popped, shared or app
+        return [self.server.pop_next()[0][0].rstrip('0123456789') for i in range(count)]
+
+    def test__pop_next__turns(self):
+        self.application.items.extend('app{0}'.format(i) for i in range(30))
+        assert self.pop_batches(4) == ['shared', 'app', 'shared', 'app']
+
+    def test__pop_next__spilled_application(self):
+        # A burst of the application spilled to disk keeps its turn, the shared queue its share
+        self.server.save_to_disk_queue(self.application_queue, ['app{0}'.format(i) for i in range(20)])
+        self.application.items.extend('app{0}'.format(i) for i in range(20, 30))
+        assert self.pop_batches(6) == ['shared', 'app', 'shared', 'app', 'shared', 'app']
+        assert self.server.disk_queues[self.application_queue]._length == 0
+        assert self.server.disk_queues[REDIS_QUEUE]._length == 0
+
+    def test__pop_next__over_budget(self):
+        self.application.items.extend('app{0}'.format(i) for i in range(30))
+        self.server.fair_applications = set(['app'])
+        self.server.buffer_budgets['app'] = 500
+        with self.server.bulks_lock:
+            self.server.update_buffered_bytes('app', 600)
+        # Only the queue of the application is skipped
+        assert not self.server.buffer_full
+        assert self.pop_batches(3) == ['shared'] * 3
+        assert self.server.pop_next() == []
+        with self.server.bulks_lock:
+            self.server.update_buffered_bytes('app', -600)
+        assert self.pop_batches(1) == ['app']
+
+
+class TestBufferBudgets:
+    def setup_method(self, method):
+        self.reactor = redongo_server.reactor = FakeReactor()
+        self.server = get_server(max_buffered_bytes=1000)
+        self.server.deal_with_mongo = lambda application_name, bulk: None
+
+    def teardown_method(self, method):
+        redongo_server.reactor = reactor
+
+    def add(self, application_name, size, **settings):
+        self.server.add_to_bulk(application_name, get_settings(**settings), ['object'], size)
+
+    def flush(self):
+        # Runs the flushes submitted
+        submitted, self.server.flush_executor.submitted = self.server.flush_executor.submitted, []
+        for application_name, bulk in submitted:
+            self.server.flush_bulk(application_name, bulk)
+        return [application_name for application_name, bulk in submitted]
+
+    def test__wait_for_buffer__global_budget(self):
+        self.add('a', 600)
+        assert self.server.wait_for_buffer(0) is True
+        self.add('b', 300)
+        self.add('c', 200)
+        assert self.server.buffer_full
+        # The biggest bulks are flushed until the ones left are within the budget
+        assert self.server.wait_for_buffer(0.01) is False
+        assert [application_name for application_name, bulk in self.server.flush_executor.submitted] == ['a']
+        assert self.server.buffer_full_seconds > 0
+        # Reads wait until the flush is written
+        threading.Timer(0.05, self.flush).start()
+        assert self.server.wait_for_buffer(5) is True
+        assert not self.server.buffer_full
+        assert self.server.total_buffered_bytes == 500
+        assert self.server.buffered_bytes == {'a': 0, 'b': 300, 'c': 200}
+
+    def test__add_to_bulk__application_budget(self):
+        self.server.fair_applications = set(['fair'])
+        self.add('fair', 300, max_buffered_bytes=500)
+        self.add('other', 300, max_buffered_bytes=500)
+        assert self.server.flush_executor.submitted == []
+        # An application with its own queue is flushed right away and only its queue is skipped
+        self.add('fair', 300, max_buffered_bytes=500)
+        assert self.server.full_applications == set(['fair'])
+        assert not self.server.buffer_full
+        assert self.flush() == ['fair']
+        assert self.server.full_applications == set()
+        # Other applications stop the reads, their bulk is flushed by wait_for_buffer
+        self.add('other', 300, max_buffered_bytes=500)
+        assert self.server.full_applications == set(['other'])
+        assert self.server.buffer_full
+        assert self.server.wait_for_buffer(0) is False
+        assert self.flush() == ['other']
+        assert not self.server.buffer_full
+        assert self.server.wait_for_buffer(0) is True
+        assert self.server.total_buffered_bytes == 0
+        assert self.server.buffered_bytes == {'fair': 0, 'other': 0}
+
+    def test__flush_bulk__failed(self):
+        def deal_with_mongo(application_name, bulk):
+            raise Exception('unexpected')
+
+        self.server.deal_with_mongo = deal_with_mongo
+        self.add('a', 600, max_buffered_bytes=500)
+        assert self.server.wait_for_buffer(0) is False
+        self.flush()
+        # The bulk is kept to be returned to disk and the server stops
+        assert [application_name for application_name, bulk in self.server.unflushed_bulks] == ['a']
+        assert (redongo_server.stopApp, (), {}) in self.reactor.thread_calls
+        assert self.server.total_buffered_bytes == 0
+        assert self.server.buffered_bytes == {'a': 0}
+        assert not self.server.buffer_full
+
+
+class TestBulkExpiration:
+    def setup_method(self, method):
+        self.reactor = redongo_server.reactor = FakeReactor()
+        self.server = get_server()
+
+    def teardown_method(self, method):
+        redongo_server.reactor = reactor
+
+    def add(self, application_name, count):
+        self.server.add_to_bulk(application_name, get_settings(bulk_size=3, bulk_expiration=10), ['object'] * count, count)
+        # The deadline is scheduled on the reactor thread
+        self.reactor.run_thread_calls()
+
+    def get_flushed(self):
+        return [(application_name, len(bulk)) for application_name, bulk in self.server.flush_executor.submitted]
+
+    def test__expire_bulk__partial(self):
+        self.add('a', 1)
+        self.reactor.advance(5)
+        self.add('a', 1)
+        self.add('b', 1)
+        self.reactor.advance(4.9)
+        assert self.get_flushed() == []
+        # From the first object of the bulk
+        self.reactor.advance(0.1)
+        assert self.get_flushed() == [('a', 2)]
+        self.reactor.advance(5)
+        assert self.get_flushed() == [('a', 2), ('b', 1)]
+        assert self.server.bulks == {}
+
+    def test__expire_bulk__flushed(self):
+        self.add('a', 2)
+        self.reactor.advance(5)
+        # Flushed because of its size, the next bulk gets its own deadline
+        self.add('a', 1)
+        assert self.get_flushed() == [('a', 3)]
+        self.add('a', 1)
+        self.reactor.advance(5)
+        assert self.get_flushed() == [('a', 3)]
+        assert len(self.server.bulks['a']) == 1
+        self.reactor.advance(5)
+        assert self.get_flushed() == [('a', 3), ('a', 1)]
+        assert self.reactor.getDelayedCalls() == []
@@ -0,0 +1,80 @@
+import collections
+import time
+from redongo import spill_utils
+
+
+class FakeTransport(object):
+    def __init__(self, queue, items=()):
+        self.queue = queue
+        self.items = collections.deque(items)
+
+    def length(self):
+        return len(self.items)
+
+    def pop(self, count, timeout=1):
+        items = [self.items.popleft() for i in range(min(count, len(self.items)))]
+        return items, ['handle-{0}'.format(item) for item in items]
+
+
+def get_items(start, stop):
+    return ['item{0}'.format(i) for i in range(start, stop)]
+
+
+class TestSpillWorker:
+    def setup_method(self, method):
+        self.saved = []
+        self.acked = []
+        self.transport = FakeTransport('queue')
+
+    def get_worker(self, transports=(), **kwargs):
+        return spill_utils.SpillWorker(self.transport, self.save, self.acked.extend, get_transports=lambda: transports, **kwargs)
+
+    def save(self, queue, items):
+        self.saved.append((queue, items))
+
+    def test__spill__watermarks(self):
+        worker = self.get_worker(high_watermark=10, low_watermark=5, pop_size=4)
+        self.transport.items.extend(get_items(0, 8))
+        assert worker._spill() is False
+        assert not worker.spilling
+        self.transport.items.extend(get_items(8, 12))
+        # Over the high watermark, it spills until the low watermark
+        assert worker._spill() is True
+        assert worker.spilling
+        assert worker._spill() is True
+        assert worker._spill() is False
+        assert self.saved == [('queue', get_items(0, 4)), ('queue', get_items(4, 7))]
+        assert self.acked == ['handle-{0}'.format(item) for item in get_items(0, 7)]
+        assert worker.queue_length == 5
+        assert (worker.spills, worker.spilled_items) == (1, 7)
+        # Under the high watermark a new spill doesn't start
+        worker.spilling = False
+        self.transport.items.extend(get_items(12, 15))
+        assert worker._spill() is False
+
+    def test__spill__budgets(self):
+        worker = self.get_worker(high_watermark=0, pop_size=3, max_bytes=10)
+        self.transport.items.extend(['data'] * 20)
+        assert worker._spill() is True
+        assert worker.spilled_bytes == 12
+        # The bytes of this second are spent, it waits for the next one
+        worker._window_start = time.time() - 0.9
+        assert worker._spill() is True
+        assert worker.spilled_items == 3
+        assert worker.throttled_seconds > 0
+        assert worker._spill() is True
+        assert worker.spilled_items == 6
+        worker = self.get_worker(high_watermark=0, pop_size=100, max_items=5)
+        assert worker._spill() is True
+        assert worker.spilled_items == 5
+
+    def test__spill__longest(self):
+        transports = [FakeTransport('application1', get_items(0, 8)), FakeTransport('application2', get_items(0, 2))]
+        worker = self.get_worker(transports, high_watermark=10, low_watermark=5)
+        self.transport.items.extend(get_items(0, 3))
+        assert worker._spill() is True
+        # The length of every queue is counted, the longest one is spilled
+        assert worker.queue_length == 13
+        assert self.saved == [('application1', get_items(0, 8))]
+        assert worker._spill() is False
+        assert worker.queue_length == 5
@@ -0,0 +1,174 @@
+import os
+import redis
+import sys
+import threading
+from redongo import transport_utils
+
+env = os.getenv('TRAVIS')
+if env == 'true':
+    REDIS_HOST = 'localhost'
+else:
+    REDIS_HOST = 'dev-redis'
+REDIS_DB = 0
+REDIS_QUEUE = 'REDONGO_TEST_TRANSPORT_QUEUE'
+
+
+class TestListTransport:
+    def setup_method(self, method):
+        self.redis = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        self.clean()
+        self.redis.rpush(REDIS_QUEUE, *['item{0}'.format(i) for i in range(5)])
+
+    def teardown_method(self, method):
+        self.clean()
+
+    def clean(self):
+        keys = self.redis.keys('{0}*'.format(REDIS_QUEUE))
+        if keys:
+            self.redis.delete(*keys)
+
+    def test__pop__OK(self):
+        transport = transport_utils.ListTransport(self.redis, REDIS_QUEUE)
+        assert transport.pop(3, timeout=0) == (['item0', 'item1', 'item2'], [None] * 3)
+        assert transport.pop(10, timeout=0) == (['item3', 'item4'], [None] * 2)
+        assert transport.pop(10, timeout=0) == ([], [])
+        self.redis.rpush(REDIS_QUEUE, 'item5')
+        assert transport.pop(10) == (['item5'], [None])
+        assert transport.length() == 0
+
+    def test__pop__reliable(self):
+        transport = transport_utils.ListTransport(self.redis, REDIS_QUEUE, consumer='consumer1')
+        items, handles = transport.pop(3, timeout=0)
+        assert items == ['item0', 'item1', 'item2']
+        batch = handles[0]
+        assert set(handles) == set([batch])
+        assert self.redis.lrange(batch.key, 0, -1) == items
+        # The last item is a frame of two objects
+        transport.extend(batch, 1)
+        transport.ack(handles)
+        assert self.redis.exists(batch.key)
+        transport.ack([batch])
+        assert not self.redis.exists(batch.key)
+        assert transport.length() == 2
+
+    def test__reclaim__dead_consumers(self):
+        dead = transport_utils.ListTransport(self.redis, REDIS_QUEUE, consumer='dead')
+        alive = transport_utils.ListTransport(self.redis, REDIS_QUEUE, consumer='alive')
+        alive.heartbeat()
+        assert dead.pop(2, timeout=0)[0] == ['item0', 'item1']
+        assert alive.pop(1, timeout=0)[0] == ['item2']
+        consumer = transport_utils.ListTransport(self.redis, REDIS_QUEUE, consumer='consumer1')
+        consumer.heartbeat()
+        # The items of dead go back to the head of the queue, in order
+        assert consumer.reclaim() == 2
+        assert self.redis.lrange(REDIS_QUEUE, 0, -1) == ['item0', 'item1', 'item3', 'item4']
+        assert consumer.reclaim() == 0
+        # A restarted consumer takes back its own items
+        assert alive.reclaim() == 0
+        assert alive.reclaim(own=True) == 1
+        assert self.redis.lrange(REDIS_QUEUE, 0, 0) == ['item2']
+
+    def test__pop_first__OK(self):
+        transport = transport_utils.ListTransport(self.redis, REDIS_QUEUE)
+        other = transport_utils.ListTransport(self.redis, '{0}_APP:a'.format(REDIS_QUEUE))
+        self.redis.delete(REDIS_QUEUE)
+        self.redis.rpush(other.queue, 'other0', 'other1', 'other2')
+        assert transport.pop_first([other], 2) == (other, ['other0', 'other1'], [None] * 2)
+        self.redis.rpush(REDIS_QUEUE, 'item5')
+        assert transport.pop_first([other], 2) == (transport, ['item5'], [None])
+        assert transport.pop_first([other], 2) == (other, ['other2'], [None])
+        assert transport.pop_first([other], 2) == (transport, [], [])
+
+
+class TestStreamTransport:
+    def setup_method(self, method):
+        self.redis = redis.Redis(REDIS_HOST, db=REDIS_DB)
+        self.redis.delete(REDIS_QUEUE)
+        self.transport = transport_utils.StreamTransport(self.redis, REDIS_QUEUE, 'consumer1', claim_timeout=0)
+        pipe = self.redis.pipeline(transaction=False)
+        transport_utils.add_push_commands(pipe, 'stream', REDIS_QUEUE, ['item{0}'.format(i) for i in range(5)])
+        pipe.execute()
+
+    def teardown_method(self, method):
+        self.redis.delete(REDIS_QUEUE, '{0}_APP:a'.format(REDIS_QUEUE))
+
+    def test__pop__ack(self):
+        items, handles = self.transport.pop(3, timeout=0)
+        assert items == ['item0', 'item1', 'item2']
+        # Delivered entries are not counted until they are acked
+        assert self.transport.length() == 2
+        self.transport.ack(handles[:2])
+        assert self.redis.execute_command('XLEN', REDIS_QUEUE) == 3
+        assert self.transport.length() == 2
+        assert self.transport.pop(10, timeout=0)[0] == ['item3', 'item4']
+        assert self.transport.pop(10, timeout=0) == ([], [])
+        assert self.transport.length() == 0
+
+    def test__reclaim__OK(self):
+        dead = transport_utils.StreamTransport(self.redis, REDIS_QUEUE, 'dead')
+        assert dead.pop(2, timeout=0)[0] == ['item0', 'item1']
+        items, handles = self.transport.pop(1, timeout=0)
+        assert items == ['item2']
+        # Entries pending in other consumers for claim_timeout seconds are claimed with XPENDING / XCLAIM
+        assert self.transport.reclaim() == 2
+        items, handles = self.transport.pop(10, timeout=0)
+        assert items == ['item0', 'item1', 'item3', 'item4']
+        self.transport.ack(handles)
+        # A restarted consumer pops its own pending entries again
+        restarted = transport_utils.StreamTransport(self.redis, REDIS_QUEUE, 'consumer1')
+        assert restarted.reclaim(own=True) == 1
+        items, handles = restarted.pop(10, timeout=0)
+        assert items == ['item2']
+        restarted.ack(handles)
+        assert self.redis.execute_command('XLEN', REDIS_QUEUE) == 0
+
+    def test__pop_first__OK(self):
+        other = transport_utils.StreamTransport(self.redis, '{0}_APP:a'.format(REDIS_QUEUE), 'consumer1')
+        self.transport.ack(self.transport.pop(10, timeout=0)[1])
+        pipe = self.redis.pipeline(transaction=False)
+        transport_utils.add_push_commands(pipe, 'stream', other.queue, ['other0', 'other1'])
+        pipe.execute()
+        transport, items, handles = self.transport.pop_first([other], 10)
+        assert transport is other
+        assert items == ['other0', 'other1']
+        other.ack(handles)
+        pipe = self.redis.pipeline(transaction=False)
+        transport_utils.add_push_commands(pipe, 'stream', REDIS_QUEUE, ['item5'])
+        transport_utils.add_push_commands(pipe, 'stream', other.queue, ['other2'])
+        pipe.execute()
+        # Both streams are read, the entries of other are popped in its next pop
+        transport, items, handles = self.transport.pop_first([other], 10)
+        assert (transport, items) == (self.transport, ['item5'])
+        self.transport.ack(handles)
+        items, handles = other.pop(10, timeout=0)
+        assert items == ['other2']
+        other.ack(handles)
+        assert self.transport.pop_first([other], 10) == (self.transport, [], [])
+
+    def test__pop__claimed_threads(self):
+        self.transport._claimed.extend(('{0}-0'.format(i), 'claimed{0}'.format(i)) for i in range(10000))
+        popped = []
+        errors = []
+
+        def pop():
+            try:
+                for i in range(1000):
+                    popped.extend(self.transport.pop(7, timeout=0)[0])
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=pop) for i in range(4)]
+        # Switches threads as often as possible
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setcheckinterval(check_interval)
+        assert errors == []
+        # Every claimed entry is popped once, then the stream entries
+        assert sorted(item for item in popped if item.startswith('claimed')) == sorted('claimed{0}'.format(i) for i in range(10000))
+        assert sorted(item for item in popped if item.startswith('item')) == ['item{0}'.format(i) for i in range(5)]